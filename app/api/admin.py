@@ -4,9 +4,12 @@ from rest_framework import serializers, viewsets, generics, status, exceptions
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.hashers import make_password
 from app import models
+from app.tile_cache import get_tile_cache_stats, reset_tile_cache_stats
+from app.task_scheduler import get_task_scheduler_stats
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -55,7 +58,7 @@ class ProfileSerializer(serializers.ModelSerializer):
         model  = Profile
         exclude = ('id', ) 
 
-        read_only_fields = ('user', )
+        read_only_fields = ('user', 'used_space', )
 
 class AdminProfileViewSet(viewsets.ModelViewSet):
     pagination_class = None
@@ -91,3 +94,21 @@ class AdminProfileViewSet(viewsets.ModelViewSet):
             raise exceptions.NotFound()
 
         return Response({'used': p.used_quota(), 'total': p.quota}, status=status.HTTP_200_OK)
+
+
+class AdminTileCacheView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(get_tile_cache_stats(), status=status.HTTP_200_OK)
+
+    def delete(self, request):
+        reset_tile_cache_stats()
+        return Response(get_tile_cache_stats(), status=status.HTTP_200_OK)
+
+
+class AdminTaskSchedulerView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(get_task_scheduler_stats(), status=status.HTTP_200_OK)
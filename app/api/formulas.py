@@ -3,7 +3,10 @@
 # https://numexpr.readthedocs.io/en/latest/user_guide.html#supported-operators
 
 import re
+import threading
+import numpy as np
 from functools import lru_cache
+from numexpr.necompiler import NumExpr, getExprNames, getType
 from django.utils.translation import gettext_lazy as _
 
 algos = {
@@ -184,6 +187,85 @@ def lookup_formula(algo, band_order = 'RGB'):
 
     return expr, hrange
 
+class CompiledExpression:
+    """
+    A band math expression (as returned by lookup_formula, e.g. "(b4-b1)/(b4+b1)")
+    compiled into numexpr programs that evaluate in float32.
+    Multiple comma separated expressions yield multiple output bands.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.blocks = []
+
+        indexes = set()
+        for block in expr.split(","):
+            block = block.strip()
+            try:
+                names, uses_vml = getExprNames(block, {})
+            except Exception as e:
+                raise ValueError("Invalid expression \"{}\": {}".format(block, str(e)))
+
+            for n in names:
+                if not re.match(r"^b[0-9]{1,2}$", n):
+                    raise ValueError("Invalid band \"{}\" in expression \"{}\"".format(n, block))
+                indexes.add(int(n[1:]))
+            self.blocks.append((block, names, uses_vml))
+
+        # Indexes (1-based) of the bands referenced by the expression
+        self.indexes = tuple(sorted(indexes))
+
+        # Compiled programs cannot run concurrently, so each thread gets its own
+        # (compiling here validates the expression)
+        self._local = threading.local()
+        self._local.programs = self.compile()
+
+    def compile(self):
+        float32 = getType(np.empty(0, dtype=np.float32))
+        programs = []
+        for block, names, uses_vml in self.blocks:
+            try:
+                program = NumExpr(block, signature=[(n, float32) for n in names])
+            except Exception as e:
+                raise ValueError("Invalid expression \"{}\": {}".format(block, str(e)))
+            args = tuple(self.indexes.index(int(n[1:])) for n in names)
+            programs.append((program, args, uses_vml))
+        return programs
+
+    def get_programs(self):
+        programs = getattr(self._local, 'programs', None)
+        if programs is None:
+            programs = self._local.programs = self.compile()
+        return programs
+
+    @property
+    def count(self):
+        return len(self.blocks)
+
+    def evaluate(self, data, out=None):
+        """
+        :param data: array of shape (len(indexes), H, W) with the bands listed in indexes,
+            in the same order (any numeric type, converted on the fly)
+        :param out: optional float32 output array of shape (count, H, W)
+        :return: float32 array of shape (count, H, W)
+        """
+        if out is None:
+            out = np.empty((self.count, ) + data.shape[1:], dtype=np.float32)
+
+        for i, (program, args, uses_vml) in enumerate(self.get_programs()):
+            program(*[data[a] for a in args], out=out[i], order='K', casting='same_kind', ex_uses_vml=uses_vml)
+
+        return out
+
+
+@lru_cache(maxsize=64)
+def compile_expression(expr):
+    """
+    :param expr: band math expression (as returned by lookup_formula)
+    :return: CompiledExpression, shared across tiles, previews and exports
+    """
+    return CompiledExpression(expr)
+
 @lru_cache(maxsize=2)
 def get_algorithm_list(max_bands=3):
     res = []
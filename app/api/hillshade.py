@@ -4,6 +4,7 @@
 # Description of changes: Factored out hillshading code
 
 
+import threading
 import numpy as np
 
 def _vector_magnitude(arr):
@@ -124,4 +125,167 @@ class LightSource:
             # intensity /= (imax - imin)
         intensity = np.clip(intensity, 0, 1)
 
-        return intensity
\ No newline at end of file
+        return intensity
+
+# Supported hillshade modes (besides the default single light source)
+HILLSHADE_MODES = ['multidirectional']
+
+# Azimuths used by the multi-directional hillshade (same as GDAL's)
+MULTIDIRECTIONAL_AZIMUTHS = (225, 270, 315, 360)
+
+_buffers = threading.local()
+
+
+def _get_buffers(shape, count):
+    """
+    Get scratch float32 buffers for the current thread. Buffers are
+    reused across calls with the same shape (e.g. all tiles of a layer)
+    """
+    if not hasattr(_buffers, 'arrays'):
+        _buffers.arrays = {}
+
+    key = (shape, count)
+    if key not in _buffers.arrays:
+        # Only keep a few sets of buffers around
+        if len(_buffers.arrays) >= 4:
+            _buffers.arrays.clear()
+        _buffers.arrays[key] = [np.empty(shape, dtype=np.float32) for _ in range(count)]
+    return _buffers.arrays[key]
+
+
+def _gradient(elevation, spacing, axis, out):
+    """
+    Same as np.gradient for a single axis, but writes into out
+    (central differences in the interior, one-sided differences at the edges)
+    """
+    e = np.moveaxis(elevation, axis, 0)
+    o = np.moveaxis(out, axis, 0)
+
+    np.subtract(e[2:], e[:-2], out=o[1:-1])
+    o[1:-1] /= 2.0 * spacing
+    np.subtract(e[1], e[0], out=o[0])
+    o[0] /= spacing
+    np.subtract(e[-1], e[-2], out=o[-1])
+    o[-1] /= spacing
+
+
+def hillshade(elevation, vert_exag=1, dx=1, dy=1, azdeg=315, altdeg=45, multidirectional=False, out=None):
+    """
+    Compute the illumination intensity of an elevation model. This gives the
+    same results as LightSource.hillshade, but fuses the gradient, normals and
+    shading steps into a few in-place operations on reusable buffers.
+    :param elevation: 2D elevation array
+    :param vert_exag: vertical exaggeration
+    :param dx: x spacing (columns)
+    :param dy: y spacing (rows)
+    :param azdeg: azimuth of the light source in degrees (ignored if multidirectional)
+    :param altdeg: altitude of the light source in degrees
+    :param multidirectional: combine light sources from multiple directions,
+        each weighted by the aspect of the terrain
+    :param out: optional float32 output array
+    :return: float32 array of intensity values between 0-1
+    """
+    if out is None:
+        out = np.empty(elevation.shape, dtype=np.float32)
+
+    if multidirectional:
+        gx, gy, norm, g2, t, t2 = _get_buffers(elevation.shape, 6)
+    else:
+        gx, gy, norm = _get_buffers(elevation.shape, 3)
+
+    _gradient(elevation, dx, 1, gx)
+    _gradient(elevation, dy, 0, gy)
+    if vert_exag != 1:
+        gx *= vert_exag
+        gy *= vert_exag
+
+    # Normal vectors are (-gx, -gy, 1) / norm
+    np.multiply(gx, gx, out=norm)
+    np.multiply(gy, gy, out=out)
+    norm += out
+    if multidirectional:
+        np.copyto(g2, norm)
+    norm += 1.0
+    np.sqrt(norm, out=norm)
+
+    alt = np.radians(altdeg)
+    lz = np.sin(alt)
+
+    if not multidirectional:
+        az = np.radians(90 - azdeg)
+        np.multiply(gx, -np.cos(az) * np.cos(alt), out=out)
+        gy *= -np.sin(az) * np.cos(alt)
+        out += gy
+        out += lz
+        out /= norm
+        np.clip(out, 0, 1, out=out)
+        return out
+
+    # Weights are sin^2 of the angle between the aspect and each light
+    # direction, they add up to 2 for 4 directions 45 degrees apart
+    flat = g2 == 0
+    g2[flat] = 1.0
+    np.divide(1.0, g2, out=g2)
+    out.fill(0)
+
+    for azdeg in MULTIDIRECTIONAL_AZIMUTHS:
+        az = np.radians(90 - azdeg)
+
+        # Horizontal component of the gradient along the light direction
+        np.multiply(gx, np.cos(az), out=t)
+        np.multiply(gy, np.sin(az), out=t2)
+        t += t2
+
+        # Intensity for this light
+        np.multiply(t, -np.cos(alt), out=t2)
+        t2 += lz
+        t2 /= norm
+        np.clip(t2, 0, 1, out=t2)
+
+        # Weight
+        np.multiply(t, t, out=t)
+        t *= g2
+        np.subtract(1.0, t, out=t)
+
+        t *= t2
+        out += t
+
+    out *= 0.5
+
+    # Flat areas have no aspect, all lights contribute equally
+    np.copyto(out, lz, where=flat)
+    return out
+
+
+def hillshade_blend(rgb, intensity, out=None):
+    """
+    Replace the HSV value of an RGB image with a hillshade intensity,
+    keeping hue and saturation. This gives the same results as hsv_blend:
+    for a given hue and saturation, RGB values are proportional to the value
+    (max(R,G,B)), so the blend is a single scaling of each pixel by
+    value / max(R,G,B) with no HSV round trip.
+    :param rgb: (3, H, W) array of RGB values in the range [0,255]
+    :param intensity: (H, W) array of intensity values in the range [0,1]
+    :param out: optional (3, H, W) uint8 output array
+    :return: (3, H, W) uint8 array
+    """
+    if out is None:
+        out = np.empty(rgb.shape, dtype=np.uint8)
+
+    maxc, scale = _get_buffers(intensity.shape, 2)
+
+    np.maximum(rgb[0], rgb[1], out=maxc)
+    np.maximum(maxc, rgb[2], out=maxc)
+
+    # Black pixels have no hue or saturation, they become gray
+    black = maxc == 0
+    maxc[black] = 1.0
+
+    np.multiply(intensity, 255.0, out=scale)
+    scale /= maxc
+
+    for b in range(3):
+        np.multiply(rgb[b], scale, out=out[b], casting='unsafe')
+        np.copyto(out[b], scale, where=black, casting='unsafe')
+
+    return out
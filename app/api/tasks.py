@@ -17,6 +17,7 @@ from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.db import transaction
 from django.http import FileResponse
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
 from django.http import StreamingHttpResponse
 from django.contrib.gis.geos import Polygon
 from zipstream.ng import ZipStream
@@ -26,6 +27,8 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.db.models import Q
+from django.utils.http import http_date
+from urllib.parse import quote
 
 from app import models, pending_actions
 from nodeodm import status_codes
@@ -37,6 +40,10 @@ from app.security import path_traversal_check
 from django.utils.translation import gettext_lazy as _
 from .fields import PolygonGeometryField
 from app.geoutils import geom_transform_wkt_bbox
+from app.raster_pool import raster_pool
+from app.chunk_store import write_chunk, finalize_upload
+from app.console_events import wait_for_console_update
+from app.processing_stats import get_task_eta
 from webodm import settings
 
 def flatten_files(request_files):
@@ -96,6 +103,57 @@ class TaskSerializer(serializers.ModelSerializer):
         exclude = ('orthophoto_extent', 'dsm_extent', 'dtm_extent', )
         read_only_fields = ('processing_time', 'status', 'last_error', 'created_at', 'pending_action', 'available_assets', 'size', )
 
+def get_chunk_info(request):
+    """
+    :return: information about the chunk of a chunked (Dropzone) upload,
+        or None if the request is not a chunked upload
+    """
+    chunk_index = request.data.get('dzchunkindex')
+    uuid = request.data.get('dzuuid')
+    total_chunk_count = request.data.get('dztotalchunkcount', None)
+    if chunk_index is None or uuid is None or total_chunk_count is None:
+        return None
+
+    try:
+        chunk_index = int(chunk_index)
+        byte_offset = int(request.data.get('dzchunkbyteoffset', 0))
+        total_chunk_count = int(total_chunk_count)
+        total_size = request.data.get('dztotalfilesize')
+        total_size = int(total_size) if total_size is not None else None
+    except ValueError:
+        raise exceptions.ValidationError(detail="Some parameters are not integers")
+
+    checksum = request.data.get('dzchunkchecksum')
+    if checksum is not None and re.match(r'^[0-9a-fA-F]{64}$', checksum) is None:
+        raise exceptions.ValidationError(detail="Invalid chunk checksum (expected a SHA-256 hex digest)")
+
+    return {
+        'uuid': re.sub('[^0-9a-zA-Z-]+', "", uuid),
+        'chunk_index': chunk_index,
+        'byte_offset': byte_offset,
+        'total_chunk_count': total_chunk_count,
+        'total_size': total_size,
+        'checksum': checksum
+    }
+
+
+def read_console_lines(console, line_num, limit):
+    """
+    :param line_num: first line to read
+    :param limit: maximum number of lines to read, or if negative, to read from the end
+    :return: (list of lines, total number of lines)
+    """
+    line_end = None
+    last = None
+
+    if limit is not None:
+        if limit > 0:
+            line_end = line_num + limit
+        else:
+            last = abs(limit)
+
+    return console.read_lines(line_num, line_end, last=last)
+
 class TaskViewSet(viewsets.ViewSet):
     """
     Task get/add/delete/update
@@ -134,7 +192,7 @@ class TaskViewSet(viewsets.ViewSet):
         task.save()
 
         # Process task right away
-        worker_tasks.process_task.delay(task.id)
+        worker_tasks.wake_task(task.id)
 
         return Response({'success': True})
 
@@ -182,28 +240,72 @@ class TaskViewSet(viewsets.ViewSet):
         except ValueError:
             raise exceptions.ValidationError("Invalid parameter")
 
-        lines = task.console.output().rstrip().split('\n')
-        count = len(lines)
-        line_start = min(line_num, count)
-        line_end = None
-
-        if limit is not None:
-            if limit > 0:
-                line_end = line_num + limit
-            else:
-                line_start = line_start if count - line_start <= abs(limit) else count - abs(limit) 
-                line_end = None 
+        lines, count = read_console_lines(task.console, line_num, limit)
 
         if fmt == 'text':
-            return Response('\n'.join(lines[line_start:line_end]))
+            return Response('\n'.join(lines))
         elif fmt == 'raw':
-            return HttpResponse('\n'.join(lines[line_start:line_end]), content_type="text/plain; charset=utf-8")
+            return HttpResponse('\n'.join(lines), content_type="text/plain; charset=utf-8")
         else:
             return Response({
-                'lines': lines[line_start:line_end],
+                'lines': lines,
                 'count': count
             })
 
+    @action(detail=True, methods=['get'])
+    def tail(self, request, pk=None, project_pk=None):
+        """
+        Wait for new console output for this task (long-polling).
+
+        Returns as soon as the output has a different number of lines
+        than the "line" query param, or after "timeout" seconds (at most CONSOLE_TAIL_TIMEOUT).
+        Tasks that are not being processed return right away.
+
+        Accepts the same "line" and "limit" query params as output
+        and returns the same response as output with f=json
+        """
+        get_and_check_project(request, project_pk)
+        try:
+            task = self.queryset.get(pk=pk, project=project_pk)
+        except (ObjectDoesNotExist, ValidationError):
+            raise exceptions.NotFound()
+
+        try:
+            line_num = max(0, int(request.query_params.get('line', 0)))
+            limit = int(request.query_params.get('limit', 0)) or None
+            timeout = min(settings.CONSOLE_TAIL_TIMEOUT, max(0, float(request.query_params.get('timeout', settings.CONSOLE_TAIL_TIMEOUT))))
+        except ValueError:
+            raise exceptions.ValidationError("Invalid parameter")
+
+        if task.status in [None, status_codes.QUEUED, status_codes.RUNNING] or task.pending_action is not None:
+            wait_for_console_update(task.console.channel,
+                                    lambda: task.console.read_lines(0, 0)[1] != line_num,
+                                    timeout)
+
+        lines, count = read_console_lines(task.console, line_num, limit)
+
+        return Response({
+            'lines': lines,
+            'count': count
+        })
+
+    @action(detail=True, methods=['get'])
+    def eta(self, request, pk=None, project_pk=None):
+        """
+        Predict when this task will be completed, based on the processing
+        statistics of its processing node.
+
+        Returns the predicted processing time of the task and the number of seconds
+        until it completes (null when a prediction cannot be made)
+        """
+        get_and_check_project(request, project_pk)
+        try:
+            task = self.queryset.get(pk=pk, project=project_pk)
+        except (ObjectDoesNotExist, ValidationError):
+            raise exceptions.NotFound()
+
+        return Response(get_task_eta(task))
+
     def list(self, request, project_pk=None):
         get_and_check_project(request, project_pk)
         query = Q(project=project_pk)
@@ -267,9 +369,9 @@ class TaskViewSet(viewsets.ViewSet):
         if task.images_count < 1:
             raise exceptions.ValidationError(detail=_("You need to upload at least 1 file before commit"))
 
-        task.update_size()
+        task.update_size(components=[''])
         task.save()
-        worker_tasks.process_task.delay(task.id)
+        worker_tasks.wake_task(task.id)
 
         serializer = TaskSerializer(task)
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -290,32 +392,18 @@ class TaskViewSet(viewsets.ViewSet):
             raise exceptions.ValidationError(detail=_("No files uploaded"))
 
         chunk_info = None
-        chunk_index = request.data.get('dzchunkindex')
-        uuid = request.data.get('dzuuid') 
-        total_chunk_count = request.data.get('dztotalchunkcount', None)
-        if len(files) == 1 and chunk_index is not None and uuid is not None and total_chunk_count is not None:
-            byte_offset = request.data.get('dzchunkbyteoffset', 0)
-            try:
-                chunk_index = int(chunk_index)
-                byte_offset = int(byte_offset)
-                total_chunk_count = int(total_chunk_count)
-            except ValueError:
-                raise exceptions.ValidationError(detail="chunkIndex is not an int")
-            
-            chunk_info = {
-                'uuid': re.sub('[^0-9a-zA-Z-]+', "", uuid),
-                'chunk_index': chunk_index,
-                'byte_offset': byte_offset,
-                'total_chunk_count': total_chunk_count,
-                'tmp_upload_file': os.path.join(settings.FILE_UPLOAD_TEMP_DIR, f"{uuid}.upload")
-            }
+        if len(files) == 1:
+            chunk_info = get_chunk_info(request)
 
         # 50% of the time, raise an exception
         # import random
         # if random.random() < 0.5:
         #     raise exceptions.ValidationError(detail=_("Random upload failure for testing"))
 
-        uploaded = task.handle_images_upload(files, chunk_info)
+        try:
+            uploaded = task.handle_images_upload(files, chunk_info)
+        except ValueError as e:
+            raise exceptions.ValidationError(detail=str(e))
         if len(uploaded) > 0:
             task.images_count = len(task.scan_images())
             # Update other parameters such as processing node, task name, etc.
@@ -386,7 +474,7 @@ class TaskViewSet(viewsets.ViewSet):
                 serializer.is_valid(raise_exception=True)
                 serializer.save()
 
-                worker_tasks.process_task.delay(task.id)
+                worker_tasks.wake_task(task.id)
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -410,7 +498,7 @@ class TaskViewSet(viewsets.ViewSet):
         serializer.save()
 
         # Process task right away
-        worker_tasks.process_task.delay(task.id)
+        worker_tasks.wake_task(task.id)
 
         return Response(serializer.data)
 
@@ -436,25 +524,159 @@ class TaskNestedView(APIView):
         return task
 
 
-def download_file_response(request, filePath, content_disposition, download_filename=None):
+def parse_range_header(range_header, filesize):
+    """
+    :param range_header: value of the HTTP Range header (or None)
+    :param filesize: size of the file being requested
+    :return: (start, end) byte positions (inclusive) of the requested range,
+        or None if the whole file should be returned. Raises ValueError
+        if the range cannot be satisfied.
+    """
+    if not range_header:
+        return None
+
+    m = re.match(r'^bytes=(\d*)-(\d*)$', range_header.strip())
+    if m is None:
+        # Multiple ranges or unsupported units, serve the whole file
+        return None
+
+    first, last = m.group(1), m.group(2)
+    if first == "" and last == "":
+        return None
+
+    if first == "":
+        # Suffix range (last N bytes)
+        length = int(last)
+        if length == 0:
+            raise ValueError("Unsatisfiable range")
+        start = max(0, filesize - length)
+        end = filesize - 1
+    else:
+        start = int(first)
+        end = int(last) if last != "" else filesize - 1
+        if end < start:
+            # Invalid, ignore it
+            return None
+        end = min(end, filesize - 1)
+
+    if start >= filesize:
+        raise ValueError("Unsatisfiable range")
+
+    return start, end
+
+
+def read_file_range(file, start, end, block_size=65536):
+    try:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = file.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def get_file_etag(st):
+    """
+    :param st: os.stat result of a file
+    :return: ETag for the file (it changes when the file is modified)
+    """
+    return '"{:x}-{:x}"'.format(st.st_mtime_ns, st.st_size)
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as required for If-None-Match
+    return etag in [t.strip().replace('W/', '', 1) for t in header.split(",")]
+
+
+def get_offload_uri(filePath):
+    """
+    :return: URI of the internal location that nginx uses to send filePath,
+        or None if files cannot be offloaded
+    """
+    if not settings.DOWNLOAD_OFFLOAD_LOCATION:
+        return None
+
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    path = os.path.abspath(filePath)
+    if os.path.commonpath([media_root, path]) != media_root:
+        return None
+
+    relpath = os.path.relpath(path, media_root).replace(os.sep, "/")
+    return settings.DOWNLOAD_OFFLOAD_LOCATION.rstrip("/") + "/" + quote(relpath)
+
+
+def download_file_response(request, filePath, content_disposition, download_filename=None, stream=False):
+    """
+    Serve a file, after permissions have been checked. When nginx is in front of the app
+    (DOWNLOAD_OFFLOAD_LOCATION) it's asked to send the file with X-Accel-Redirect,
+    otherwise the file is sent from here with support for ETag and Range requests.
+    :param stream: always use a streaming response
+    """
     filename = os.path.basename(filePath)
     if download_filename is None: 
         download_filename = filename
-    filesize = os.stat(filePath).st_size
+    content_type = mimetypes.guess_type(filename)[0] or "application/zip"
+
+    offload_uri = get_offload_uri(filePath)
+    if offload_uri is not None:
+        # nginx handles ranges and conditional requests
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = offload_uri
+        response['Content-Disposition'] = "{}; filename={}".format(content_disposition, download_filename)
+        return response
+
+    st = os.stat(filePath)
+    filesize = st.st_size
+    etag = get_file_etag(st)
+
+    if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    # Ranges only apply if the file hasn't changed since the client last saw it
+    if_range = request.META.get('HTTP_IF_RANGE')
+    try:
+        if if_range is None or if_range.strip() == etag:
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'), filesize)
+        else:
+            byte_range = None
+    except ValueError:
+        response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        response['Content-Range'] = "bytes */{}".format(filesize)
+        return response
+
     file = open(filePath, "rb")
 
     # More than 100mb, normal http response, otherwise stream
     # Django docs say to avoid streaming when possible
-    stream = filesize > 1e8 or request.GET.get('_force_stream', False)
-    if stream:
-        response = FileResponse(file)
+    stream = stream or byte_range is not None or filesize > 1e8 or request.GET.get('_force_stream', False)
+    if byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_file_range(file, start, end), content_type=content_type,
+                                         status=status.HTTP_206_PARTIAL_CONTENT)
+        response['Content-Range'] = "bytes {}-{}/{}".format(start, end, filesize)
+        response['Content-Length'] = end - start + 1
+    elif stream:
+        # WSGI servers send FileResponses with sendfile
+        response = FileResponse(file, content_type=content_type)
+        response['Content-Length'] = filesize
     else:
-        response = HttpResponse(FileWrapper(file),
-                                content_type=(mimetypes.guess_type(filename)[0] or "application/zip"))
+        response = HttpResponse(FileWrapper(file), content_type=content_type)
+        response['Content-Length'] = filesize
 
-    response['Content-Type'] = mimetypes.guess_type(filename)[0] or "application/zip"
     response['Content-Disposition'] = "{}; filename={}".format(content_disposition, download_filename)
-    response['Content-Length'] = filesize
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(st.st_mtime)
 
     # For testing
     if stream:
@@ -505,6 +727,9 @@ class TaskDownloads(TaskNestedView):
 
         if is_stream:
             return download_file_stream(request, asset_fs, 'attachment', download_filename=download_filename)
+        elif task.is_deferred_asset(asset):
+            # Prebuilt archive
+            return download_file_response(request, asset_fs, 'attachment', download_filename=download_filename, stream=True)
         else:
             return download_file_response(request, asset_fs, 'attachment', download_filename=download_filename)
 
@@ -525,7 +750,8 @@ class TaskThumbnail(TaskNestedView):
         except ValueError:
             pass
 
-        with rasterio.open(orthophoto_path, "r") as raster:
+        with raster_pool.open(orthophoto_path) as src:
+            raster = src.dataset
             ci = raster.colorinterp
             indexes = (1, 2, 3,)
 
@@ -649,19 +875,60 @@ Task backup endpoint
 class TaskBackup(TaskNestedView):
     def get(self, request, pk=None, project_pk=None):
         """
-        Downloads a task's backup
+        Downloads a task's backup, building it first if needed. With ?async=1 the backup
+        is built by a worker instead: if it's not ready yet, the ID of the worker task
+        building it is returned (with status 202) and the download can be retried later.
         """
         task = self.get_and_check_task(request, pk)
+        since = request.GET.get('since')
+        if since is not None and not task.has_backup(since):
+            raise exceptions.ValidationError(detail=_("Invalid backup ID"))
 
         # Check and download
         try:
-            asset_fs = task.get_task_backup_stream()
+            backup = task.get_ready_backup(since)
+            if backup is None:
+                if request.GET.get('async') == '1':
+                    celery_task_id = worker_tasks.schedule_task_backup(task.id, since)
+
+                    # Might have been quick
+                    backup = task.get_ready_backup(since)
+                    if backup is None:
+                        return Response({'celery_task_id': celery_task_id}, status=status.HTTP_202_ACCEPTED)
+                else:
+                    backup = task.get_task_backup(since)
         except FileNotFoundError:
             raise exceptions.NotFound(_("Asset does not exist"))
 
+        backup_path, backup_id = backup
         download_filename = request.GET.get('filename', get_asset_download_filename(task, "backup.zip"))
 
-        return download_file_stream(request, asset_fs, 'attachment', download_filename=download_filename)
+        response = download_file_response(request, backup_path, 'attachment', download_filename=download_filename, stream=True)
+        # Pass as ?since= to only download what changed next time
+        response['X-Backup-Id'] = backup_id
+        return response
+
+    def post(self, request, pk=None, project_pk=None):
+        """
+        Starts building a task's backup
+        """
+        task = self.get_and_check_task(request, pk)
+        since = request.data.get('since')
+        if since is not None and not task.has_backup(since):
+            raise exceptions.ValidationError(detail=_("Invalid backup ID"))
+        filename = get_asset_download_filename(task, "backup.zip")
+
+        try:
+            if task.get_ready_backup(since) is not None:
+                url = '/api/projects/{}/tasks/{}/backup'.format(task.project.id, task.id)
+                if since is not None:
+                    url += '?since={}'.format(quote(since))
+                return Response({'url': url, 'filename': filename})
+        except FileNotFoundError:
+            raise exceptions.NotFound(_("Asset does not exist"))
+
+        celery_task_id = worker_tasks.schedule_task_backup(task.id, since)
+        return Response({'celery_task_id': celery_task_id, 'filename': filename})
 
 """
 Task assets import
@@ -686,39 +953,20 @@ class TaskAssetsImport(APIView):
             if re.match(r"^https?:\/\/.+$", import_url.lower()) is None:
                 raise exceptions.ValidationError(detail=_("Invalid URL. Did you mean %(hint)s ?") % { 'hint': f'http://{import_url}'})
 
-        chunk_index = request.data.get('dzchunkindex')
-        uuid = request.data.get('dzuuid') 
-        total_chunk_count = request.data.get('dztotalchunkcount', None)
-
         # Chunked upload?
-        tmp_upload_file = None
-        if len(files) > 0 and chunk_index is not None and uuid is not None and total_chunk_count is not None:
-            byte_offset = request.data.get('dzchunkbyteoffset', 0) 
-
-            try:
-                chunk_index = int(chunk_index)
-                byte_offset = int(byte_offset)
-                total_chunk_count = int(total_chunk_count)
-            except ValueError:
-                raise exceptions.ValidationError(detail="Some parameters are not integers")
-            uuid = re.sub('[^0-9a-zA-Z-]+', "", uuid)
-
-            tmp_upload_file = os.path.join(settings.FILE_UPLOAD_TEMP_DIR, f"{uuid}.upload")
-            if os.path.isfile(tmp_upload_file) and chunk_index == 0:
-                os.unlink(tmp_upload_file)
-            
-            with open(tmp_upload_file, 'ab') as fd:
-                fd.truncate(byte_offset)
-                fd.seek(byte_offset)
-                if isinstance(files[0], InMemoryUploadedFile):
-                    for chunk in files[0].chunks():
-                        fd.write(chunk)
-                else:
-                    with open(files[0].temporary_file_path(), 'rb') as f:
-                        shutil.copyfileobj(f, fd)
-            
-            if chunk_index + 1 < total_chunk_count:
-                return Response({'uploaded': True}, status=status.HTTP_200_OK)
+        chunk_info = None
+        if len(files) > 0:
+            chunk_info = get_chunk_info(request)
+            if chunk_info is not None:
+                try:
+                    complete = write_chunk(chunk_info['uuid'], files[0], chunk_info['chunk_index'], chunk_info['byte_offset'],
+                                           chunk_info['total_chunk_count'], total_size=chunk_info['total_size'],
+                                           checksum=chunk_info['checksum'])
+                except ValueError as e:
+                    raise exceptions.ValidationError(detail=str(e))
+
+                if not complete:
+                    return Response({'uploaded': True}, status=status.HTTP_200_OK)
 
         # Ready to import
         with transaction.atomic():
@@ -732,7 +980,7 @@ class TaskAssetsImport(APIView):
             destination_file = task.assets_path("all.zip")
 
             # Non-chunked file import
-            if tmp_upload_file is None and len(files) > 0:
+            if chunk_info is None and len(files) > 0:
                 with open(destination_file, 'wb+') as fd:
                     if isinstance(files[0], InMemoryUploadedFile):
                         for chunk in files[0].chunks():
@@ -740,11 +988,13 @@ class TaskAssetsImport(APIView):
                     else:
                         with open(files[0].temporary_file_path(), 'rb') as file:
                             copyfileobj(file, fd)
-            elif tmp_upload_file is not None:
-                # Move
-                shutil.move(tmp_upload_file, destination_file)
+            elif chunk_info is not None:
+                try:
+                    finalize_upload(chunk_info['uuid'], destination_file)
+                except ValueError as e:
+                    raise exceptions.ValidationError(detail=str(e))
 
-            worker_tasks.process_task.delay(task.id)
+            worker_tasks.wake_task(task.id)
 
         serializer = TaskSerializer(task)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -6,24 +6,28 @@ from rasterio.features import bounds as featureBounds
 from rasterio.errors import NotGeoreferencedWarning
 import urllib
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from .common import get_asset_download_filename
 from django.http import HttpResponse
+from webodm import settings
 from rio_tiler.errors import TileOutsideBounds
 from rio_tiler.utils import has_alpha_band, \
     non_alpha_indexes, render, create_cutline
-from rio_tiler.utils import _stats as raster_stats
-from rio_tiler.models import ImageStatistics, ImageData
-from rio_tiler.models import Metadata as RioMetadata
+from rio_tiler.models import ImageData
 from rio_tiler.profiles import img_profiles
 from rio_tiler.colormap import cmap as colormap, apply_cmap
-from rio_tiler.io import COGReader
 from rio_tiler.errors import InvalidColorMapName, AlphaBandWarning
 import numpy as np
 from .custom_colormaps_helper import custom_colormaps
-from app.raster_utils import extension_for_export_format, ZOOM_EXTRA_LEVELS
-from .hsvblend import hsv_blend
-from .hillshade import LightSource
-from .formulas import lookup_formula, get_algorithm_list, get_auto_bands
+from app.raster_utils import extension_for_export_format, get_precomputed_hillshade, ZOOM_EXTRA_LEVELS
+from app.raster_pool import raster_pool
+from app.raster_metadata import compute_raster_metadata, get_raster_metadata_key, get_cached_raster_metadata, \
+    put_cached_raster_metadata
+from app.tile_cache import get_tile_cache_key, get_geometry_hash, get_cached_tile, put_cached_tile
+from app.tile_pyramid import get_pyramid_tile
+from .hillshade import hillshade as compute_hillshade, hillshade_blend, HILLSHADE_MODES
+from .formulas import lookup_formula, get_algorithm_list, get_auto_bands, compile_expression
 from .tasks import TaskNestedView
 from app.geoutils import geom_transform_wkt_bbox
 from rest_framework import exceptions
@@ -59,7 +63,7 @@ def get_tile_url(task, tile_type, query_params):
     url = '/api/projects/{}/tasks/{}/{}/tiles/{{z}}/{{x}}/{{y}}'.format(task.project.id, task.id, tile_type)
     params = {}
 
-    for k in ['formula', 'bands', 'rescale', 'color_map', 'hillshade']:
+    for k in ['formula', 'bands', 'rescale', 'color_map', 'hillshade', 'hillshade_mode']:
         if query_params.get(k):
             params[k] = query_params.get(k)
     
@@ -104,7 +108,7 @@ class TileJson(TaskNestedView):
         if not os.path.isfile(raster_path):
             raise exceptions.NotFound()
 
-        with COGReader(raster_path) as src:
+        with raster_pool.open(raster_path) as src:
             minzoom, maxzoom = get_zoom_safe(src)
 
         return Response({
@@ -167,48 +171,35 @@ class Metadata(TaskNestedView):
 
         except ValueError as e:
             raise exceptions.ValidationError(str(e))
-        pmin, pmax = 2.0, 98.0
         raster_path = get_raster_path(task, tile_type)
         if not os.path.isfile(raster_path):
             raise exceptions.NotFound()
         try:
-            with COGReader(raster_path) as src:
-                band_count = src.dataset.meta['count']
-                if boundaries_feature is not None:
-                    cutline = create_cutline(src.dataset, boundaries_feature, CRS.from_string('EPSG:4326'))
-                    bounds = featureBounds(boundaries_feature)
-                elif crop and task.crop is not None:
-                    cutline, bounds = geom_transform_wkt_bbox(task.crop, src.dataset)
-                else:
-                    cutline = None
-                    bounds = None
-                
-                if cutline is not None:
-                    vrt_options = {'cutline': cutline}
-                else:
-                    vrt_options = None
-
-                if has_alpha_band(src.dataset):
-                    band_count -= 1
-                nodata = None
-                # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
-                if tile_type == 'orthophoto':
-                    nodata = 0
-                histogram_options = {"bins": 255, "range": hrange}
-                if expr is not None:
-                    data, mask = src.preview(expression=expr, vrt_options=vrt_options)
-                    data = np.ma.array(data)
-                    data.mask = mask == 0
-                    stats = {
-                        str(b + 1): raster_stats(data[b], percentiles=(pmin, pmax), bins=255, range=hrange)
-                        for b in range(data.shape[0])
-                    }
-                    stats = {b: ImageStatistics(**s) for b, s in stats.items()}
-                    metadata = RioMetadata(statistics=stats, **src.info().dict())
-                else:
-                    metadata = src.metadata(pmin=pmin, pmax=pmax, hist_options=histogram_options, nodata=nodata,
-                                            bounds=bounds, vrt_options=vrt_options)
-                info = json.loads(metadata.json())
+            # Statistics are expensive to compute, serve them from cache if possible
+            cache_key = get_raster_metadata_key(raster_path, tile_type, expr, hrange,
+                                                crop=task.crop if crop and boundaries_feature is None else None,
+                                                boundaries=boundaries_feature)
+            md = get_cached_raster_metadata(task, cache_key)
+            if md is None:
+                with raster_pool.open(raster_path) as src:
+                    if boundaries_feature is not None:
+                        cutline = create_cutline(src.dataset, boundaries_feature, CRS.from_string('EPSG:4326'))
+                        bounds = featureBounds(boundaries_feature)
+                    elif crop and task.crop is not None:
+                        cutline, bounds = geom_transform_wkt_bbox(task.crop, src.dataset)
+                    else:
+                        cutline = None
+                        bounds = None
+
+                    if cutline is not None:
+                        vrt_options = {'cutline': cutline}
+                    else:
+                        vrt_options = None
+
+                    md = compute_raster_metadata(src, tile_type, expr, hrange, vrt_options, bounds)
+                put_cached_raster_metadata(task, cache_key, md)
+            info = md['info']
+            band_count = md['band_count']
         except IndexError as e:
             # Caught when trying to get an invalid raster metadata
             # or when the crop area is defined improperly. In order
@@ -285,11 +276,313 @@ class Metadata(TaskNestedView):
             info['maxzoom'] = info['minzoom']
         info['maxzoom'] += ZOOM_EXTRA_LEVELS
         info['minzoom'] -= ZOOM_EXTRA_LEVELS
-        info['bounds'] = {'value': bounds if bounds is not None else src.bounds, 'crs': src.dataset.crs}
+        info['bounds'] = {'value': md['bounds'], 'crs': md['crs']}
 
         return Response(info)
 
 
+def get_tile_params(task, tile_type, query_params):
+    """
+    Parse and validate the rendering parameters of a tile request
+    :return: dict of rendering parameters
+    """
+    formula = query_params.get('formula')
+    bands = query_params.get('bands')
+    rescale = query_params.get('rescale')
+    color_map = query_params.get('color_map')
+    hillshade = query_params.get('hillshade')
+    hillshade_mode = query_params.get('hillshade_mode')
+    tilesize = query_params.get('size')
+    crop = query_params.get('crop') == '1'
+
+    boundaries_feature = query_params.get('boundaries')
+    if boundaries_feature == '':
+        boundaries_feature = None
+    if boundaries_feature is not None:
+        try:
+            boundaries_feature = json.loads(boundaries_feature)
+        except json.JSONDecodeError:
+            raise exceptions.ValidationError(_("Invalid boundaries parameter"))
+
+    if formula == '': formula = None
+    if bands == '': bands = None
+    if rescale == '': rescale = None
+    if color_map == '': color_map = None
+    if hillshade == '' or hillshade == '0': hillshade = None
+    if hillshade_mode == '' or hillshade_mode == 'single' or hillshade is None: hillshade_mode = None
+    if tilesize == '' or tilesize is None: tilesize = 256
+    if bands == 'auto' and formula:
+        bands, _discard_ = get_auto_bands(task.orthophoto_bands, formula)
+
+    try:
+        tilesize = int(tilesize)
+        if tilesize != 256 and tilesize != 512:
+            raise ValueError("Invalid size")
+    except ValueError:
+        raise exceptions.ValidationError(_("Invalid tile size parameter"))
+
+    if hillshade_mode is not None and hillshade_mode not in HILLSHADE_MODES:
+        raise exceptions.ValidationError(_("Invalid hillshade_mode value"))
+
+    try:
+        expr, _discard_ = lookup_formula(formula, bands)
+        if expr is not None:
+            compile_expression(expr)
+    except ValueError as e:
+        raise exceptions.ValidationError(str(e))
+
+    if tile_type in ['dsm', 'dtm'] and rescale is None:
+        rescale = "0,1000"
+    if tile_type == 'orthophoto' and rescale is None:
+        rescale = "0,255"
+
+    if tile_type in ['dsm', 'dtm'] and color_map is None:
+        color_map = "gray"
+
+    if tile_type == 'orthophoto' and formula is not None:
+        if color_map is None:
+            color_map = "gray"
+        if rescale is None:
+            rescale = "-1,1"
+
+    return {
+        'expr': expr,
+        'rescale': rescale,
+        'color_map': color_map,
+        'hillshade': hillshade,
+        'hillshade_mode': hillshade_mode,
+        'tilesize': tilesize,
+        'crop': crop,
+        'boundaries_feature': boundaries_feature,
+    }
+
+
+def render_tile(task, src, tile_type, z, x, y, params, tilesize, ext=None, accepts_webp=False):
+    """
+    Render a tile
+    :param src: COGReader
+    :param params: rendering parameters (see get_tile_params)
+    :param tilesize: size of the tile in pixels
+    :param ext: image format (png, jpg, webp) or None to choose automatically
+    :return: (image bytes, image format)
+    """
+    expr = params['expr']
+    rescale = params['rescale']
+    color_map = params['color_map']
+    hillshade = params['hillshade']
+    hillshade_mode = params['hillshade_mode']
+    crop = params['crop']
+    boundaries_feature = params['boundaries_feature']
+
+    indexes = None
+    nodata = None
+
+    if not src.tile_exists(z, x, y):
+        raise exceptions.NotFound(_("Outside of bounds"))
+
+    minzoom, maxzoom = get_zoom_safe(src)
+    has_alpha = has_alpha_band(src.dataset)
+    if z < minzoom - ZOOM_EXTRA_LEVELS or z > maxzoom + ZOOM_EXTRA_LEVELS:
+        raise exceptions.NotFound()
+
+    if boundaries_feature is not None:
+        try:
+            cutline = create_cutline(src.dataset, boundaries_feature, CRS.from_string('EPSG:4326'))
+        except:
+            raise exceptions.ValidationError(_("Invalid boundaries"))
+    elif crop and task.crop is not None:
+        cutline, bounds = geom_transform_wkt_bbox(task.crop, src.dataset)
+    else:
+        cutline = None
+
+    if cutline is not None:
+        vrt_options = {'cutline': cutline}
+    else:
+        vrt_options = None
+
+    # Handle N-bands datasets for orthophotos (not plant health)
+    if tile_type == 'orthophoto' and expr is None:
+        ci = src.dataset.colorinterp
+        # More than 4 bands?
+        if len(ci) > 4:
+            # Try to find RGBA band order
+            if ColorInterp.red in ci and \
+                    ColorInterp.green in ci and \
+                    ColorInterp.blue in ci:
+                indexes = (ci.index(ColorInterp.red) + 1,
+                           ci.index(ColorInterp.green) + 1,
+                           ci.index(ColorInterp.blue) + 1,)
+            else:
+                # Fallback to first three
+                indexes = (1, 2, 3,)
+        elif has_alpha:
+            indexes = non_alpha_indexes(src.dataset)
+
+    # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
+    if nodata is None and tile_type == 'orthophoto':
+        nodata = 0
+
+    resampling = "nearest"
+    padding = 0
+    tile_buffer = None
+
+    if tile_type in ["dsm", "dtm"]:
+        resampling = "bilinear"
+        padding = 16
+
+    hillshade_path = None
+    if hillshade is not None:
+        try:
+            hillshade = float(hillshade)
+            if hillshade <= 0:
+                hillshade = 1.0
+        except ValueError:
+            raise exceptions.ValidationError(_("Invalid hillshade value"))
+
+        hillshade_path = get_precomputed_hillshade(src.dataset.name, hillshade, hillshade_mode)
+
+        # Hillshading is not a local tile operation and
+        # requires neighbor tiles to be rendered seamlessly
+        # (unless we have precomputed it)
+        tile_buffer = 16 if hillshade_path is None else 0
+
+    try:
+        if expr is not None:
+            # Read only the referenced bands and apply the compiled expression
+            compiled = compile_expression(expr)
+            tile = src.tile(x, y, z, indexes=compiled.indexes, tilesize=tilesize, nodata=nodata,
+                            padding=padding,
+                            tile_buffer=tile_buffer,
+                            resampling_method=resampling, vrt_options=vrt_options)
+            tile = ImageData(compiled.evaluate(tile.data), tile.mask,
+                             assets=tile.assets, bounds=tile.bounds, crs=tile.crs)
+        else:
+            tile = src.tile(x, y, z, indexes=indexes, tilesize=tilesize, nodata=nodata,
+                            padding=padding,
+                            tile_buffer=tile_buffer,
+                            resampling_method=resampling, vrt_options=vrt_options)
+    except TileOutsideBounds:
+        raise exceptions.NotFound(_("Outside of bounds"))
+
+    if color_map:
+        try:
+            colormap.get(color_map)
+        except InvalidColorMapName:
+            raise exceptions.ValidationError(_("Not a valid color_map value"))
+
+    intensity = None
+    try:
+        rescale_arr = list(map(float, rescale.split(",")))
+    except ValueError:
+        raise exceptions.ValidationError(_("Invalid rescale value"))
+
+    # Auto?
+    if ext is None:
+        # Check for transparency
+        if np.equal(tile.mask, 255).all():
+            ext = "jpg"
+        else:
+            if accepts_webp:
+                ext = "webp"
+            else:
+                ext = "png"
+
+    driver = "jpeg" if ext == "jpg" else ext
+
+    options = img_profiles.get(driver, {})
+    if hillshade is not None and tile.data.shape[0] != 1:
+        raise exceptions.ValidationError(
+            _("Cannot compute hillshade of non-elevation raster (multiple bands found)"))
+
+    if hillshade_path is not None:
+        with raster_pool.open(hillshade_path) as hillshade_src:
+            try:
+                intensity = hillshade_src.tile(x, y, z, indexes=(1,), tilesize=tilesize,
+                                               resampling_method="bilinear", vrt_options=vrt_options).data[0]
+            except TileOutsideBounds:
+                raise exceptions.NotFound(_("Outside of bounds"))
+        intensity = intensity.astype(np.float32)
+        np.divide(intensity, 255.0, out=intensity)
+    elif hillshade is not None:
+        delta_scale = (maxzoom + ZOOM_EXTRA_LEVELS + 1 - z) ** 2
+        dx = src.dataset.meta["transform"][0] * delta_scale
+        dy = src.dataset.meta["transform"][4] * delta_scale
+
+        # Remove elevation data from edge buffer tiles
+        # (to keep intensity uniform across tiles)
+        elevation = tile.data[0]
+        elevation[0:tile_buffer, 0:tile_buffer] = nodata
+        elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, 0:tile_buffer] = nodata
+        elevation[0:tile_buffer, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
+        elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
+
+        intensity = compute_hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade,
+                                      multidirectional=hillshade_mode == 'multidirectional')
+        intensity = intensity[tile_buffer:tile_buffer+tilesize, tile_buffer:tile_buffer+tilesize]
+
+    if intensity is not None:
+        rgb = tile.post_process(in_range=(rescale_arr,))
+        rgb_data = rgb.data[:,tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer]
+        if colormap:
+            rgb, _discard_ = apply_cmap(rgb_data, colormap.get(color_map))
+        if rgb.data.shape[0] != 3:
+            raise exceptions.ValidationError(
+                _("Cannot process tile: intensity image provided, but no RGB data was computed."))
+        rgb = hillshade_blend(rgb, intensity)
+        if rgb is not None:
+            mask = tile.mask[tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer]
+            return render(rgb, mask, img_format=driver, **options), ext
+
+    if color_map is not None:
+        return tile.post_process(in_range=(rescale_arr,)).render(img_format=driver, colormap=colormap.get(color_map),
+                                                                **options), ext
+
+    return tile.post_process(in_range=(rescale_arr,)).render(img_format=driver, **options), ext
+
+
+def get_tile(task, tile_type, z, x, y, params, tilesize, ext=None, accepts_webp=False):
+    """
+    Get a rendered tile, from the tiles cache if possible
+    :return: (image bytes, image format)
+    """
+    url = get_raster_path(task, tile_type)
+    if not os.path.isfile(url):
+        raise exceptions.NotFound()
+
+    # Pre-rendered tiles
+    if ext != "webp":
+        pyramid_tile = get_pyramid_tile(task, tile_type, url, params, tilesize, z, x, y)
+        if pyramid_tile is False:
+            raise exceptions.NotFound(_("Outside of bounds"))
+        elif pyramid_tile is not None and (ext is None or pyramid_tile[1] == ext):
+            return pyramid_tile
+
+    cache_key = get_tile_cache_key(raster_mtime=os.path.getmtime(url),
+                                   tilesize=tilesize,
+                                   expr=params['expr'],
+                                   rescale=params['rescale'],
+                                   color_map=params['color_map'],
+                                   hillshade=params['hillshade'],
+                                   hillshade_mode=params['hillshade_mode'],
+                                   crop=get_geometry_hash(task.crop) if params['crop'] else None,
+                                   boundaries=get_geometry_hash(params['boundaries_feature']),
+                                   ext=ext)
+    if ext is None:
+        cache_exts = ["jpg", "webp" if accepts_webp else "png"]
+    else:
+        cache_exts = [ext]
+
+    cached = get_cached_tile(task.id, tile_type, z, x, y, cache_key, cache_exts)
+    if cached is not None:
+        return cached
+
+    with raster_pool.open(url) as src:
+        content, ext = render_tile(task, src, tile_type, z, x, y, params, tilesize, ext, accepts_webp)
+
+    put_cached_tile(task.id, tile_type, z, x, y, cache_key, ext, content)
+    return content, ext
+
+
 class Tiles(TaskNestedView):
     def get(self, request, pk=None, project_pk=None, tile_type="", z="", x="", y="", scale=1, ext=None):
         """
@@ -303,225 +596,129 @@ class Tiles(TaskNestedView):
 
         scale = int(scale)
 
-        indexes = None
-        nodata = None
-        rgb_tile = None
-
-        formula = self.request.query_params.get('formula')
-        bands = self.request.query_params.get('bands')
-        rescale = self.request.query_params.get('rescale')
-        color_map = self.request.query_params.get('color_map')
-        hillshade = self.request.query_params.get('hillshade')
-        tilesize = self.request.query_params.get('size')
-        crop = self.request.query_params.get('crop') == '1'
-
-        boundaries_feature = self.request.query_params.get('boundaries')
-        if boundaries_feature == '':
-            boundaries_feature = None
-        if boundaries_feature is not None:
+        params = get_tile_params(task, tile_type, self.request.query_params)
+        if params['tilesize'] == 512:
+            z -= 1
+        tilesize = scale * params['tilesize']
+
+        accepts_webp = 'image/webp' in request.headers.get('Accept', '')
+        content, ext = get_tile(task, tile_type, z, x, y, params, tilesize, ext, accepts_webp)
+
+        return HttpResponse(content, content_type="image/{}".format(ext))
+
+
+def parse_tile_range(value, name):
+    """
+    :param value: a number ("5") or an inclusive range ("5-8")
+    :return: (min, max)
+    """
+    try:
+        parts = value.split("-")
+        if len(parts) == 1:
+            return int(parts[0]), int(parts[0])
+        elif len(parts) == 2:
+            vmin, vmax = int(parts[0]), int(parts[1])
+            if vmin > vmax:
+                raise ValueError("Invalid range")
+            return vmin, vmax
+        else:
+            raise ValueError("Invalid range")
+    except (ValueError, AttributeError):
+        raise exceptions.ValidationError(_("Invalid %(param)s parameter") % {'param': name})
+
+
+def parse_tile_list(query_params):
+    """
+    Parse the list of tiles of a batch tile request, either
+    as tiles=z/x/y,z/x/y,... or as z=Z&x=XMIN-XMAX&y=YMIN-YMAX
+    :return: list of (z, x, y) tuples
+    """
+    tiles = query_params.get('tiles')
+    if tiles:
+        result = []
+        for t in tiles.split(","):
             try:
-                boundaries_feature = json.loads(boundaries_feature)
-            except json.JSONDecodeError:
-                raise exceptions.ValidationError(_("Invalid boundaries parameter"))
-
-        if formula == '': formula = None
-        if bands == '': bands = None
-        if rescale == '': rescale = None
-        if color_map == '': color_map = None
-        if hillshade == '' or hillshade == '0': hillshade = None
-        if tilesize == '' or tilesize is None: tilesize = 256
-        if bands == 'auto' and formula:
-            bands, _discard_ = get_auto_bands(task.orthophoto_bands, formula)
-
+                z, x, y = map(int, t.split("/"))
+            except ValueError:
+                raise exceptions.ValidationError(_("Invalid tiles parameter"))
+            result.append((z, x, y))
+    else:
+        z = query_params.get('z')
+        x = query_params.get('x')
+        y = query_params.get('y')
+        if not z or not x or not y:
+            raise exceptions.ValidationError(_("Either the tiles or the z, x and y parameters are required"))
         try:
-            tilesize = int(tilesize)
-            if tilesize != 256 and tilesize != 512:
-                raise ValueError("Invalid size")
-
-            if tilesize == 512:
-                z -= 1
+            z = int(z)
         except ValueError:
-            raise exceptions.ValidationError(_("Invalid tile size parameter"))
-
-        try:
-            expr, _discard_ = lookup_formula(formula, bands)
-        except ValueError as e:
-            raise exceptions.ValidationError(str(e))
-
-        if tile_type in ['dsm', 'dtm'] and rescale is None:
-            rescale = "0,1000"
-        if tile_type == 'orthophoto' and rescale is None:
-            rescale = "0,255"
-
-        if tile_type in ['dsm', 'dtm'] and color_map is None:
-            color_map = "gray"
+            raise exceptions.ValidationError(_("Invalid %(param)s parameter") % {'param': 'z'})
 
-        if tile_type == 'orthophoto' and formula is not None:
-            if color_map is None:
-                color_map = "gray"
-            if rescale is None:
-                rescale = "-1,1"
+        xmin, xmax = parse_tile_range(x, 'x')
+        ymin, ymax = parse_tile_range(y, 'y')
+        if (xmax - xmin + 1) * (ymax - ymin + 1) > settings.TILES_BATCH_MAX_TILES:
+            raise exceptions.ValidationError(_("Too many tiles requested"))
+        result = [(z, tx, ty) for ty in range(ymin, ymax + 1) for tx in range(xmin, xmax + 1)]
 
-        if nodata is not None:
-            nodata = np.nan if nodata == "nan" else float(nodata)
-        tilesize = scale * tilesize
-        url = get_raster_path(task, tile_type)
-        if not os.path.isfile(url):
-            raise exceptions.NotFound()
+    if len(result) == 0 or len(result) > settings.TILES_BATCH_MAX_TILES:
+        raise exceptions.ValidationError(_("Too many tiles requested"))
 
-        with COGReader(url) as src:
-            if not src.tile_exists(z, x, y):
-                raise exceptions.NotFound(_("Outside of bounds"))
+    # Remove duplicates, preserving order
+    return list(dict.fromkeys(result))
 
-            minzoom, maxzoom = get_zoom_safe(src)
-            has_alpha = has_alpha_band(src.dataset)
-            if z < minzoom - ZOOM_EXTRA_LEVELS or z > maxzoom + ZOOM_EXTRA_LEVELS:
-                raise exceptions.NotFound()
 
-            if boundaries_feature is not None:
-                try:
-                    cutline = create_cutline(src.dataset, boundaries_feature, CRS.from_string('EPSG:4326'))
-                except:
-                    raise exceptions.ValidationError(_("Invalid boundaries"))
-            elif crop and task.crop is not None:
-                cutline, bounds = geom_transform_wkt_bbox(task.crop, src.dataset)
-            else:
-                cutline = None
-            
-            if cutline is not None:
-                vrt_options = {'cutline': cutline}
-            else:
-                vrt_options = None
-
-            # Handle N-bands datasets for orthophotos (not plant health)
-            if tile_type == 'orthophoto' and expr is None:
-                ci = src.dataset.colorinterp
-                # More than 4 bands?
-                if len(ci) > 4:
-                    # Try to find RGBA band order
-                    if ColorInterp.red in ci and \
-                            ColorInterp.green in ci and \
-                            ColorInterp.blue in ci:
-                        indexes = (ci.index(ColorInterp.red) + 1,
-                                   ci.index(ColorInterp.green) + 1,
-                                   ci.index(ColorInterp.blue) + 1,)
-                    else:
-                        # Fallback to first three
-                        indexes = (1, 2, 3,)
-                elif has_alpha:
-                    indexes = non_alpha_indexes(src.dataset)
+class TilesBatch(TaskNestedView):
+    def get(self, request, pk=None, project_pk=None, tile_type=""):
+        """
+        Get multiple tile images in a single multipart/mixed response.
+        Tiles share the same rendering parameters as the Tiles endpoint;
+        tiles that fall outside of the raster are omitted from the response.
+        Each part has a Content-Location header set to z/x/y.
+        """
+        task = self.get_and_check_task(request, pk)
 
-            # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
-            if nodata is None and tile_type == 'orthophoto':
-                nodata = 0
+        tiles = parse_tile_list(self.request.query_params)
+        ext = self.request.query_params.get('ext')
+        if ext == '': ext = None
+        if ext is not None and ext not in ['png', 'jpg', 'webp']:
+            raise exceptions.ValidationError(_("Invalid ext parameter"))
 
-            resampling = "nearest"
-            padding = 0
-            tile_buffer = None
+        scale = self.request.query_params.get('scale', '1')
+        if not scale.isdigit() or int(scale) < 1:
+            raise exceptions.ValidationError(_("Invalid scale parameter"))
+        scale = int(scale)
 
-            if tile_type in ["dsm", "dtm"]:
-                resampling = "bilinear"
-                padding = 16
+        params = get_tile_params(task, tile_type, self.request.query_params)
+        zoom_offset = -1 if params['tilesize'] == 512 else 0
+        tilesize = scale * params['tilesize']
 
-            # Hillshading is not a local tile operation and
-            # requires neighbor tiles to be rendered seamlessly
-            if hillshade is not None:
-                tile_buffer = 16
+        accepts_webp = 'image/webp' in request.headers.get('Accept', '')
 
+        def fetch(t):
+            z, x, y = t
             try:
-                if expr is not None:
-                    tile = src.tile(x, y, z, expression=expr, tilesize=tilesize, nodata=nodata,
-                                    padding=padding,
-                                    tile_buffer=tile_buffer,
-                                    resampling_method=resampling, vrt_options=vrt_options)
-                else:
-                    tile = src.tile(x, y, z, indexes=indexes, tilesize=tilesize, nodata=nodata,
-                                    padding=padding,
-                                    tile_buffer=tile_buffer,
-                                    resampling_method=resampling, vrt_options=vrt_options)
-            except TileOutsideBounds:
-                raise exceptions.NotFound(_("Outside of bounds"))
-            
-            if color_map:
-                try:
-                    colormap.get(color_map)
-                except InvalidColorMapName:
-                    raise exceptions.ValidationError(_("Not a valid color_map value"))
-            
-            intensity = None
-            try:
-                rescale_arr = list(map(float, rescale.split(",")))
-            except ValueError:
-                raise exceptions.ValidationError(_("Invalid rescale value"))
-
-            # Auto?
-            if ext is None:
-                # Check for transparency
-                if np.equal(tile.mask, 255).all():
-                    ext = "jpg"
-                else:
-                    if 'image/webp' in request.headers.get('Accept', ''):
-                        ext = "webp"
-                    else:
-                        ext = "png"
-
-            driver = "jpeg" if ext == "jpg" else ext
-
-            options = img_profiles.get(driver, {})
-            if hillshade is not None:
-                try:
-                    hillshade = float(hillshade)
-                    if hillshade <= 0:
-                        hillshade = 1.0
-                except ValueError:
-                    raise exceptions.ValidationError(_("Invalid hillshade value"))
-                if tile.data.shape[0] != 1:
-                    raise exceptions.ValidationError(
-                        _("Cannot compute hillshade of non-elevation raster (multiple bands found)"))
-                delta_scale = (maxzoom + ZOOM_EXTRA_LEVELS + 1 - z) ** 2
-                dx = src.dataset.meta["transform"][0] * delta_scale
-                dy = src.dataset.meta["transform"][4] * delta_scale
-                ls = LightSource(azdeg=315, altdeg=45)
-                
-                # Remove elevation data from edge buffer tiles
-                # (to keep intensity uniform across tiles)
-                elevation = tile.data[0]
-                elevation[0:tile_buffer, 0:tile_buffer] = nodata
-                elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, 0:tile_buffer] = nodata
-                elevation[0:tile_buffer, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
-                elevation[tile_buffer+tilesize:tile_buffer*2+tilesize, tile_buffer+tilesize:tile_buffer*2+tilesize] = nodata
-
-                intensity = ls.hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade)
-                intensity = intensity[tile_buffer:tile_buffer+tilesize, tile_buffer:tile_buffer+tilesize]
-
-            if intensity is not None:
-                rgb = tile.post_process(in_range=(rescale_arr,))
-                rgb_data = rgb.data[:,tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer]
-                if colormap:
-                    rgb, _discard_ = apply_cmap(rgb_data, colormap.get(color_map))
-                if rgb.data.shape[0] != 3:
-                    raise exceptions.ValidationError(
-                        _("Cannot process tile: intensity image provided, but no RGB data was computed."))
-                intensity = intensity * 255.0
-                rgb = hsv_blend(rgb, intensity)
-                if rgb is not None:
-                    mask = tile.mask[tile_buffer:tilesize+tile_buffer, tile_buffer:tilesize+tile_buffer]
-                    return HttpResponse(
-                        render(rgb, mask, img_format=driver, **options),
-                        content_type="image/{}".format(ext)
-                    )
-
-            if color_map is not None:
-                return HttpResponse(
-                    tile.post_process(in_range=(rescale_arr,)).render(img_format=driver, colormap=colormap.get(color_map),
-                                                                    **options),
-                    content_type="image/{}".format(ext)
-                )
-
-            return HttpResponse(
-                tile.post_process(in_range=(rescale_arr,)).render(img_format=driver, **options),
-                content_type="image/{}".format(ext)
-            )
+                return get_tile(task, tile_type, z + zoom_offset, x, y, params, tilesize, ext, accepts_webp)
+            except exceptions.NotFound:
+                return None
+
+        # Each worker checks out its own raster handle from the pool;
+        # reading and encoding release the GIL, so threads render in parallel
+        max_workers = max(1, min(settings.TILES_BATCH_THREADS, len(tiles)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(fetch, tiles))
+
+        boundary = uuid.uuid4().hex
+        body = []
+        for (z, x, y), result in zip(tiles, results):
+            if result is None:
+                continue
+            content, tile_ext = result
+            body.append("--{}\r\nContent-Type: image/{}\r\nContent-Location: {}/{}/{}\r\n\r\n".format(
+                boundary, tile_ext, z, x, y).encode('utf-8'))
+            body.append(content)
+            body.append(b"\r\n")
+        body.append("--{}--\r\n".format(boundary).encode('utf-8'))
+
+        return HttpResponse(b"".join(body), content_type="multipart/mixed; boundary={}".format(boundary))
 
 
 class Export(TaskNestedView):
@@ -539,6 +736,7 @@ class Export(TaskNestedView):
         epsg = request.data.get('epsg')
         color_map = request.data.get('color_map')
         hillshade = request.data.get('hillshade')
+        hillshade_mode = request.data.get('hillshade_mode')
         resample = request.data.get('resample', 0)
 
         if formula == '': formula = None
@@ -547,11 +745,12 @@ class Export(TaskNestedView):
         if epsg == '': epsg = None
         if color_map == '': color_map = None
         if hillshade == '': hillshade = None
+        if hillshade_mode == '' or hillshade_mode == 'single': hillshade_mode = None
         if resample == '': resample = 0
 
         expr = None
 
-        if asset_type in ['orthophoto', 'dsm', 'dtm'] and not export_format in ['gtiff', 'gtiff-rgb', 'jpg', 'png', 'kmz']:
+        if asset_type in ['orthophoto', 'dsm', 'dtm'] and not export_format in ['gtiff', 'gtiff-rgb', 'jpg', 'png', 'kmz', 'mbtiles']:
             raise exceptions.ValidationError(_("Unsupported format: %(value)s") % {'value': export_format})
         if asset_type == 'georeferenced_model' and not export_format in ['laz', 'las', 'ply', 'csv']:
             raise exceptions.ValidationError(_("Unsupported format: %(value)s") % {'value': export_format})
@@ -593,7 +792,7 @@ class Export(TaskNestedView):
             except ValueError as e:
                 raise exceptions.ValidationError(str(e))
         
-        if export_format in ['gtiff-rgb', 'jpg', 'png']:
+        if export_format in ['gtiff-rgb', 'jpg', 'png', 'mbtiles']:
             if formula is not None and rescale is None:
                 rescale = "-1,1"
         
@@ -614,6 +813,9 @@ class Export(TaskNestedView):
                     raise Exception("Hillshade must be > 0")
             except:
                 raise exceptions.ValidationError(_("Invalid hillshade value: %(value)s") % {'value': hillshade})
+
+        if hillshade_mode is not None and hillshade_mode not in HILLSHADE_MODES:
+            raise exceptions.ValidationError(_("Invalid hillshade_mode value: %(value)s") % {'value': hillshade_mode})
         
         if asset_type == 'georeferenced_model':
             url = get_pointcloud_path(task)
@@ -645,6 +847,7 @@ class Export(TaskNestedView):
                                                         rescale=rescale, 
                                                         color_map=color_map,
                                                         hillshade=hillshade,
+                                                        hillshade_mode=hillshade_mode,
                                                         asset_type=asset_type,
                                                         name=task.name,
                                                         crop=task.crop.wkt if task.crop is not None else None).task_id
@@ -0,0 +1,444 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from app.deferred_assets import STORED_EXTENSIONS
+from app.zip_utils import deflate_file, append_raw_member
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+
+# Backups are zip files with a manifest listing the files of the task and their
+# content hashes, and a blobs/ directory with the contents of the files (each
+# distinct content is stored once). Incremental backups only include the blobs
+# that were not in a previous backup.
+MANIFEST_FILE = "backup_manifest.json"
+BLOBS_DIR = "blobs"
+MANIFEST_VERSION = 1
+
+# Blobs are named after the SHA-256 of their content
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Backup IDs are the SHA-1 of their manifest's file list
+MANIFEST_ID_PATTERN = re.compile(r"[0-9a-f]{40}")
+
+# Files smaller than this are hashed every time instead of being cached
+# (and are always included in backups, so restores never need a local copy)
+HASH_CACHE_MIN_SIZE = 64 * 1024
+
+HASH_CACHE_FILE = "hashes.json"
+STATE_FILE = "backup_state.json"
+
+# A backup build that hasn't started for this long (in seconds) can be scheduled again
+BUILD_QUEUE_TIMEOUT = 60 * 60
+
+# A backup build that hasn't reported progress for this long (in seconds) is considered dead
+BUILD_LOCK_TIMEOUT = 60
+
+
+def get_build_lock_id(task_id):
+    return 'task_backup_build_{}'.format(task_id)
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_hash_cache_path(task):
+    return os.path.join(get_backups_dir(task), HASH_CACHE_FILE)
+
+
+def read_hash_cache(path):
+    """
+    :return: dict of file name --> [size, mtime (ns), inode, hash]
+    """
+    cache = read_manifest(path)
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(data))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def get_task_files(task_dir):
+    """
+    :return: sorted list of (name relative to task_dir, path, os.stat_result) of the files of a task
+    """
+    files = []
+    for dp, dn, filenames in os.walk(task_dir):
+        for f in filenames:
+            p = os.path.join(dp, f)
+            files.append((os.path.relpath(p, task_dir).replace(os.sep, "/"), p, os.stat(p)))
+    return sorted(files, key=lambda f: f[0])
+
+
+def get_files_signature(files):
+    """
+    :param files: list of (name, path, os.stat_result)
+    :return: a hash that changes when any of the files is added, removed or modified
+    """
+    h = hashlib.sha1()
+    for name, _, st in files:
+        h.update("{}:{}:{}\n".format(name, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
+def hash_files(files, cache_path=None, threads=1):
+    """
+    Compute the SHA-256 of files. Hashes of large files are cached, so
+    files that haven't changed since they were last hashed are not read again.
+    :param files: list of (name, path, os.stat_result)
+    :param cache_path: file where the hashes are cached (rewritten with the hashes of files)
+    :param threads: number of files to hash at the same time
+    :return: list of hex digests (same order as files)
+    """
+    cache = read_hash_cache(cache_path) if cache_path is not None else {}
+    digests = []
+    for name, _, st in files:
+        cached = cache.get(name)
+        if cached is not None and cached[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+            digests.append(cached[3])
+        else:
+            digests.append(None)
+
+    missing = [i for i, d in enumerate(digests) if d is None]
+    if len(missing) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            futures = {executor.submit(hash_file, files[i][1]): i for i in missing}
+            for f in as_completed(futures):
+                digests[futures[f]] = f.result()
+
+    if cache_path is not None:
+        write_json(cache_path, {name: [st.st_size, st.st_mtime_ns, st.st_ino, digests[i]]
+                                for i, (name, _, st) in enumerate(files) if st.st_size >= HASH_CACHE_MIN_SIZE})
+
+    return digests
+
+
+def find_local_blobs(tasks):
+    """
+    :param tasks: tasks whose files can be used to restore backups
+    :return: dict of hash --> list of paths of files that had that content when they were last backed up
+    """
+    blobs = {}
+    for task in tasks:
+        task_dir = task.task_path("")
+        for name, cached in read_hash_cache(get_hash_cache_path(task)).items():
+            blobs.setdefault(cached[3], []).append(os.path.join(task_dir, name))
+    return blobs
+
+
+def get_manifest_id(files):
+    h = hashlib.sha1()
+    for f in files:
+        h.update("{}:{}\n".format(f['path'], f['hash']).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_backups_dir(task):
+    return os.path.join(task.get_task_assets_cache(), "backups")
+
+
+def get_manifests_dir(task):
+    return os.path.join(get_backups_dir(task), "manifests")
+
+
+def get_manifest_path(task, backup_id):
+    return os.path.join(get_manifests_dir(task), "{}.json".format(os.path.basename(backup_id)))
+
+
+def has_backup(task, backup_id):
+    """
+    :return: True if backup_id is the ID of a backup of this task (or of the task it was
+        duplicated from), which can be used as the base of an incremental backup
+    """
+    return isinstance(backup_id, str) and MANIFEST_ID_PATTERN.fullmatch(backup_id) is not None and \
+        os.path.isfile(get_manifest_path(task, backup_id))
+
+
+def copy_backup_manifests(src_task, dest_task):
+    """
+    Let a duplicated task use the backups of the original as a base for incremental backups
+    """
+    src_dir = get_manifests_dir(src_task)
+    if os.path.isdir(src_dir):
+        shutil.copytree(src_dir, get_manifests_dir(dest_task))
+
+
+def read_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def get_state_path(task):
+    return os.path.join(get_backups_dir(task), STATE_FILE)
+
+
+def get_ready_backup(task, since=None):
+    """
+    :param since: same as get_task_backup
+    :return: (path to the backup archive, ID of the backup) if the last backup
+        that was built is still up to date, or None
+    """
+    task.write_backup_file()
+
+    files = get_task_files(task.task_path(""))
+    if len(files) == 0:
+        raise FileNotFoundError("No files available for download")
+
+    state = read_manifest(get_state_path(task))
+    if state is None or state.get('since') != since or state.get('signature') != get_files_signature(files):
+        return None
+
+    archive_path = os.path.join(get_backups_dir(task), os.path.basename(state['archive']))
+    if os.path.isfile(archive_path):
+        return archive_path, state['id']
+    else:
+        return None
+
+
+def get_task_backup(task, since=None, threads=None):
+    """
+    Build a backup of a task (or reuse a previous one if the task hasn't changed).
+    This can take a while, web requests should use get_ready_backup instead.
+    :param since: ID of a previous backup of this task (or of the task it was duplicated from).
+        Files that were in that backup are listed in the manifest but not included.
+        Raises ValueError if it's not one (see has_backup).
+    :param threads: number of files to hash and compress at the same time
+    :return: (path to the backup archive, ID of the backup)
+    """
+    if threads is None:
+        threads = settings.BACKUP_THREADS
+    if threads is None or threads <= 0:
+        threads = max(1, settings.WORKERS_MAX_THREADS)
+
+    ready = get_ready_backup(task, since)
+    if ready is not None:
+        return ready
+
+    files = get_task_files(task.task_path(""))
+    signature = get_files_signature(files)
+
+    digests = hash_files(files, get_hash_cache_path(task), threads)
+    manifest_files = [{
+        'path': name,
+        'hash': digests[i],
+        'size': st.st_size
+    } for i, (name, _, st) in enumerate(files)]
+    backup_id = get_manifest_id(manifest_files)
+
+    backups_dir = get_backups_dir(task)
+    os.makedirs(backups_dir, exist_ok=True)
+
+    # Blobs that the user already has
+    base = None
+    shipped = set()
+    if since is not None:
+        base_manifest = read_manifest(get_manifest_path(task, since)) if has_backup(task, since) else None
+        if base_manifest is None:
+            raise ValueError("{} is not a backup of {}".format(since, task))
+        base = base_manifest['id']
+        shipped = set([f['hash'] for f in base_manifest['files']])
+
+    archive_path = os.path.join(backups_dir, "{}{}.zip".format(backup_id, "-" + base if base is not None else ""))
+
+    if not os.path.isfile(archive_path):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'id': backup_id,
+            'base': base,
+            'files': manifest_files
+        }
+
+        # One blob for each distinct content (small files are always included)
+        blobs = {}
+        for i, (name, p, st) in enumerate(files):
+            if (digests[i] not in shipped or st.st_size < HASH_CACHE_MIN_SIZE) and digests[i] not in blobs:
+                blobs[digests[i]] = p
+
+        write_backup_archive(archive_path, manifest, blobs, threads)
+        write_json(get_manifest_path(task, backup_id), manifest)
+
+        # Only the last backup archive is kept
+        for f in os.listdir(backups_dir):
+            if f.endswith(".zip") and os.path.join(backups_dir, f) != archive_path:
+                try:
+                    os.remove(os.path.join(backups_dir, f))
+                except OSError:
+                    pass
+
+        logger.info("Built backup {} for {} ({} files, {} blobs)".format(backup_id, task, len(files), len(blobs)))
+
+    write_json(get_state_path(task), {
+        'since': since,
+        'signature': signature,
+        'id': backup_id,
+        'archive': os.path.basename(archive_path)
+    })
+
+    return archive_path, backup_id
+
+
+def write_backup_archive(archive_path, manifest, blobs, threads):
+    """
+    :param manifest: backup manifest
+    :param blobs: dict of hash --> path of the files to include
+    :param threads: number of blobs to compress at the same time
+    """
+    backups_dir = os.path.dirname(archive_path)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=backups_dir)
+    os.close(fd)
+    tmp_dir = tempfile.mkdtemp(dir=backups_dir)
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    pending = set()
+
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', allowZip64=True) as zip_h:
+            zip_h.comment = b"Generated by WebODM"
+            zip_h.writestr(MANIFEST_FILE, json.dumps(manifest), compress_type=zipfile.ZIP_DEFLATED)
+
+            def write_deflated(f):
+                digest, path, deflated = f.result()
+                try:
+                    append_raw_member(zip_h, "{}/{}".format(BLOBS_DIR, digest), deflated,
+                                      date_time=time.localtime(os.path.getmtime(path))[:6])
+                finally:
+                    os.remove(deflated['path'])
+
+            def deflate(digest, path):
+                return digest, path, deflate_file(path, tmp_dir)
+
+            for digest, path in blobs.items():
+                if path.lower().endswith(STORED_EXTENSIONS):
+                    # Already compressed, copied as-is while the others are compressed
+                    zip_h.write(path, "{}/{}".format(BLOBS_DIR, digest), compress_type=zipfile.ZIP_STORED)
+                else:
+                    pending.add(executor.submit(deflate, digest, path))
+
+                # Limit the amount of compressed data waiting to be written
+                while len(pending) >= threads * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        write_deflated(f)
+
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    write_deflated(f)
+
+        os.replace(tmp_path, archive_path)
+        tmp_path = None
+    finally:
+        for f in pending:
+            f.cancel()
+        executor.shutdown(wait=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_backup(directory):
+    return os.path.isfile(os.path.join(directory, MANIFEST_FILE))
+
+
+def is_valid_manifest(manifest):
+    """
+    Manifests come from uploaded files, check them before they are used to touch the file system
+    """
+    if not isinstance(manifest, dict) or manifest.get('version', 0) > MANIFEST_VERSION or not isinstance(manifest.get('files'), list):
+        return False
+
+    for f in manifest['files']:
+        if not isinstance(f, dict) or not isinstance(f.get('path'), str) or not isinstance(f.get('size'), int):
+            return False
+        if not isinstance(f.get('hash'), str) or HASH_PATTERN.fullmatch(f['hash']) is None:
+            return False
+
+    return True
+
+
+def restore_backup(src_dir, dest_dir, local_tasks=()):
+    """
+    Recreate the files of a task from an extracted backup
+    :param src_dir: directory where the backup archive was extracted (blobs are moved out of it)
+    :param dest_dir: task directory to create
+    :param local_tasks: tasks whose files can be copied when restoring incremental backups
+        (only tasks that the user restoring the backup has access to)
+    """
+    manifest = read_manifest(os.path.join(src_dir, MANIFEST_FILE))
+    if not is_valid_manifest(manifest):
+        raise ValueError("Invalid backup manifest")
+
+    blobs_dir = os.path.realpath(os.path.join(src_dir, BLOBS_DIR))
+    local_blobs = None
+    restored = {}
+    for f in manifest['files']:
+        dest = os.path.normpath(os.path.join(dest_dir, f['path']))
+        if os.path.commonpath([dest_dir, dest]) != os.path.normpath(dest_dir):
+            raise ValueError("Invalid path in backup: {}".format(f['path']))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+        digest = f['hash']
+        if digest in restored:
+            # Same content as another file
+            shutil.copyfile(restored[digest], dest)
+        else:
+            blob = os.path.realpath(os.path.join(blobs_dir, digest))
+            if os.path.commonpath([blobs_dir, blob]) != blobs_dir:
+                raise ValueError("Invalid hash in backup: {}".format(digest))
+
+            if os.path.isfile(blob):
+                shutil.move(blob, dest)
+            else:
+                # Incremental backup, look for a local copy
+                if local_blobs is None:
+                    local_blobs = find_local_blobs(local_tasks)
+                if not copy_blob(local_blobs.get(digest, []), digest, dest):
+                    raise FileNotFoundError("{} is not in the backup (restore the full backup instead)".format(f['path']))
+
+            if os.path.getsize(dest) != f['size']:
+                raise ValueError("{} is corrupted".format(f['path']))
+            restored[digest] = dest
+
+
+def copy_blob(paths, digest, dest):
+    """
+    Copy the first of paths that still has a certain content
+    :return: True if a copy was made
+    """
+    for p in paths:
+        try:
+            shutil.copyfile(p, dest)
+        except OSError:
+            continue
+        if hash_file(dest) == digest:
+            return True
+
+    if os.path.exists(dest):
+        os.remove(dest)
+    return False
@@ -0,0 +1,213 @@
+import os
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import redis
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+# Uploads that don't receive chunks for this long (in seconds) are forgotten
+# (same as the cleanup of the temporary directory)
+UPLOAD_EXPIRE = 60 * 60 * 24
+
+
+def get_upload_path(uuid):
+    return os.path.join(settings.FILE_UPLOAD_TEMP_DIR, "{}.upload".format(uuid))
+
+
+def get_upload_key(uuid):
+    return 'chunked_upload_{}'.format(uuid)
+
+
+def get_chunks_key(uuid):
+    return 'chunked_upload_chunks_{}'.format(uuid)
+
+
+def preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not supported by the platform or file system
+        os.ftruncate(fd, size)
+
+
+def init_upload(uuid, total_chunk_count, total_size=None):
+    """
+    Create the file that chunks are written to, unless another chunk of the same
+    upload already did (chunks can arrive concurrently and in any order)
+    """
+    path = get_upload_path(uuid)
+    if redis_client.exists(get_upload_key(uuid)) and os.path.isfile(path):
+        return
+
+    with redis_client.lock('chunked_upload_lock_{}'.format(uuid), timeout=30, blocking_timeout=30):
+        if redis_client.exists(get_upload_key(uuid)):
+            if os.path.isfile(path):
+                return
+            else:
+                # The file has been removed, start over
+                logger.warning("Chunked upload {} has lost its file, restarting".format(uuid))
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if total_size is not None and total_size > 0:
+                preallocate(fd, total_size)
+        finally:
+            os.close(fd)
+
+        pipe = redis_client.pipeline()
+        pipe.delete(get_chunks_key(uuid))
+        pipe.hmset(get_upload_key(uuid), {
+            'total_chunk_count': total_chunk_count,
+            'total_size': total_size if total_size is not None else -1,
+            'created_at': time.time()
+        })
+        pipe.expire(get_upload_key(uuid), UPLOAD_EXPIRE)
+        pipe.execute()
+
+
+def write_chunk_data(fd, file, offset, checksum=None):
+    """
+    Write an uploaded chunk at a byte offset
+    :param checksum: expected SHA-256 of the chunk (hex), raises ValueError if it doesn't match
+    :return: number of bytes written
+    """
+    if checksum is not None:
+        # Verify before writing, so that a bad chunk never overwrites good data
+        h = hashlib.sha256()
+        for data in file.chunks():
+            h.update(data)
+        if h.hexdigest() != checksum.lower():
+            raise ValueError("Chunk checksum mismatch")
+
+    written = 0
+
+    if not isinstance(file, InMemoryUploadedFile) and hasattr(os, 'copy_file_range'):
+        # Let the kernel copy the data from the temporary upload file
+        src = os.open(file.temporary_file_path(), os.O_RDONLY)
+        try:
+            size = os.fstat(src).st_size
+            while written < size:
+                n = os.copy_file_range(src, fd, size - written, written, offset + written)
+                if n == 0:
+                    break
+                written += n
+            return written
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            # Not supported between these file systems, fall back to pwrite
+            written = 0
+        finally:
+            os.close(src)
+
+    for data in file.chunks():
+        view = memoryview(data)
+        while len(view) > 0:
+            n = os.pwrite(fd, view, offset + written)
+            written += n
+            view = view[n:]
+
+    return written
+
+
+def write_chunk(uuid, file, chunk_index, byte_offset, total_chunk_count, total_size=None, checksum=None):
+    """
+    Store a chunk of an upload. Chunks can be written concurrently, out of order and
+    more than once (e.g. when a client resumes an upload after a disconnection).
+    :param uuid: ID of the upload
+    :param file: UploadedFile with the data of the chunk
+    :param total_size: size of the complete file, if known (the file is preallocated)
+    :param checksum: expected SHA-256 of the chunk (hex). Raises ValueError if it doesn't match.
+    :return: True if this was the last missing chunk, in which case the caller
+        should call finalize_upload
+    """
+    if chunk_index < 0 or chunk_index >= total_chunk_count or byte_offset < 0:
+        raise ValueError("Invalid chunk")
+    if total_size is not None and byte_offset + file.size > total_size:
+        raise ValueError("Chunk is out of bounds")
+
+    init_upload(uuid, total_chunk_count, total_size)
+
+    fd = os.open(get_upload_path(uuid), os.O_WRONLY)
+    try:
+        length = write_chunk_data(fd, file, byte_offset, checksum)
+    finally:
+        os.close(fd)
+
+    # Received ranges are tracked so that uploads can be resumed
+    pipe = redis_client.pipeline()
+    pipe.hset(get_chunks_key(uuid), chunk_index, "{}:{}".format(byte_offset, length))
+    pipe.hlen(get_chunks_key(uuid))
+    pipe.expire(get_chunks_key(uuid), UPLOAD_EXPIRE)
+    pipe.expire(get_upload_key(uuid), UPLOAD_EXPIRE)
+    _, received, _, _ = pipe.execute()
+
+    if received < total_chunk_count:
+        return False
+
+    # Only one of the requests finalizes the upload
+    return redis_client.hsetnx(get_upload_key(uuid), 'finalizing', 1) == 1
+
+
+def get_received_ranges(uuid):
+    """
+    :return: sorted list of (byte offset, length) of the chunks that have been received
+    """
+    ranges = []
+    for v in redis_client.hvals(get_chunks_key(uuid)):
+        offset, length = v.decode('utf-8').split(":")
+        ranges.append((int(offset), int(length)))
+    return sorted(ranges)
+
+
+def finalize_upload(uuid, destination):
+    """
+    Move a completed upload to its destination. If this fails for reasons other
+    than missing data, the upload is kept and can be finalized by sending any chunk again.
+    :return: size of the file
+    """
+    path = get_upload_path(uuid)
+
+    # Chunks must cover the file without gaps
+    size = 0
+    for offset, length in get_received_ranges(uuid):
+        if offset > size:
+            discard_upload(uuid)
+            raise ValueError("Upload is missing data at byte {}".format(size))
+        size = max(size, offset + length)
+
+    total_size = int(redis_client.hget(get_upload_key(uuid), 'total_size') or -1)
+    if total_size >= 0 and size != total_size:
+        discard_upload(uuid)
+        raise ValueError("Upload is incomplete ({} of {} bytes)".format(size, total_size))
+
+    try:
+        if os.path.getsize(path) != size:
+            os.truncate(path, size)
+
+        try:
+            os.replace(path, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(path, destination)
+    except Exception:
+        redis_client.hdel(get_upload_key(uuid), 'finalizing')
+        raise
+
+    redis_client.delete(get_upload_key(uuid), get_chunks_key(uuid))
+    return size
+
+
+def discard_upload(uuid):
+    redis_client.delete(get_upload_key(uuid), get_chunks_key(uuid))
+    try:
+        os.remove(get_upload_path(uuid))
+    except FileNotFoundError:
+        pass
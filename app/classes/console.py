@@ -1,13 +1,31 @@
 import os
 import logging
+from array import array
+try:
+    import fcntl
+except ImportError:
+    # Windows, writers are not serialized
+    fcntl = None
+from app.console_events import notify_console_update
 logger = logging.getLogger('app.logger')
 
+# Size in bytes of each entry in the line offsets index
+INDEX_ENTRY_SIZE = array('Q').itemsize
+
+READ_CHUNK_SIZE = 64 * 1024
+
 class Console:
-    def __init__(self, file):
+    def __init__(self, file, channel=None):
         self.file = file
         self.base_dir = os.path.dirname(self.file)
         self.parent_dir = os.path.dirname(self.base_dir)
 
+        # Sidecar index with the byte offsets of the start of each line (after the first)
+        self.index_file = self.file + ".idx"
+
+        # Pub/sub channel to notify of changes (optional)
+        self.channel = channel
+
     def __repr__(self):
         return "<Console output: %s>" % self.file
 
@@ -29,6 +47,63 @@ class Console:
     def output(self):
         return str(self)
 
+    def lines_count(self):
+        """
+        :return: number of lines in the console output (a trailing newline counts as an additional empty line)
+        """
+        try:
+            with open(self.file, 'rb') as f:
+                size, indexed, tail = self._read_index(f)
+                if size == 0:
+                    return 0
+                else:
+                    return indexed + len(tail) + 1
+        except IOError:
+            return 0
+
+    def read_lines(self, start=0, end=None, last=None):
+        """
+        Read a range of lines from the console output, ignoring trailing whitespace,
+        without reading the entire file
+        :param start: first line to read
+        :param end: line to stop at (exclusive), or None to read until the end
+        :param last: if set, read at most this many lines from the end
+        :return: (list of lines, total number of lines)
+        """
+        try:
+            with open(self.file, 'rb') as f:
+                size, indexed, tail = self._read_index(f)
+
+                # Find the end of the content and the newlines that follow it
+                content_end = size
+                trailing_newlines = 0
+                while content_end > 0:
+                    chunk_start = max(0, content_end - READ_CHUNK_SIZE)
+                    f.seek(chunk_start)
+                    chunk = f.read(content_end - chunk_start)
+                    stripped = chunk.rstrip()
+                    trailing_newlines += chunk.count(b"\n", len(stripped))
+                    content_end = chunk_start + len(stripped)
+                    if len(stripped) > 0:
+                        break
+
+                count = indexed + len(tail) - trailing_newlines + 1
+                start = min(start, count)
+                if last is not None:
+                    start = max(start, count - last)
+                end = count if end is None else min(end, count)
+                if start >= end:
+                    return [], count
+
+                begin = self._line_offset(start, indexed, tail)
+                stop = self._line_offset(end, indexed, tail) - 1 if end < count else content_end
+
+                f.seek(begin)
+                text = f.read(stop - begin).decode("utf-8", errors="replace")
+                return [l[:-1] if l.endswith("\r") else l for l in text.split("\n")], count
+        except IOError:
+            return [""], 1
+
     def append(self, text):
         if os.path.isdir(self.parent_dir):
             try:
@@ -36,8 +111,14 @@ class Console:
                 if not os.path.isdir(self.base_dir):
                     os.makedirs(self.base_dir, exist_ok=True)
                 
-                with open(self.file, "a", encoding="utf-8") as f:
-                    f.write(text)
+                with open(self.file, "ab+") as f:
+                    # Concurrent writers must not index the same lines twice
+                    self._lock(f)
+                    f.write(text.encode("utf-8"))
+                    f.flush()
+                    self._update_index(f)
+
+                self.notify()
             except IOError:
                 logger.warn("Cannot append to console file: %s" % self.file)
 
@@ -47,11 +128,15 @@ class Console:
                 if not os.path.isdir(self.base_dir):
                     os.makedirs(self.base_dir, exist_ok=True)
 
+                self.remove_index()
                 if os.path.isfile(self.file):
                     os.unlink(self.file)
                 
                 with open(self.file, "w", encoding="utf-8") as f:
                     f.write(text)
+                
+                self.update_index()
+                self.notify()
             except IOError:
                 logger.warn("Cannot reset console file: %s" % self.file)
 
@@ -71,9 +156,106 @@ class Console:
             if not os.path.isfile(src_file):
                 raise OSError("Source file does not exist")
             
+            self.remove_index()
             if os.path.isfile(self.file):
                 os.unlink(self.file)
             
             os.link(src_file, self.file)
+            self.update_index()
+            self.notify()
         except OSError:
-            logger.warn("Cannot link console file: %s --> %s" % (src_file, self.file))
\ No newline at end of file
+            logger.warn("Cannot link console file: %s --> %s" % (src_file, self.file))
+
+    def notify(self):
+        if self.channel is not None:
+            notify_console_update(self.channel)
+
+    def update_index(self):
+        """
+        Add the lines that have been appended to the console file to the line offsets index
+        """
+        try:
+            with open(self.file, 'rb') as f:
+                self._lock(f)
+                self._update_index(f)
+        except OSError:
+            logger.warn("Cannot update console index: %s" % self.index_file)
+
+    def _update_index(self, f):
+        """
+        :param f: console file opened in binary mode (and locked)
+        """
+        size, indexed, tail = self._read_index(f)
+
+        if indexed == 0 and os.path.isfile(self.index_file):
+            # Stale index
+            os.unlink(self.index_file)
+
+        if len(tail) > 0:
+            with open(self.index_file, 'ab') as idx:
+                idx.write(array('Q', tail).tobytes())
+
+    def _lock(self, f):
+        """
+        Lock the console file until f is closed
+        """
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def remove_index(self):
+        if os.path.isfile(self.index_file):
+            os.unlink(self.index_file)
+
+    def _line_offset(self, line, indexed, tail):
+        """
+        :return: byte offset of the start of a line
+        """
+        if line == 0:
+            return 0
+        elif line - 1 < indexed:
+            with open(self.index_file, 'rb') as idx:
+                idx.seek((line - 1) * INDEX_ENTRY_SIZE)
+                return array('Q', idx.read(INDEX_ENTRY_SIZE))[0]
+        else:
+            return tail[line - 1 - indexed]
+
+    def _read_index(self, f):
+        """
+        Read the state of the line offsets index. Lines that have been
+        appended but are not in the index yet (or all lines, if there's no index)
+        are found by scanning the end of the console file.
+        :param f: console file opened in binary mode
+        :return: (console file size, number of line offsets in the index, list of line offsets not in the index)
+        """
+        size = os.fstat(f.fileno()).st_size
+        indexed = 0
+        last_offset = 0
+
+        try:
+            with open(self.index_file, 'rb') as idx:
+                indexed = os.fstat(idx.fileno()).st_size // INDEX_ENTRY_SIZE
+                if indexed > 0:
+                    idx.seek((indexed - 1) * INDEX_ENTRY_SIZE)
+                    last_offset = array('Q', idx.read(INDEX_ENTRY_SIZE))[0]
+                    if last_offset > size:
+                        # The console file has been replaced, ignore the index
+                        indexed = 0
+                        last_offset = 0
+        except FileNotFoundError:
+            pass
+
+        tail = []
+        f.seek(last_offset)
+        pos = last_offset
+        while pos < size:
+            chunk = f.read(min(READ_CHUNK_SIZE, size - pos))
+            if not chunk:
+                break
+            i = chunk.find(b"\n")
+            while i != -1:
+                tail.append(pos + i + 1)
+                i = chunk.find(b"\n", i + 1)
+            pos += len(chunk)
+
+        return size, indexed, tail
+
@@ -0,0 +1,82 @@
+import time
+import uuid
+import logging
+import redis
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+# Sorted set of the requests that are waiting for console updates, scored by start time
+WAITERS_KEY = 'console_tail_waiters'
+
+
+def get_console_channel(task_id):
+    return 'task_console_{}'.format(task_id)
+
+
+def notify_console_update(channel):
+    """
+    Let clients that are waiting for new console output know that it has changed
+    """
+    try:
+        redis_client.publish(channel, 1)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot publish console update on {}: {}".format(channel, str(e)))
+
+
+def wait_for_console_update(channel, has_update, timeout):
+    """
+    Wait until the console output changes
+    :param channel: console channel
+    :param has_update: function returning True if the output has already changed.
+        It's called after subscribing to the channel, so that no notification is missed.
+    :param timeout: maximum number of seconds to wait
+    :return: True if the output changed, False otherwise
+    """
+    if timeout <= 0:
+        return has_update()
+
+    # Each waiting request holds a web worker, so we limit how many can wait at once.
+    # Requests over the limit return right away and clients keep polling.
+    waiter = uuid.uuid4().hex
+    now = time.time()
+    try:
+        pipe = redis_client.pipeline()
+        pipe.zremrangebyscore(WAITERS_KEY, '-inf', now - settings.CONSOLE_TAIL_TIMEOUT * 2)
+        pipe.zadd(WAITERS_KEY, {waiter: now})
+        pipe.zcard(WAITERS_KEY)
+        waiters = pipe.execute()[-1]
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot wait for console updates: {}".format(str(e)))
+        return has_update()
+
+    pubsub = None
+    try:
+        if waiters > settings.CONSOLE_TAIL_MAX_WAITERS:
+            return has_update()
+
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+
+        if has_update():
+            return True
+
+        deadline = now + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if pubsub.get_message(timeout=remaining) is not None:
+                return True
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot wait for console updates: {}".format(str(e)))
+        return has_update()
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+        try:
+            redis_client.zrem(WAITERS_KEY, waiter)
+        except redis.exceptions.RedisError:
+            pass
+
@@ -0,0 +1,186 @@
+import os
+import time
+import json
+import hashlib
+import logging
+import tempfile
+import zipfile
+import threading
+import redis
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+# Files that are already compressed are stored as-is in the archives
+# (deflating them again takes time and saves next to nothing)
+STORED_EXTENSIONS = ('.laz', '.jpg', '.jpeg', '.tif', '.tiff', '.png', '.webp',
+                     '.glb', '.zip', '.kmz', '.gz', '.mbtiles')
+
+# A build that hasn't reported progress for this long (in seconds) is considered dead
+BUILD_LOCK_TIMEOUT = 60
+
+
+def get_archives_dir(task):
+    return os.path.join(task.get_task_assets_cache(), "archives")
+
+
+def get_archive_path(task, asset):
+    return os.path.join(get_archives_dir(task), asset)
+
+
+def get_signature_path(archive_path):
+    return archive_path + ".json"
+
+
+def get_build_lock_id(task, asset):
+    return 'deferred_asset_build_{}_{}'.format(task.id, asset)
+
+
+def get_signature(paths):
+    """
+    :param paths: files to archive (list of {'n': name in the archive, 'fs': path})
+    :return: a hash that changes when any of the files is added, removed or modified
+    """
+    h = hashlib.sha1()
+    for p in sorted(paths, key=lambda p: p['n']):
+        try:
+            st = os.stat(p['fs'])
+            h.update("{}:{}:{}\n".format(p['n'], st.st_size, st.st_mtime_ns).encode('utf-8'))
+        except FileNotFoundError:
+            pass
+    return h.hexdigest()
+
+
+def get_archive(task, asset, paths, signature=None):
+    """
+    :param paths: files that should be in the archive
+    :param signature: signature of paths (computed when None)
+    :return: path to the prebuilt archive of a deferred asset, or None
+        if it hasn't been built or if it's out of date
+    """
+    archive_path = get_archive_path(task, asset)
+    if not os.path.isfile(archive_path):
+        return None
+
+    try:
+        with open(get_signature_path(archive_path), 'r') as f:
+            built = json.loads(f.read()).get('signature')
+    except (OSError, ValueError):
+        return None
+
+    if signature is None:
+        signature = get_signature(paths)
+
+    if built == signature:
+        return archive_path
+    else:
+        return None
+
+
+def is_building(task, asset):
+    last_update = redis_client.get(get_build_lock_id(task, asset))
+    return last_update is not None and time.time() - float(last_update) <= BUILD_LOCK_TIMEOUT
+
+
+def build_archive(task, asset, paths):
+    """
+    Write the zip archive of a deferred asset to the task assets cache.
+    Nothing is done if another process is already building the same archive.
+    :param paths: files to archive (list of {'n': name in the archive, 'fs': path})
+    :return: path to the archive, or None if it's being built elsewhere
+    """
+    lock_id = get_build_lock_id(task, asset)
+    lock_value = str(time.time()).encode('utf-8')
+
+    def acquire_lock(pipe):
+        last_update = pipe.get(lock_id)
+        if last_update is not None:
+            if time.time() - float(last_update) <= BUILD_LOCK_TIMEOUT:
+                # Somebody else is building it
+                return False
+            else:
+                logger.warning("Archive build lock {} has expired, rebuilding".format(lock_id))
+        pipe.multi()
+        pipe.set(lock_id, lock_value)
+        return True
+
+    if not redis_client.transaction(acquire_lock, lock_id, value_from_callable=True):
+        return None
+
+    # Keep the lock alive while building (members can take a long time to compress)
+    owned = [lock_value]
+    stopped = threading.Event()
+
+    def refresh_lock(pipe):
+        if pipe.get(lock_id) != owned[0]:
+            # Taken over by somebody else
+            return None
+        value = str(time.time()).encode('utf-8')
+        pipe.multi()
+        pipe.set(lock_id, value)
+        return value
+
+    def update_lock():
+        while not stopped.wait(BUILD_LOCK_TIMEOUT / 4):
+            try:
+                owned[0] = redis_client.transaction(refresh_lock, lock_id, value_from_callable=True)
+            except redis.exceptions.RedisError as e:
+                logger.warning("Cannot refresh archive build lock {}: {}".format(lock_id, str(e)))
+            if owned[0] is None:
+                break
+
+    def release_lock(pipe):
+        if owned[0] is not None and pipe.get(lock_id) == owned[0]:
+            pipe.multi()
+            pipe.delete(lock_id)
+
+    lock_monitor = threading.Thread(target=update_lock, daemon=True)
+    lock_monitor.start()
+
+    archive_path = get_archive_path(task, asset)
+    tmp_path = None
+
+    try:
+        signature = get_signature(paths)
+        if get_archive(task, asset, paths, signature) is not None:
+            return archive_path
+
+        archives_dir = get_archives_dir(task)
+        os.makedirs(archives_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=asset + ".", dir=archives_dir)
+        os.close(fd)
+
+        with zipfile.ZipFile(tmp_path, 'w', allowZip64=True) as zf:
+            zf.comment = b"Generated by WebODM"
+            for p in paths:
+                if p['fs'].lower().endswith(STORED_EXTENSIONS):
+                    compress_type = zipfile.ZIP_STORED
+                else:
+                    compress_type = zipfile.ZIP_DEFLATED
+                zf.write(p['fs'], p['n'], compress_type=compress_type)
+
+        # The signature is written after the archive, so a reader
+        # never mistakes a stale archive for an up to date one
+        os.replace(tmp_path, archive_path)
+        tmp_path = None
+        with open(get_signature_path(archive_path), 'w') as f:
+            f.write(json.dumps({'signature': signature}))
+
+        logger.info("Built {} for {} ({} bytes)".format(asset, task, os.path.getsize(archive_path)))
+        return archive_path
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError as e:
+                logger.warning("Cannot remove {}: {}".format(tmp_path, str(e)))
+
+        stopped.set()
+        lock_monitor.join()
+        try:
+            redis_client.transaction(release_lock, lock_id)
+        except redis.exceptions.RedisError:
+            # The lock will expire at some point
+            pass
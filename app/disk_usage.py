@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def scan_directory(path, exclude=()):
+    """
+    :param path: directory to scan (non recursively)
+    :param exclude: absolute paths of subdirectories to skip
+    :return: (bytes used by the files in path, list of subdirectories)
+    """
+    total = 0
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    # Symlinks are neither counted nor followed
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in exclude:
+                            subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    # Removed while scanning
+                    pass
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+
+    return total, subdirs
+
+
+def get_directory_size(path, exclude=(), threads=1):
+    """
+    Compute the size of all files in a directory tree. With multiple threads,
+    subdirectories are scanned in parallel (which is much faster for directories
+    with many files on network or spinning disks).
+    :param path: directory
+    :param exclude: absolute paths of subdirectories to skip
+    :param threads: number of directories to scan at the same time
+    :return: size in bytes
+    """
+    exclude = set(exclude)
+
+    if threads <= 1:
+        total = 0
+        dirs = [path]
+        while dirs:
+            size, subdirs = scan_directory(dirs.pop(), exclude)
+            total += size
+            dirs.extend(subdirs)
+        return total
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(scan_directory, path, exclude)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                size, subdirs = f.result()
+                total += size
+                for d in subdirs:
+                    pending.add(executor.submit(scan_directory, d, exclude))
+
+    return total
+
+
+def is_tree_modified(path, since, exclude=()):
+    """
+    Check whether entries have been added, removed or renamed anywhere in a
+    directory tree after a certain time, by looking at the modification time
+    of its directories. Files are not stat'ed, so files that are rewritten
+    in place are not detected.
+    :param path: directory
+    :param since: timestamp
+    :param exclude: absolute paths of subdirectories to skip
+    :return: True if a directory of the tree has been modified after since
+    """
+    exclude = set(exclude)
+    dirs = [path]
+
+    while dirs:
+        d = dirs.pop()
+        try:
+            if os.stat(d).st_mtime > since:
+                return True
+
+            with os.scandir(d) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False) and entry.path not in exclude:
+                            dirs.append(entry.path)
+                    except FileNotFoundError:
+                        # Removed while scanning
+                        pass
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+
+    return False
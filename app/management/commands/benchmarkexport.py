@@ -0,0 +1,70 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from django.core.management.base import BaseCommand
+from app.raster_utils import export_raster, extension_for_export_format
+from webodm import settings
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmark raster exports with different numbers of threads and check that outputs are identical"
+
+    def add_arguments(self, parser):
+        parser.add_argument("raster", type=str, help="Path to an orthophoto, DSM or DTM")
+        parser.add_argument("--asset-type", type=str, default="orthophoto", choices=["orthophoto", "dsm", "dtm"])
+        parser.add_argument("--format", type=str, default="gtiff-rgb", help="Export format (gtiff, gtiff-rgb, jpg, png)")
+        parser.add_argument("--expression", type=str, default=None, help="Band math expression (e.g. \"(b2-b1)/(b2+b1)\")")
+        parser.add_argument("--color-map", type=str, default=None, help="Color map (e.g. rdylgn)")
+        parser.add_argument("--hillshade", type=float, default=None, help="Hillshade vertical exaggeration (DEMs)")
+        parser.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1], help="Thread counts to compare")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        raster = options.get('raster')
+        export_format = options.get('format')
+        tmpdir = tempfile.mkdtemp(dir=settings.MEDIA_TMP)
+
+        print("Input: %s (%.1f MB)" % (raster, os.path.getsize(raster) / 1024 / 1024))
+        print("{:<10} {:>12} {:>10}  {}".format("threads", "seconds", "speedup", "sha256"))
+
+        try:
+            baseline = None
+            hashes = set()
+            for threads in options.get('threads'):
+                output = os.path.join(tmpdir, "export-%s.%s" % (threads, extension_for_export_format(export_format)))
+
+                start = time.time()
+                export_raster(raster, output,
+                              asset_type=options.get('asset_type'),
+                              format=export_format,
+                              expression=options.get('expression'),
+                              color_map=options.get('color_map'),
+                              hillshade=options.get('hillshade'),
+                              threads=threads)
+                elapsed = time.time() - start
+                if baseline is None:
+                    baseline = elapsed
+
+                h = file_hash(output)
+                hashes.add(h)
+                os.unlink(output)
+
+                print("{:<10} {:>12.2f} {:>9.2f}x  {}".format(threads, elapsed, baseline / elapsed, h[:16]))
+
+            if len(hashes) == 1:
+                print("Outputs are identical")
+            else:
+                print("Outputs differ!")
+                exit(1)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
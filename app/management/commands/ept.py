@@ -26,7 +26,7 @@ class Command(BaseCommand):
         count = 0
         for t in tasks:
             if t.check_ept(threads=options.get('threads')):
-                t.update_size(commit=True)
+                t.update_size(commit=True, components=[os.path.join('assets', 'entwine_pointcloud')])
                 print(str(t))
                 count += 1
         
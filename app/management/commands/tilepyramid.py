@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from app.models import Task
+from worker.tasks import generate_tile_pyramids
+
+class Command(BaseCommand):
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("task", nargs="*", help="ID of the task(s) to pre-render tiles for")
+        parser.add_argument("--public", action="store_true", required=False, default=False, help="Also include all public tasks")
+        parser.add_argument("--formula", required=False, default=None, help="Also pre-render the orthophoto with this plant health formula (e.g. NDVI)")
+        parser.add_argument("--bands", required=False, default=None, help="Band order to use with --formula (e.g. RGN or auto)")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        task_ids = set(options.get('task'))
+        if options.get('public'):
+            task_ids |= {str(t.id) for t in Task.objects.filter(public=True).only('id')}
+
+        if len(task_ids) == 0:
+            print("Specify one or more task IDs or --public")
+            exit(1)
+
+        for task_id in task_ids:
+            generate_tile_pyramids.delay(task_id, formula=options.get('formula'), bands=options.get('bands'))
+            print("Queued %s" % task_id)
@@ -0,0 +1,35 @@
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def update_used_space(apps, schema_editor):
+    Task = apps.get_model('app', 'Task')
+    Profile = apps.get_model('app', 'Profile')
+
+    totals = dict(Task.objects.values_list('project__owner').annotate(total=Sum('size')))
+    for p in Profile.objects.all():
+        p.used_space = totals.get(p.user_id) or 0
+        p.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0044_task_console_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='size_ledger',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, help_text='Size in bytes of each part of the task directory, and when they were computed', verbose_name='Size Ledger'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='used_space',
+            field=models.FloatField(blank=True, default=0, help_text='Disk space used by the tasks of this user in megabytes (kept up to date as task sizes change)', verbose_name='Used Space'),
+        ),
+
+        migrations.RunPython(update_used_space),
+    ]
@@ -1,27 +1,47 @@
 import time
+import logging
 from django.contrib.auth.models import User
 from django.db import models
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_init, post_delete
 from django.dispatch import receiver
-from app.models import Task
-from django.db.models import Sum
+from app.models import Task, Project
+from django.db.models import Sum, F
 from django.core.cache import cache
 from webodm import settings
 
+logger = logging.getLogger('app.logger')
+
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     quota = models.FloatField(default=-1, blank=True, help_text=_("Maximum disk quota in megabytes"), verbose_name=_("Quota"))
+    used_space = models.FloatField(default=0, blank=True, help_text=_("Disk space used by the tasks of this user in megabytes (kept up to date as task sizes change)"), verbose_name=_("Used Space"))
 
     def has_quota(self):
         return self.quota != -1
 
     def used_quota(self):
-        q = Task.objects.filter(project__owner=self.user).aggregate(total=Sum('size'))['total']
+        q = Profile.objects.filter(pk=self.pk).values_list('used_space', flat=True).first()
         if q is None:
             q = 0
-        return q
+        return max(0, q)
+
+    def reconcile_used_space(self):
+        """
+        Recompute the disk space used by this user from the size of its tasks
+        :return: difference (in megabytes) between the recomputed and the previous value
+        """
+        with transaction.atomic():
+            # Task size changes wait for the lock, so they are not lost
+            used_space = Profile.objects.select_for_update().filter(pk=self.pk).values_list('used_space', flat=True).first()
+            total = Task.objects.filter(project__owner=self.user).aggregate(total=Sum('size'))['total'] or 0
+            Profile.objects.filter(pk=self.pk).update(used_space=total)
+
+        self.used_space = total
+        self.clear_used_quota_cache()
+        return total - (used_space or 0)
 
     def has_exceeded_quota(self):
         if not self.has_quota():
@@ -64,6 +84,91 @@ class Profile(models.Model):
         cache.delete(f'quota_deadline_{self.user.id}')
 
     
+def update_used_space(user_id, delta):
+    if user_id is None or delta == 0:
+        return
+    Profile.objects.filter(user_id=user_id).update(used_space=F('used_space') + delta)
+    cache.delete(f'used_quota_{user_id}')
+
+
+def reconcile_used_spaces(tolerance=0.01):
+    """
+    Compare the disk space used by each user with the size of its tasks
+    and fix the users for which they differ
+    :return: number of users that were fixed
+    """
+    totals = dict(Task.objects.values_list('project__owner').annotate(total=Sum('size')))
+    count = 0
+    for p in Profile.objects.select_related('user'):
+        if abs(totals.get(p.user_id, 0) - p.used_space) > tolerance:
+            diff = p.reconcile_used_space()
+            if abs(diff) > tolerance:
+                logger.warning("Disk usage of {} was off by {:.2f} MB".format(p.user.username, diff))
+                count += 1
+    return count
+
+
+def get_project_owner_id(project_id):
+    return Project.objects.filter(pk=project_id).values_list('owner_id', flat=True).first()
+
+
+# Keep track of task sizes and projects as they are loaded,
+# so that changes can be applied to the disk usage of users
+# (owners are only looked up when a task is saved or deleted)
+@receiver(post_init, sender=Task)
+def track_task_size(sender, instance, **kwargs):
+    instance._original_size = instance.__dict__.get('size')
+    instance._original_project_id = instance.__dict__.get('project_id')
+
+
+@receiver(post_save, sender=Task)
+def update_task_used_space(sender, instance, created, **kwargs):
+    size = instance.__dict__.get('size')
+    if size is None:
+        return
+
+    previous_size = 0 if created else instance._original_size
+    original_project_id = instance._original_project_id if instance._original_project_id is not None else instance.project_id
+
+    if previous_size is None:
+        # Size was not loaded, we don't know what changed
+        pass
+    elif created or instance.project_id == original_project_id:
+        update_used_space(instance.project.owner_id, size - previous_size)
+    else:
+        # Moved to a different project (possibly with a different owner)
+        original_owner_id = get_project_owner_id(original_project_id)
+        owner_id = instance.project.owner_id
+        if owner_id != original_owner_id:
+            update_used_space(original_owner_id, -previous_size)
+            update_used_space(owner_id, size)
+        else:
+            update_used_space(owner_id, size - previous_size)
+
+    instance._original_size = size
+    instance._original_project_id = instance.project_id
+
+
+@receiver(post_delete, sender=Task)
+def remove_task_used_space(sender, instance, **kwargs):
+    if instance._original_size is not None and instance._original_project_id is not None:
+        update_used_space(get_project_owner_id(instance._original_project_id), -instance._original_size)
+
+
+@receiver(post_init, sender=Project)
+def track_project_owner(sender, instance, **kwargs):
+    instance._original_owner_id = instance.__dict__.get('owner_id')
+
+
+@receiver(post_save, sender=Project)
+def update_project_used_space(sender, instance, created, **kwargs):
+    if not created and instance._original_owner_id is not None and instance.owner_id != instance._original_owner_id:
+        total = Task.objects.filter(project=instance).aggregate(total=Sum('size'))['total'] or 0
+        update_used_space(instance._original_owner_id, -total)
+        update_used_space(instance.owner_id, total)
+    instance._original_owner_id = instance.owner_id
+
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
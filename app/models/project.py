@@ -136,7 +136,9 @@ class Project(models.Model):
         if self.public and self.public_id is None:
             self.public_id = uuid.uuid4()
 
-        super(Project, self).save(*args, **kwargs)
+        # Owner changes also update the disk usage of both users (see profile.py)
+        with transaction.atomic():
+            super(Project, self).save(*args, **kwargs)
 
     class Meta:
         verbose_name = _("Project")
@@ -38,12 +38,22 @@ from app import pending_actions
 from django.contrib.gis.db.models.fields import GeometryField
 
 from app.cogeo import assure_cogeo
+from app.zip_utils import extract_zip, get_corrupted_ranges
+from app.disk_usage import get_directory_size, is_tree_modified
+from app.deferred_assets import get_archive, build_archive, is_building, get_signature
+from app.backup import get_task_backup, get_ready_backup, has_backup, copy_backup_manifests, is_backup as is_backup_archive, restore_backup
+from app.chunk_store import write_chunk, finalize_upload
+from app.raster_utils import generate_hillshade
+from app.tile_cache import clear_tile_cache
+from app.tile_pyramid import clear_tile_pyramids
+from app.raster_metadata import precompute_raster_metadata
 from app.pointcloud_utils import is_pointcloud_georeferenced
 from app.testwatch import testWatch
 from app.security import path_traversal_check
 from app.geoutils import geom_transform
 from nodeodm import status_codes
 from nodeodm.models import ProcessingNode
+from nodeodm.download import invalidate_download, remove_download
 from pyodm.exceptions import NodeResponseError, NodeConnectionError, NodeServerError, OdmError
 from webodm import settings
 from app.classes.gcp import GCPFile
@@ -51,8 +61,11 @@ from .project import Project
 from django.utils.translation import gettext_lazy as _, gettext
 
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import subprocess
 from app.classes.console import Console
+from app.console_events import get_console_channel
+from app.processing_stats import record_stages, clear_stages, record_task_processing
 
 logger = logging.getLogger('app.logger')
 redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
@@ -145,7 +158,12 @@ def resize_image(image_path, resize_to, done=None):
         resized_width = int(width * ratio)
         resized_height = int(height * ratio)
 
-        im = im.resize((resized_width, resized_height), Image.LANCZOS)
+        if is_jpeg:
+            # Let the JPEG decoder downscale (by 1/2, 1/4 or 1/8) while decoding,
+            # to a size that is still larger than the target size
+            im.draft(im.mode, (resized_width, resized_height))
+
+        im = im.resize((resized_width, resized_height), Image.LANCZOS, reducing_gap=3.0)
         params = {}
         if is_jpeg:
             params['quality'] = 100
@@ -245,6 +263,10 @@ class Task(models.Model):
 
     TASK_PROGRESS_LAST_VALUE = 0.85
 
+    # Parts of the task directory whose size is tracked separately, so that
+    # a change to one of them doesn't require scanning the others (see update_size)
+    SIZE_COMPONENTS = [os.path.join('assets', 'entwine_pointcloud'), 'assets', '']
+
     id = models.UUIDField(primary_key=True, default=uuid_module.uuid4, unique=True, serialize=False, editable=False, verbose_name=_("Id"))
 
     uuid = models.CharField(max_length=255, db_index=True, default='', blank=True, help_text=_("Identifier of the task (as returned by NodeODM API)"), verbose_name=_("UUID"))
@@ -291,6 +313,7 @@ class Task(models.Model):
     tags = models.TextField(db_index=True, default="", blank=True, help_text=_("Task tags"), verbose_name=_("Tags"))
     orthophoto_bands = fields.JSONField(default=list, blank=True, help_text=_("List of orthophoto bands"), verbose_name=_("Orthophoto Bands"))
     size = models.FloatField(default=0.0, blank=True, help_text=_("Size of the task on disk in megabytes"), verbose_name=_("Size"))
+    size_ledger = fields.JSONField(default=dict, blank=True, help_text=_("Size in bytes of each part of the task directory, and when they were computed"), verbose_name=_("Size Ledger"))
     compacted = models.BooleanField(default=False, help_text=_("A flag indicating whether this task was compacted"), verbose_name=_("Compact"))
     crop = GeometryField(null=True, blank=True, srid=4326, help_text=_("Polygon defining the crop area of this task"), verbose_name=_("Crop Polygon"))
 
@@ -303,9 +326,9 @@ class Task(models.Model):
         super(Task, self).__init__(*args, **kwargs)
 
         # To help keep track of changes to the project id
-        self.__original_project_id = self.project.id
+        self.__original_project_id = self.project_id
         
-        self.console = Console(self.data_path("console_output.txt"))
+        self.console = Console(self.data_path("console_output.txt"), channel=get_console_channel(self.id))
 
     def __str__(self):
         name = self.name if self.name is not None else gettext("unnamed")
@@ -337,9 +360,9 @@ class Task(models.Model):
             logger.warning("Could not move assets folder for task {}. We're going to proceed anyway, but you might experience issues: {}".format(self, e))
 
     def save(self, *args, **kwargs):
-        if self.project.id != self.__original_project_id:
-            self.move_assets(self.__original_project_id, self.project.id)
-            self.__original_project_id = self.project.id
+        if self.project_id != self.__original_project_id:
+            self.move_assets(self.__original_project_id, self.project_id)
+            self.__original_project_id = self.project_id
 
         # Manually validate the fields we want,
         # since Django's clean_fields() method obliterates 
@@ -377,7 +400,9 @@ class Task(models.Model):
         self.clean()
         self.validate_unique()
 
-        super(Task, self).save(*args, **kwargs)
+        # Size changes also update the disk usage of the owner (see profile.py)
+        with transaction.atomic():
+            super(Task, self).save(*args, **kwargs)
     
     def get_extent(self):
         if self.orthophoto_extent is not None:
@@ -406,7 +431,7 @@ class Task(models.Model):
         Get path relative to the root task directory
         """
         return os.path.join(settings.MEDIA_ROOT,
-                            assets_directory_path(self.id, self.project.id, ""),
+                            assets_directory_path(self.id, self.project_id, ""),
                             *args)
 
     def is_asset_available_slow(self, asset):
@@ -490,6 +515,11 @@ class Task(models.Model):
                 else:
                     logger.warning("Task {} doesn't have folder, will skip copying".format(self))
 
+                try:
+                    copy_backup_manifests(self, task)
+                except OSError as e:
+                    logger.warning("Cannot copy backup manifests of {}: {}".format(self, str(e)))
+
                 self.project.owner.profile.clear_used_quota_cache()
 
                 from app.plugins import signals as plugin_signals
@@ -503,18 +533,27 @@ class Task(models.Model):
 
     def write_backup_file(self):
         """Dump this tasks's fields to a backup file"""
-        with open(self.data_path("backup.json"), "w") as f:
-            f.write(json.dumps({
-                'name': self.name,
-                'processing_time': self.processing_time,
-                'options': self.options,
-                'created_at': self.created_at.astimezone(timezone.utc).timestamp(),
-                'public': self.public,
-                'resize_to': self.resize_to,
-                'potree_scene': self.potree_scene,
-                'tags': self.tags,
-                'crop': json.loads(self.crop.geojson) if self.crop is not None else None,
-            }))
+        backup = json.dumps({
+            'name': self.name,
+            'processing_time': self.processing_time,
+            'options': self.options,
+            'created_at': self.created_at.astimezone(timezone.utc).timestamp(),
+            'public': self.public,
+            'resize_to': self.resize_to,
+            'potree_scene': self.potree_scene,
+            'tags': self.tags,
+            'crop': json.loads(self.crop.geojson) if self.crop is not None else None,
+        })
+
+        # Only write when something changed, so that backups can tell the task hasn't changed
+        backup_file = self.data_path("backup.json")
+        if os.path.isfile(backup_file):
+            with open(backup_file, "r") as f:
+                if f.read() == backup:
+                    return
+
+        with open(backup_file, "w") as f:
+            f.write(backup)
     
     def read_backup_file(self):
         """Set this tasks fields based on the backup file (but don't save)"""
@@ -540,17 +579,47 @@ class Task(models.Model):
             except Exception as e:
                 logger.warning("Cannot read backup file: %s" % str(e))
 
-    def get_task_backup_stream(self):
-        self.write_backup_file()
-        zip_dir = self.task_path("")
-        paths = [{'n': os.path.relpath(os.path.join(dp, f), zip_dir), 'fs': os.path.join(dp, f)} for dp, dn, filenames in os.walk(zip_dir) for f in filenames]
-        return self.zip_stream(paths)
+    def get_task_backup(self, since=None):
+        """
+        :param since: ID of a previous backup, files that haven't changed since are not included
+        :return: (path to the backup archive, ID of the backup)
+        """
+        return get_task_backup(self, since)
+
+    def has_backup(self, backup_id):
+        """
+        :return: True if backup_id can be used as the base of an incremental backup of this task
+        """
+        return has_backup(self, backup_id)
+
+    def get_ready_backup(self, since=None):
+        """
+        :return: (path to the backup archive, ID of the backup) if an up to date backup has been built, or None
+        """
+        return get_ready_backup(self, since)
     
+    def is_deferred_asset(self, asset):
+        value = self.ASSETS_MAP.get(asset)
+        return isinstance(value, dict) and 'deferred_path' in value and 'deferred_compress_dir' in value
+
+    def get_deferred_asset_paths(self, asset):
+        """
+        :param asset: one of ASSETS_MAP keys (a deferred asset)
+        :return: files of the asset archive (list of {'n': name in the archive, 'fs': path})
+        """
+        value = self.ASSETS_MAP[asset]
+        zip_dir = self.assets_path(value['deferred_compress_dir'])
+        paths = [{'n': os.path.relpath(os.path.join(dp, f), zip_dir), 'fs': os.path.join(dp, f)} for dp, dn, filenames in os.walk(zip_dir) for f in filenames]
+        if 'deferred_exclude_files' in value and isinstance(value['deferred_exclude_files'], tuple):
+            paths = [p for p in paths if os.path.basename(p['fs']) not in value['deferred_exclude_files']]
+        return paths
+
     def get_asset_file_or_stream(self, asset):
         """
         Get a stream to an asset
         :param asset: one of ASSETS_MAP keys
-        :return: (path|stream)
+        :return: (path|stream) deferred assets are returned as a path
+            to their prebuilt archive, or as a stream if the archive is not built yet
         """
         if asset in self.ASSETS_MAP:
             value = self.ASSETS_MAP[asset]
@@ -558,12 +627,18 @@ class Task(models.Model):
                 return self.assets_path(value)
 
             elif isinstance(value, dict):
-                if 'deferred_path' in value and 'deferred_compress_dir' in value:
-                    zip_dir = self.assets_path(value['deferred_compress_dir'])
-                    paths = [{'n': os.path.relpath(os.path.join(dp, f), zip_dir), 'fs': os.path.join(dp, f)} for dp, dn, filenames in os.walk(zip_dir) for f in filenames]
-                    if 'deferred_exclude_files' in value and isinstance(value['deferred_exclude_files'], tuple):
-                        paths = [p for p in paths if os.path.basename(p['fs']) not in value['deferred_exclude_files']]
-                    
+                if self.is_deferred_asset(asset):
+                    paths = self.get_deferred_asset_paths(asset)
+                    if len(paths) > 0 and asset in settings.DEFERRED_ASSETS_PREBUILD:
+                        signature = get_signature(paths)
+                        archive = get_archive(self, asset, paths, signature)
+                        if archive is None and not is_building(self, asset):
+                            # Missing or out of date, stream it this time
+                            self.schedule_deferred_assets_build([asset])
+                            archive = get_archive(self, asset, paths, signature)
+                        if archive is not None:
+                            return archive
+
                     return self.zip_stream(paths)
                 else:
                     raise FileNotFoundError("{} is not a valid asset (invalid dict values)".format(asset))
@@ -655,7 +730,7 @@ class Task(models.Model):
         self.refresh_from_db()
 
         try:
-            self.extract_assets_and_complete()
+            self.extract_assets_and_complete(progress_start=0.9)
         except (zipfile.BadZipFile, FileNotFoundError):
             raise NodeServerError(gettext("Invalid zip file"))
         except NotImplementedError:
@@ -687,23 +762,36 @@ class Task(models.Model):
                 self.handle_import()
 
             if self.pending_action == pending_actions.RESIZE:
-                resized_images = self.resize_images()
-                self.refresh_from_db()
-                self.resize_gcp(resized_images)
-                self.pending_action = None
-                self.save()
+                if settings.PIPELINE_RESIZE_UPLOADS and not self.uuid and self.status is None:
+                    self.auto_assign_processing_node()
+
+                if self.can_pipeline_resize_upload():
+                    # Resize images and upload them to the processing node as they are ready
+                    logger.info("Resizing and processing... {}".format(self))
+                    try:
+                        uuid = self.resize_and_upload_images()
+                    except NodeConnectionError as e:
+                        # If we can't create a task because the node is offline
+                        # We want to fail instead of trying again
+                        raise NodeServerError(gettext('Connection error: %(error)s') % {'error': str(e)})
+
+                    # Refresh task object before committing change
+                    self.refresh_from_db()
+                    self.resize_progress = 1.0
+                    self.upload_progress = 1.0
+                    self.uuid = uuid
+                    self.pending_action = None
+                    self.save()
+                else:
+                    resized_images = self.resize_images()
+                    self.refresh_from_db()
+                    self.resize_gcp(resized_images)
+                    self.pending_action = None
+                    self.save()
 
             if self.auto_processing_node and not self.status in [status_codes.FAILED, status_codes.CANCELED]:
                 # No processing node assigned and need to auto assign
-                if self.processing_node is None:
-                    # Assign first online node with lowest queue count
-                    self.processing_node = ProcessingNode.find_best_available_node(self.project.owner)
-                    if self.processing_node:
-                        self.processing_node.queue_count += 1 # Doesn't have to be accurate, it will get overridden later
-                        self.processing_node.save()
-
-                        logger.info("Automatically assigned processing node {} to {}".format(self.processing_node, self))
-                        self.save()
+                self.auto_assign_processing_node()
 
                 # Processing node assigned, but is offline and no errors
                 if self.processing_node and not self.processing_node.is_online():
@@ -826,6 +914,7 @@ class Task(models.Model):
                             self.upload_progress = 0
 
                         self.console.reset()
+                        clear_stages(self.id)
                         self.processing_time = -1
                         self.status = None
                         self.last_error = None
@@ -864,18 +953,14 @@ class Task(models.Model):
                 # Need to update status (first time, queued or running?)
                 if self.uuid and self.status in [None, status_codes.QUEUED, status_codes.RUNNING]:
                     # Update task info from processing node
-                    if not self.console.output():
-                        current_lines_count = 0
-                    else:
-                        current_lines_count = len(self.console.output().split("\n"))
-
-                    info = self.processing_node.get_task_info(self.uuid, current_lines_count)
+                    info = self.processing_node.get_task_info(self.uuid, self.console.lines_count())
 
                     self.processing_time = info.processing_time
                     self.status = info.status.value
 
                     if len(info.output) > 0:
                         self.console += "\n".join(info.output) + '\n'
+                        record_stages(self.id, info.output)
 
                     # Update running progress
                     self.running_progress = (info.progress / 100.0) * self.TASK_PROGRESS_LAST_VALUE
@@ -897,11 +982,13 @@ class Task(models.Model):
 
                             os.makedirs(assets_dir)
 
-                            # Download and try to extract results up to 4 times
+                            # Download and try to extract results up to 5 times
                             # (~5% of the times, on large downloads, the archive could be corrupted)
+                            # Downloads are resumable, so only the corrupted parts are downloaded again
                             retry_num = 0
                             extracted = False
                             last_update = 0
+                            download_path = self.task_path("all.zip.download")
 
                             def callback(progress):
                                 nonlocal last_update
@@ -918,23 +1005,37 @@ class Task(models.Model):
                                 logger.info("Downloading all.zip for {}".format(self))
 
                                 # Download all assets
-                                zip_path = self.processing_node.download_task_assets(self.uuid, assets_dir, progress_callback=callback, parallel_downloads=max(1, int(16 / (2 ** retry_num))))
+                                zip_path = self.processing_node.download_task_assets(self.uuid, download_path, progress_callback=callback, parallel_downloads=max(1, int(16 / (2 ** retry_num))))
+
+                                # Check the central directory and local headers before extracting
+                                corrupted_ranges = get_corrupted_ranges(zip_path)
 
-                                # Rename to all.zip
-                                all_zip_path = self.assets_path("all.zip")
-                                os.rename(zip_path, all_zip_path)
+                                if len(corrupted_ranges) == 0:
+                                    # Rename to all.zip
+                                    all_zip_path = self.assets_path("all.zip")
+                                    os.rename(zip_path, all_zip_path)
 
-                                logger.info("Extracting all.zip for {}".format(self))
+                                    logger.info("Extracting all.zip for {}".format(self))
 
-                                try:
-                                    self.extract_assets_and_complete()
-                                    extracted = True
-                                except zipfile.BadZipFile:
+                                    try:
+                                        self.extract_assets_and_complete()
+                                        extracted = True
+                                        remove_download(download_path)
+                                        record_task_processing(self)
+                                    except zipfile.BadZipFile:
+                                        # Find which members are corrupted
+                                        os.rename(all_zip_path, zip_path)
+                                        corrupted_ranges = get_corrupted_ranges(zip_path, check_crc=True)
+
+                                if not extracted:
                                     if retry_num < 5:
-                                        logger.warning("{} seems corrupted. Retrying...".format(all_zip_path))
+                                        logger.warning("{} seems corrupted ({} corrupted ranges). Retrying...".format(zip_path, len(corrupted_ranges)))
                                         retry_num += 1
-                                        os.remove(all_zip_path)
+
+                                        # If we cannot tell what's wrong, download everything again
+                                        invalidate_download(download_path, corrupted_ranges if len(corrupted_ranges) > 0 and retry_num < 3 else None)
                                     else:
+                                        remove_download(download_path)
                                         raise NodeServerError(gettext("Invalid zip file"))
                         else:
                             # FAILED, CANCELED
@@ -956,35 +1057,52 @@ class Task(models.Model):
             # Task was interrupted during image resize / upload
             logger.warning("{} interrupted: {}".format(self, str(e)))
 
-    def extract_assets_and_complete(self):
+    def extract_assets_and_complete(self, progress_start=TASK_PROGRESS_LAST_VALUE + 0.1):
         """
         Extracts assets/all.zip, populates task fields where required and assure COGs
         It will raise a zipfile.BadZipFile exception is the archive is corrupted.
+        :param progress_start: running progress at the start of the extraction.
+            Progress is reported between this value and 1.0
         :return:
         """
         assets_dir = self.assets_path("")
         zip_path = self.assets_path("all.zip")
+        threads = max(1, settings.WORKERS_MAX_THREADS)
+        last_update = 0
+
+        def update_progress(stage_start, stage_end, progress, force=False):
+            nonlocal last_update
+
+            if force or time.time() - last_update >= 2:
+                running_progress = progress_start + (1.0 - progress_start) * (stage_start + (stage_end - stage_start) * progress)
+                Task.objects.filter(pk=self.id).update(running_progress=running_progress)
+                self.running_progress = running_progress
+                last_update = time.time()
 
         # Extract from zip
-        with zipfile.ZipFile(zip_path, "r") as zip_h:
-            zip_h.extractall(assets_dir)
+        extract_zip(zip_path, assets_dir, threads=threads, progress_callback=partial(update_progress, 0, 0.5))
 
         logger.info("Extracted all.zip for {}".format(self))
         
         os.remove(zip_path)
 
         # Check if this looks like a backup file, in which case we need to move the files
-        # a directory level higher
-        is_backup = os.path.isfile(self.assets_path("data", "backup.json")) and os.path.isdir(self.assets_path("assets"))
+        # a directory level higher (or rebuild them from the backup blobs)
+        is_backup = is_backup_archive(assets_dir) or (os.path.isfile(self.assets_path("data", "backup.json")) and os.path.isdir(self.assets_path("assets")))
         if is_backup:
             logger.info("Restoring from backup")
             try:
                 tmp_dir = os.path.join(settings.FILE_UPLOAD_TEMP_DIR, f"{self.id}.backup")
-                
-                shutil.move(assets_dir, tmp_dir)
+
+                if is_backup_archive(assets_dir):
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    # Incremental backups can reuse files of the owner's other tasks
+                    restore_backup(assets_dir, tmp_dir, local_tasks=Task.objects.filter(project__owner_id=self.project.owner_id).exclude(pk=self.id))
+                else:
+                    shutil.move(assets_dir, tmp_dir)
                 shutil.rmtree(self.task_path(""))
                 shutil.move(tmp_dir, self.task_path(""))
-            except shutil.Error as e:
+            except (shutil.Error, OSError, ValueError) as e:
                 logger.warning("Cannot restore from backup: %s" % str(e))
                 raise NodeServerError("Cannot restore from backup")
         else:
@@ -1003,15 +1121,25 @@ class Task(models.Model):
         # Populate *_extent fields
         extent_fields = self.get_extent_fields()
 
+        # Make sure the rasters are Cloud Optimized GeoTIFFs
+        # if not, they will be created
+        def assure_raster_cogeo(raster_path):
+            try:
+                assure_cogeo(raster_path)
+            except IOError as e:
+                logger.warning("Cannot create Cloud Optimized GeoTIFF for %s (%s). This will result in degraded visualization performance." % (raster_path, str(e)))
+
+        rasters = [raster_path for raster_path, field in extent_fields if os.path.exists(raster_path)]
+        update_progress(0.5, 0.8, 0, force=True)
+        if len(rasters) > 0:
+            with ThreadPoolExecutor(max_workers=min(threads, len(rasters))) as executor:
+                futures = [executor.submit(assure_raster_cogeo, raster_path) for raster_path in rasters]
+                for i, f in enumerate(as_completed(futures)):
+                    f.result()
+                    update_progress(0.5, 0.8, (i + 1) / len(rasters), force=True)
+
         for raster_path, field in extent_fields:
             if os.path.exists(raster_path):
-                # Make sure this is a Cloud Optimized GeoTIFF
-                # if not, it will be created
-                try:
-                    assure_cogeo(raster_path)
-                except IOError as e:
-                    logger.warning("Cannot create Cloud Optimized GeoTIFF for %s (%s). This will result in degraded visualization performance." % (raster_path, str(e)))
-
                 # Read extent and SRID
                 raster = GDALRaster(raster_path)
                 extent = OGRGeometry.from_bbox(raster.extent)
@@ -1028,7 +1156,9 @@ class Task(models.Model):
 
                 logger.info("Populated extent field with {} for {}".format(raster_path, self))
         
-        self.check_ept()
+        self.check_ept(threads=settings.EPT_THREADS or threads)
+        update_progress(0.8, 1, 0.5, force=True)
+        self.check_hillshades()
 
         # Flushes the changes to the *_extent fields
         # and immediately reads them back into Python
@@ -1043,6 +1173,9 @@ class Task(models.Model):
         self.update_orthophoto_bands_field()
         self.update_size()
         self.clear_task_assets_cache()
+        clear_tile_cache(self.id)
+        clear_tile_pyramids(self)
+        precompute_raster_metadata(self)
         self.potree_scene = {}
         self.running_progress = 1.0
         self.crop = None
@@ -1061,6 +1194,8 @@ class Task(models.Model):
         
         self.save()
 
+        self.schedule_deferred_assets_build()
+
         from app.plugins import signals as plugin_signals
         plugin_signals.task_completed.send_robust(sender=self.__class__, task_id=self.id)
 
@@ -1185,21 +1320,60 @@ class Task(models.Model):
             'crop_projected': self.get_projected_crop() 
         }
 
+    def build_deferred_assets(self, assets=None):
+        """
+        Build the archives of deferred assets (e.g. textured_model.zip)
+        so that they can be downloaded without being compressed on every request
+        :param assets: deferred assets to build (defaults to the available
+            deferred assets listed in settings.DEFERRED_ASSETS_PREBUILD)
+        """
+        if assets is None:
+            assets = [a for a in self.available_assets if self.is_deferred_asset(a) and
+                      a in settings.DEFERRED_ASSETS_PREBUILD]
+
+        for asset in assets:
+            paths = self.get_deferred_asset_paths(asset)
+            if len(paths) == 0:
+                continue
+
+            try:
+                build_archive(self, asset, paths)
+            except Exception as e:
+                logger.warning("Cannot build {} for {}: {}".format(asset, self, str(e)))
+
+    def schedule_deferred_assets_build(self, assets=None):
+        if not settings.DEFERRED_ASSETS_PREBUILD:
+            return
+
+        # Lazy import, the worker depends on the models
+        from worker.tasks import build_deferred_assets
+        build_deferred_assets.delay(self.id, assets)
+
     def generate_deferred_asset(self, archive, directory, stream=False):
         """
-        :param archive: path of the destination .zip file (relative to /assets/ directory)
+        :param archive: name of the .zip file (e.g. textured_model.zip)
         :param directory: path of the source directory to compress (relative to /assets/ directory)
-        :param stream: return a stream instead of a path to the file
-        :return: full path of the generated archive
+        :param stream: unused
+        :return: full path of the generated archive (in the task assets cache)
         """
-        archive_path = self.assets_path(archive)
         directory_path = self.assets_path(directory)
 
         if not os.path.exists(directory_path):
             raise FileNotFoundError("{} does not exist".format(directory_path))
 
-        if not os.path.exists(archive_path):
-            shutil.make_archive(os.path.splitext(archive_path)[0], 'zip', directory_path)
+        asset = os.path.basename(archive)
+        if self.is_deferred_asset(asset):
+            paths = self.get_deferred_asset_paths(asset)
+        else:
+            paths = [{'n': os.path.relpath(os.path.join(dp, f), directory_path), 'fs': os.path.join(dp, f)} for dp, dn, filenames in os.walk(directory_path) for f in filenames]
+
+        archive_path = build_archive(self, asset, paths)
+        while archive_path is None:
+            # Being built by somebody else, wait for it
+            time.sleep(2)
+            archive_path = get_archive(self, asset, paths)
+            if archive_path is None and not is_building(self, asset):
+                archive_path = build_archive(self, asset, paths)
 
         return archive_path
 
@@ -1270,6 +1444,7 @@ class Task(models.Model):
         directory_to_delete = os.path.join(settings.MEDIA_ROOT,
                                            task_directory_path(self.id, self.project.id))
         self.clear_task_assets_cache()
+        clear_tile_cache(self.id)
 
         super(Task, self).delete(using, keep_parents)
 
@@ -1294,7 +1469,7 @@ class Task(models.Model):
                 logger.warning(e)
 
         self.compacted = True
-        self.update_size(commit=True)
+        self.update_size(commit=True, components=[''])
 
     def check_public_edit(self):
         """
@@ -1318,11 +1493,37 @@ class Task(models.Model):
         return [os.path.join(directory, f) for f in os.listdir(directory) if
                        re.match(regex, f, re.IGNORECASE)]
 
+    def auto_assign_processing_node(self):
+        """
+        Assign the online node that is expected to finish this task the earliest,
+        if this task needs to be automatically assigned a processing node
+        """
+        if self.auto_processing_node and self.processing_node is None and \
+                not self.status in [status_codes.FAILED, status_codes.CANCELED]:
+            with ProcessingNode.node_assignment_lock():
+                self.processing_node = ProcessingNode.find_best_available_node(self.project.owner, self.images_count, self.options)
+                if self.processing_node:
+                    # Saving while holding the lock reserves the node's capacity for this task
+                    self.save()
+
+            if self.processing_node:
+                logger.info("Automatically assigned processing node {} to {}".format(self.processing_node, self))
+
+    def can_pipeline_resize_upload(self):
+        """
+        :return: whether images can be uploaded to the processing node while they are being resized
+        """
+        return settings.PIPELINE_RESIZE_UPLOADS and \
+               self.processing_node is not None and \
+               not self.uuid and self.status is None and self.resize_to > 0 and \
+               self.processing_node.is_online() and \
+               self.processing_node.supports_chunked_uploads()
+
     def check_if_canceled(self):
         # Check if task has been canceled/removed
-        if Task.objects.only("pending_action").get(pk=self.id).pending_action in [pending_actions.CANCEL,
-                                                                                  pending_actions.REMOVE,
-                                                                                  pending_actions.COMPACT]:
+        if Task.objects.filter(pk=self.id).values_list('pending_action', flat=True).get() in [pending_actions.CANCEL,
+                                                                                             pending_actions.REMOVE,
+                                                                                             pending_actions.COMPACT]:
             raise TaskInterruptedException()
 
     def resize_images(self):
@@ -1356,13 +1557,124 @@ class Task(models.Model):
                 self.check_if_canceled()
                 last_update = time.time()
 
-        resized_images = [im for im in list(map(partial(resize_image, resize_to=self.resize_to, done=callback), images_path)) 
-                          if im is not None]
-        
+        # PIL releases the GIL while decoding, resampling and encoding,
+        # so images can be resized in parallel using threads.
+        # Progress updates and cancellation checks happen in this thread.
+        threads = max(1, min(settings.WORKERS_MAX_THREADS, total_images))
+        results = [None] * total_images
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {executor.submit(resize_image, image_path, self.resize_to): i for i, image_path in enumerate(images_path)}
+            try:
+                for f in as_completed(futures):
+                    i = futures[f]
+                    results[i] = f.result()
+                    callback(results[i])
+            finally:
+                # If the task was canceled, don't start resizing the remaining images
+                for f in futures:
+                    f.cancel()
+
+        resized_images = [im for im in results if im is not None]
+
         Task.objects.filter(pk=self.id).update(resize_progress=1.0)
 
         return resized_images
 
+    def resize_and_upload_images(self):
+        """
+        Destructively resize this task's JPG images (see resize_images) and upload
+        each image to the processing node as soon as it has been resized. Other files
+        (GCP, geo.txt, etc.) are uploaded last, after the GCP file has been resized.
+        The processing node needs to support chunked uploads (init/upload/commit).
+        :return UUID of the new task on the processing node
+        """
+        from app.plugins import signals as plugin_signals
+        plugin_signals.task_resizing_images.send_robust(sender=self.__class__, task_id=self.id)
+
+        images_path = self.task_path()
+        files = [os.path.join(images_path, f) for f in self.scan_images()]
+        if len(files) < 1: raise NodeServerError(gettext("Need at least 1 file"))
+
+        images = [f for f in files if re.match(r'.*\.(jpe?g|tiff?)$', f, re.IGNORECASE)]
+        other_files = [f for f in files if f not in images]
+        total_images = len(images)
+        total_files = len(files)
+
+        uuid = self.processing_node.init_task(self.name, self.options)
+
+        resize_threads = max(1, min(settings.WORKERS_MAX_THREADS, total_images))
+        upload_threads = max(1, min(settings.NODE_UPLOAD_THREADS, total_files))
+
+        # Limit the number of images that are being resized or are waiting
+        # to be uploaded, so that resizing doesn't run too far ahead of a slow upload
+        max_in_flight = max(resize_threads, upload_threads) * 2
+
+        resize_executor = ThreadPoolExecutor(max_workers=resize_threads)
+        upload_executor = ThreadPoolExecutor(max_workers=upload_threads)
+        resize_futures = {}
+        upload_futures = set()
+        results = [None] * total_images
+        next_image = 0
+        resized_count = 0
+        uploaded_count = 0
+        last_update = 0
+
+        def update_progress(force=False):
+            nonlocal last_update
+
+            if force or time.time() - last_update >= 2:
+                testWatch.manual_log_call("Task.process.callback")
+                self.check_if_canceled()
+                Task.objects.filter(pk=self.id).update(resize_progress=float(resized_count) / float(max(1, total_images)),
+                                                       upload_progress=float(uploaded_count) / float(total_files))
+                last_update = time.time()
+
+        try:
+            if total_images == 0:
+                for p in other_files:
+                    upload_futures.add(upload_executor.submit(self.processing_node.upload_task_file, uuid, p))
+
+            while uploaded_count < total_files:
+                # Start resizing more images, if we're not too far ahead of uploads
+                while next_image < total_images and (next_image - uploaded_count) < max_in_flight:
+                    f = resize_executor.submit(resize_image, images[next_image], self.resize_to)
+                    resize_futures[f] = next_image
+                    next_image += 1
+
+                done, _ = wait(list(resize_futures) + list(upload_futures), timeout=2, return_when=FIRST_COMPLETED)
+                for f in done:
+                    if f in resize_futures:
+                        i = resize_futures.pop(f)
+                        results[i] = f.result()
+                        resized_count += 1
+
+                        # Images that could not be resized are uploaded as-is
+                        upload_futures.add(upload_executor.submit(self.processing_node.upload_task_file, uuid, images[i]))
+
+                        if resized_count == total_images:
+                            # GCP entries can be scaled only after all images have been resized
+                            self.resize_gcp([r for r in results if r is not None])
+                            for p in other_files:
+                                upload_futures.add(upload_executor.submit(self.processing_node.upload_task_file, uuid, p))
+                    else:
+                        upload_futures.discard(f)
+                        f.result()
+                        uploaded_count += 1
+
+                update_progress()
+        finally:
+            # If the task was canceled or an upload failed, don't process the remaining images
+            # (the uncommitted task is eventually cleaned up by the processing node)
+            for f in list(resize_futures) + list(upload_futures):
+                f.cancel()
+            resize_executor.shutdown(wait=True)
+            upload_executor.shutdown(wait=True)
+
+        update_progress(force=True)
+
+        return self.processing_node.commit_task(uuid)
+
     def resize_gcp(self, resized_images):
         """
         Destructively change this task's GCP file (if any)
@@ -1453,26 +1765,16 @@ class Task(models.Model):
                 os.makedirs(tp, exist_ok=True)
 
             if chunk_info is not None:
-                if os.path.isfile(chunk_info['tmp_upload_file']) and chunk_info['chunk_index'] == 0:
-                    os.unlink(chunk_info['tmp_upload_file'])
-                
-                with open(chunk_info['tmp_upload_file'], 'ab') as fd:
-                    fd.seek(chunk_info['byte_offset'])
-                    if isinstance(file, InMemoryUploadedFile):
-                        for chunk in file.chunks():
-                            fd.write(chunk)
-                    else:
-                        with open(file.temporary_file_path(), 'rb') as f:
-                            shutil.copyfileobj(f, fd)
-                
-                if chunk_info['chunk_index'] + 1 < chunk_info['total_chunk_count']:
-                    continue # will wait for next chunk
+                complete = write_chunk(chunk_info['uuid'], file, chunk_info['chunk_index'], chunk_info['byte_offset'],
+                                       chunk_info['total_chunk_count'], total_size=chunk_info.get('total_size'),
+                                       checksum=chunk_info.get('checksum'))
+                if not complete:
+                    continue # will wait for the other chunks
 
             dst_path = self.get_image_path(name)
 
             if chunk_info is not None:
-                if chunk_info['tmp_upload_file'] is not None and os.path.isfile(chunk_info['tmp_upload_file']):
-                    shutil.move(chunk_info['tmp_upload_file'], dst_path)
+                finalize_upload(chunk_info['uuid'], dst_path)
             else:
                 with open(dst_path, 'wb+') as fd:
                     if isinstance(file, InMemoryUploadedFile):
@@ -1485,21 +1787,83 @@ class Task(models.Model):
             uploaded[name] = os.path.getsize(dst_path)
         return uploaded
 
-    def update_size(self, commit=False):
+    def get_size_component_path(self, component):
+        """
+        :return: (path of a size component, paths of the components inside it)
+        """
+        inner = [self.task_path(c) for c in self.SIZE_COMPONENTS if c != component and
+                 (component == '' or c.startswith(component + os.sep))]
+        return self.task_path(component), inner
+
+    def update_size(self, commit=False, components=None):
+        """
+        Update the size of this task on disk. Only the parts of the task directory
+        that have changed are scanned, the size of the others is read from the size ledger.
+        :param commit: save the task
+        :param components: list of SIZE_COMPONENTS that have changed,
+            or None to scan the entire task directory
+        """
         try:
-            total_bytes = 0
-            for dirpath, _, filenames in os.walk(self.task_path()):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    if not os.path.islink(fp):
-                        total_bytes += os.path.getsize(fp)
-            self.size = (total_bytes / 1024 / 1024)
+            ledger = dict(self.size_ledger)
+
+            for c in self.SIZE_COMPONENTS:
+                if components is None or c in components or c not in ledger:
+                    path, inner = self.get_size_component_path(c)
+                    scanned_at = time.time()
+                    ledger[c] = {
+                        'bytes': get_directory_size(path, exclude=inner, threads=settings.DISK_USAGE_SCAN_THREADS),
+                        'scanned_at': scanned_at
+                    }
+
+            self.size_ledger = ledger
+            self.size = (sum(ledger[c]['bytes'] for c in self.SIZE_COMPONENTS) / 1024 / 1024)
             if commit: self.save()
 
             self.project.owner.profile.clear_used_quota_cache()
         except Exception as e:
             logger.warn("Cannot update size for task {}: {}".format(self, str(e)))
 
+    def get_changed_size_components(self):
+        """
+        Find the parts of the task directory that might have changed
+        since their size was last computed (e.g. files that were added or
+        removed outside of WebODM), by looking at the modification time of
+        all of their directories. Files that were rewritten in place
+        without being renamed are not detected.
+        :return: list of SIZE_COMPONENTS
+        """
+        changed = []
+
+        for c in self.SIZE_COMPONENTS:
+            entry = self.size_ledger.get(c)
+            path, inner = self.get_size_component_path(c)
+            exists = os.path.isdir(path)
+
+            if entry is None:
+                if exists:
+                    changed.append(c)
+            elif not exists:
+                if entry['bytes'] > 0:
+                    changed.append(c)
+            elif is_tree_modified(path, entry['scanned_at'], exclude=inner):
+                changed.append(c)
+
+        return changed
+
+    def check_hillshades(self):
+        """
+        Precompute the hillshade intensity rasters of the DEMs (if enabled)
+        """
+        if not settings.HILLSHADE_PRECOMPUTE:
+            return
+
+        for asset in ['dsm.tif', 'dtm.tif']:
+            dem_path = self.get_asset_download_path(asset)
+            if os.path.isfile(dem_path):
+                try:
+                    generate_hillshade(dem_path)
+                except Exception as e:
+                    logger.warning("Cannot generate hillshade for {} of {}: {}".format(asset, self, str(e)))
 
     def get_task_assets_cache(self):
         if self.id is None:
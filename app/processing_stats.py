@@ -0,0 +1,156 @@
+import re
+import time
+import logging
+import redis
+from PIL import Image
+from nodeodm import status_codes
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+# Lines printed by the processing engine when a stage starts
+# (e.g. "[INFO]    Running opensfm stage")
+STAGE_REGEX = re.compile(r'Running (\w+) stage')
+
+# Stages of a task that is processing are kept this long (in seconds)
+STAGES_EXPIRE = 60 * 60 * 24 * 30
+
+
+def get_stages_key(task_id):
+    return 'task_stages_{}'.format(task_id)
+
+
+def record_stages(task_id, lines):
+    """
+    Remember when each processing stage of a task started,
+    by looking for stage markers in new console output
+    :param lines: new lines of console output
+    """
+    stages = {}
+    for line in lines:
+        m = STAGE_REGEX.search(line)
+        if m is not None and m.group(1) not in stages:
+            stages[m.group(1)] = time.time()
+
+    if len(stages) > 0:
+        pipe = redis_client.pipeline()
+        for stage, t in stages.items():
+            pipe.hsetnx(get_stages_key(task_id), stage, t)
+        pipe.expire(get_stages_key(task_id), STAGES_EXPIRE)
+        pipe.execute()
+
+
+def clear_stages(task_id):
+    redis_client.delete(get_stages_key(task_id))
+
+
+def get_stage_times(task_id, end_time=None):
+    """
+    :param end_time: time at which the last stage ended (defaults to now)
+    :return: dict of stage --> number of seconds spent in that stage
+    """
+    if end_time is None:
+        end_time = time.time()
+
+    starts = sorted([(float(t), stage.decode('utf-8')) for stage, t in redis_client.hgetall(get_stages_key(task_id)).items()])
+    stage_times = {}
+    for i, (start, stage) in enumerate(starts):
+        end = starts[i + 1][0] if i + 1 < len(starts) else end_time
+        stage_times[stage] = max(0, end - start)
+
+    return stage_times
+
+
+def get_images_megapixels(paths):
+    """
+    :return: total megapixels of the images (only their headers are read)
+    """
+    megapixels = 0
+    for p in paths:
+        try:
+            with Image.open(p) as im:
+                megapixels += im.size[0] * im.size[1] / 1000000.0
+        except (IOError, ValueError, Image.DecompressionBombError):
+            pass
+    return megapixels
+
+
+def record_task_processing(task):
+    """
+    Add a task that has just completed to the processing statistics of its node,
+    so that the processing time of future tasks can be predicted
+    """
+    try:
+        node = task.processing_node
+        if node is None or task.images_count <= 0 or task.processing_time <= 0:
+            return
+
+        # Partial runs don't tell us how long the full pipeline takes
+        if len([o for o in task.options if o.get('name') == 'rerun-from']) > 0:
+            return
+
+        images = [task.task_path(f) for f in task.scan_images() if re.match(r'.*\.(jpe?g|tiff?)$', f, re.IGNORECASE)]
+        megapixels = get_images_megapixels(images)
+        node.record_processing(task.images_count, task.processing_time / 1000.0, task.options,
+                               megapixels=megapixels, stage_times=get_stage_times(task.id))
+    except Exception as e:
+        logger.warning("Cannot record processing statistics for {}: {}".format(task, str(e)))
+    finally:
+        clear_stages(task.id)
+
+
+def get_remaining_time(task, predicted):
+    """
+    :param predicted: predicted processing time of the task (seconds)
+    :return: seconds until a task that is processing completes
+    """
+    elapsed = max(0, task.processing_time / 1000.0)
+    remaining = predicted - elapsed
+    if remaining > 0:
+        return remaining
+
+    # Taking longer than predicted, extrapolate from its progress
+    progress = task.running_progress / task.TASK_PROGRESS_LAST_VALUE
+    if progress > 0.05:
+        return max(0, elapsed / min(1, progress) - elapsed)
+    else:
+        return 0
+
+
+def get_task_eta(task):
+    """
+    Predict when a task that is waiting or processing will be completed
+    :return: dict with the predicted processing time of the task (seconds) and
+        the number of seconds until it completes (None when unknown)
+    """
+    result = {
+        'predicted_processing_time': None,
+        'eta': None
+    }
+
+    node = task.processing_node
+    if node is None or task.status not in [None, status_codes.QUEUED, status_codes.RUNNING]:
+        return result
+
+    stats = list(node.throughput_stats.all())
+    predicted = node.predict_processing_time(task.images_count, task.options, stats)
+    if predicted is None:
+        return result
+    result['predicted_processing_time'] = predicted
+
+    if task.status == status_codes.RUNNING:
+        result['eta'] = get_remaining_time(task, predicted)
+    else:
+        # Wait for the tasks that were submitted to the same node before this one
+        from app.models import Task
+        ahead = Task.objects.filter(processing_node=node, status__in=[status_codes.QUEUED, status_codes.RUNNING],
+                                    created_at__lt=task.created_at).exclude(pk=task.pk)
+        wait = 0
+        for t in ahead:
+            t_predicted = node.predict_processing_time(t.images_count, t.options, stats)
+            wait += get_remaining_time(t, t_predicted) if t.status == status_codes.RUNNING else t_predicted
+
+        result['eta'] = wait / (node.max_parallel_tasks or 1) + predicted
+
+    return result
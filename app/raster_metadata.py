@@ -0,0 +1,131 @@
+import os
+import json
+import logging
+import tempfile
+import numpy as np
+from rio_tiler.utils import has_alpha_band
+from rio_tiler.utils import _stats as raster_stats
+from rio_tiler.models import ImageStatistics
+from rio_tiler.models import Metadata as RioMetadata
+from rio_tiler.io import COGReader
+from app.tile_cache import get_tile_cache_key, get_geometry_hash
+from app.api.formulas import compile_expression
+
+logger = logging.getLogger('app.logger')
+
+PMIN, PMAX = 2.0, 98.0
+
+
+def compute_raster_metadata(src, tile_type, expr=None, hrange=None, vrt_options=None, bounds=None):
+    """
+    Compute statistics and histograms of a raster
+    :param src: COGReader
+    :param tile_type: one of orthophoto, dsm, dtm
+    :param expr: band math expression (or None)
+    :param hrange: histogram range (or None)
+    :param vrt_options: optional VRT options (e.g. cutline)
+    :param bounds: optional bounds to restrict the computation to
+    :return: JSON serializable dict with the rio-tiler metadata, the number
+        of (non-alpha) bands, the bounds and the CRS of the raster
+    """
+    band_count = src.dataset.meta['count']
+    if has_alpha_band(src.dataset):
+        band_count -= 1
+
+    nodata = None
+    # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
+    if tile_type == 'orthophoto':
+        nodata = 0
+
+    histogram_options = {"bins": 255, "range": hrange}
+    if expr is not None:
+        compiled = compile_expression(expr)
+        data, mask = src.preview(indexes=compiled.indexes, vrt_options=vrt_options)
+        data = np.ma.array(compiled.evaluate(data))
+        data.mask = mask == 0
+        stats = {
+            str(b + 1): raster_stats(data[b], percentiles=(PMIN, PMAX), bins=255, range=hrange)
+            for b in range(data.shape[0])
+        }
+        stats = {b: ImageStatistics(**s) for b, s in stats.items()}
+        metadata = RioMetadata(statistics=stats, **src.info().dict())
+    else:
+        metadata = src.metadata(pmin=PMIN, pmax=PMAX, hist_options=histogram_options, nodata=nodata,
+                                bounds=bounds, vrt_options=vrt_options)
+
+    crs = src.dataset.crs
+    return {
+        'info': json.loads(metadata.json()),
+        'band_count': band_count,
+        'bounds': list(bounds if bounds is not None else src.bounds),
+        'crs': crs.to_dict() if crs is not None else None,
+    }
+
+
+def get_raster_metadata_key(raster_path, tile_type, expr=None, hrange=None, crop=None, boundaries=None):
+    """
+    :param crop: GEOSGeometry crop area (or None)
+    :param boundaries: GeoJSON boundaries feature (or None)
+    :return: a key that uniquely identifies the metadata of a raster
+    """
+    return get_tile_cache_key(raster_mtime=os.path.getmtime(raster_path),
+                              tile_type=tile_type,
+                              expr=expr,
+                              hrange=list(hrange) if hrange is not None else None,
+                              crop=get_geometry_hash(crop),
+                              boundaries=get_geometry_hash(boundaries))
+
+
+def get_raster_metadata_cache_path(task, key):
+    cache_dir = task.get_task_assets_cache()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "metadata", "{}.json".format(key))
+
+
+def get_cached_raster_metadata(task, key):
+    p = get_raster_metadata_cache_path(task, key)
+    if p is None or not os.path.isfile(p):
+        return None
+
+    try:
+        with open(p, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+    except (IOError, ValueError) as e:
+        logger.warning("Cannot read cached raster metadata {}: {}".format(p, str(e)))
+        return None
+
+
+def put_cached_raster_metadata(task, key, md):
+    p = get_raster_metadata_cache_path(task, key)
+    if p is None:
+        return
+
+    d = os.path.dirname(p)
+    try:
+        os.makedirs(d, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=d)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json.dumps(md))
+        os.replace(tmp_path, p)
+    except OSError as e:
+        logger.warning("Cannot write cached raster metadata {}: {}".format(p, str(e)))
+
+
+def precompute_raster_metadata(task):
+    """
+    Compute and cache the metadata of the default (uncropped, no formula)
+    views of a task's rasters, so that the first map load is fast
+    """
+    for tile_type in ['orthophoto', 'dsm', 'dtm']:
+        raster_path = task.get_asset_download_path(tile_type + ".tif")
+        if not os.path.isfile(raster_path):
+            continue
+
+        try:
+            key = get_raster_metadata_key(raster_path, tile_type)
+            with COGReader(raster_path) as src:
+                md = compute_raster_metadata(src, tile_type)
+            put_cached_raster_metadata(task, key, md)
+        except Exception as e:
+            logger.warning("Cannot precompute metadata for {} of {}: {}".format(tile_type, task, str(e)))
@@ -0,0 +1,140 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from rasterio.errors import RasterioError
+from rio_tiler.io import COGReader
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+
+
+class RasterPool:
+    """
+    A bounded, thread-safe pool of open COGReader handles.
+
+    Opening a GeoTIFF requires parsing its header, IFDs and overviews,
+    which can dominate the time it takes to render a tile. The pool keeps
+    idle handles open so that subsequent requests in the same process
+    can reuse them. Handles are never shared between concurrent users:
+    a handle is checked out for the duration of a with block and returned
+    to the pool afterwards.
+
+    Handles are keyed by path, modification time, size and inode,
+    so that replaced or modified rasters are never served from stale handles.
+    """
+
+    def __init__(self, max_idle=16, idle_timeout=120, opener=COGReader):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.opener = opener
+        self.lock = threading.Lock()
+
+        # List of (key, last_used, reader), least recently used first
+        self.idle = []
+
+    def get_key(self, path):
+        st = os.stat(path)
+        return (os.path.realpath(path), st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @contextmanager
+    def open(self, path):
+        """
+        Checkout a COGReader for path, opening a new one if none is available
+        """
+        key = self.get_key(path)
+        reader = self.acquire(key)
+        if reader is None:
+            reader = self.opener(path)
+
+        reusable = True
+        try:
+            yield reader
+        except RasterioError:
+            # Don't trust handles that caused I/O errors
+            reusable = False
+            raise
+        finally:
+            if reusable:
+                self.release(key, reader)
+            else:
+                self.close_readers([reader])
+
+    def acquire(self, key):
+        expired = []
+        reader = None
+
+        with self.lock:
+            expired = self.pop_expired()
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i][0] == key:
+                    reader = self.idle.pop(i)[2]
+                    break
+
+        self.close_readers(expired)
+        return reader
+
+    def release(self, key, reader):
+        to_close = []
+
+        with self.lock:
+            to_close = self.pop_expired()
+
+            # Drop handles for older versions of the same file
+            path = key[0]
+            stale = [e for e in self.idle if e[0][0] == path and e[0] != key]
+            if stale:
+                self.idle = [e for e in self.idle if not (e[0][0] == path and e[0] != key)]
+                to_close += [e[2] for e in stale]
+
+            if self.max_idle > 0:
+                self.idle.append((key, time.time(), reader))
+            else:
+                to_close.append(reader)
+
+            while len(self.idle) > self.max_idle:
+                to_close.append(self.idle.pop(0)[2])
+
+        self.close_readers(to_close)
+
+    def pop_expired(self):
+        """
+        Remove idle handles that have not been used recently (must hold lock)
+        :return: list of readers to close
+        """
+        now = time.time()
+        expired = [e[2] for e in self.idle if now - e[1] > self.idle_timeout]
+        if expired:
+            self.idle = [e for e in self.idle if now - e[1] <= self.idle_timeout]
+        return expired
+
+    def close_readers(self, readers):
+        for r in readers:
+            try:
+                r.close()
+            except Exception as e:
+                logger.warning("Cannot close raster handle: {}".format(str(e)))
+
+    def invalidate(self, path=None):
+        """
+        Close idle handles for path (or all idle handles if path is None)
+        """
+        with self.lock:
+            if path is None:
+                to_close = [e[2] for e in self.idle]
+                self.idle = []
+            else:
+                path = os.path.realpath(path)
+                to_close = [e[2] for e in self.idle if e[0][0] == path]
+                self.idle = [e for e in self.idle if e[0][0] != path]
+
+        self.close_readers(to_close)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.idle)
+
+
+raster_pool = RasterPool(max_idle=settings.RASTER_POOL_SIZE,
+                         idle_timeout=settings.RASTER_POOL_IDLE_TIMEOUT)
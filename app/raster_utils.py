@@ -1,27 +1,36 @@
 import rasterio
-import re
 import logging
 import os
+import shutil
+import tempfile
 import subprocess
 import numpy as np
-import numexpr as ne
 import json
 import time
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from django.contrib.gis.geos import GEOSGeometry
 from rasterio.enums import ColorInterp
 from rasterio.windows import Window
 from rio_tiler.utils import has_alpha_band, linear_rescale
 from rio_tiler.colormap import cmap as colormap, apply_cmap
 from rio_tiler.errors import InvalidColorMapName
-from app.api.hsvblend import hsv_blend
-from app.api.hillshade import LightSource
+from app.api.hillshade import hillshade as compute_hillshade, hillshade_blend
+from app.api.formulas import compile_expression
 from rio_tiler.io import COGReader
+from app.tile_pyramid import write_tile_archive, PYRAMID_TILESIZE, CHUNK_SIZE
 from webodm import settings
 
 logger = logging.getLogger('app.logger')
 
 ZOOM_EXTRA_LEVELS = 3
 
+# Scale of the elevation gradients when shading full resolution DEMs
+# (exports and precomputed hillshades must match)
+HILLSHADE_DELTA_SCALE = ZOOM_EXTRA_LEVELS ** 2
+
 def extension_for_export_format(export_format):
     extensions = {
         'gtiff': 'tif',
@@ -85,9 +94,178 @@ def compute_block_aligned_subwindows(src, win):
     
     return subwins
 
+def get_block_aligned_window_size(src, window_size):
+    """
+    :return: the smallest multiple of the (square) block size of a tiled
+        raster that is at least window_size, so that windows are read whole blocks
+        at a time, or window_size if the raster isn't tiled
+    """
+    block_h, block_w = src.block_shapes[0]
+    if block_h != block_w or block_w >= src.width or block_w > 2048:
+        return window_size
+    return max(1, -(-window_size // block_w)) * block_w
+
+def process_windows(input, src, windows, read, compute, write, threads=1, max_in_flight=None):
+    """
+    Read, compute and write a list of raster windows.
+    With more than one thread, windows are read by a pool of reader threads
+    (each with its own dataset handle, since handles cannot be shared across threads)
+    and computed by a pool of compute threads, while the results are written
+    by the calling thread in the same order as a serial run, so that the output
+    is identical.
+    :param input: path to the raster (used to open per-thread dataset handles)
+    :param src: rasterio dataset of input (used when running serially)
+    :param windows: list of (window, destination window)
+    :param read: function(src, window) --> data
+    :param compute: function(window, destination window, data) --> result
+    :param write: function(index, result), always called from the calling thread
+    :param threads: number of compute threads
+    :param max_in_flight: maximum number of windows read or computed
+        but not yet written (defaults to twice the number of threads)
+    """
+    if threads is None or threads <= 1:
+        for idx, (w, dst_w) in enumerate(windows):
+            write(idx, compute(w, dst_w, read(src, w)))
+        return
+
+    if max_in_flight is None:
+        max_in_flight = threads * 2
+
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def read_window(w):
+        if not hasattr(local, 'src'):
+            local.src = rasterio.open(input)
+            with handles_lock:
+                handles.append(local.src)
+        return read(local.src, w)
+
+    try:
+        # The compute pool must outlive the reader pool, whose callbacks submit to it
+        with ThreadPoolExecutor(max_workers=threads) as compute_pool, \
+             ThreadPoolExecutor(max_workers=max(1, threads // 2)) as read_pool:
+
+            def submit(w, dst_w):
+                result = Future()
+
+                def computed(f):
+                    if f.exception() is not None:
+                        result.set_exception(f.exception())
+                    else:
+                        result.set_result(f.result())
+
+                def read_done(f):
+                    if f.exception() is not None:
+                        result.set_exception(f.exception())
+                    else:
+                        compute_pool.submit(compute, w, dst_w, f.result()).add_done_callback(computed)
+
+                read_pool.submit(read_window, w).add_done_callback(read_done)
+                return result
+
+            windows_iter = iter(windows)
+            pending = deque(submit(w, dst_w) for w, dst_w in itertools.islice(windows_iter, max_in_flight))
+            idx = 0
+            while pending:
+                res = pending.popleft().result()
+                for w, dst_w in itertools.islice(windows_iter, 1):
+                    pending.append(submit(w, dst_w))
+                write(idx, res)
+                idx += 1
+    finally:
+        for h in handles:
+            h.close()
+
 def padded_window(w, pad):
     return Window(w.col_off - pad, w.row_off - pad, w.width + pad * 2, w.height + pad * 2)
 
+def get_hillshade_path(dem_path):
+    """
+    :return: path of the precomputed hillshade intensity raster of a DEM
+    """
+    base, _ = os.path.splitext(dem_path)
+    return base + "_hillshade.tif"
+
+def get_precomputed_hillshade(dem_path, vert_exag, hillshade_mode=None):
+    """
+    :return: path of an up-to-date precomputed hillshade intensity raster
+        matching the rendering parameters, or None if there isn't one
+    """
+    if not settings.HILLSHADE_PRECOMPUTE or hillshade_mode is not None:
+        return None
+    if float(vert_exag) != float(settings.HILLSHADE_PRECOMPUTE_VERT_EXAG):
+        return None
+
+    hillshade_path = get_hillshade_path(dem_path)
+    try:
+        if os.path.getmtime(hillshade_path) < os.path.getmtime(dem_path):
+            return None
+    except OSError:
+        return None
+
+    return hillshade_path
+
+def generate_hillshade(dem_path, vert_exag=None, window_size=512):
+    """
+    Compute the hillshade intensity of a DEM at full resolution and write
+    it as an 8-bit Cloud Optimized GeoTIFF (with averaged overviews) next to the DEM,
+    so that the tiler can blend it instead of shading each tile
+    :param dem_path: path to DEM
+    :param vert_exag: vertical exaggeration (defaults to settings.HILLSHADE_PRECOMPUTE_VERT_EXAG)
+    :return: path to the hillshade raster
+    """
+    if vert_exag is None:
+        vert_exag = settings.HILLSHADE_PRECOMPUTE_VERT_EXAG
+
+    now = time.time()
+    output = get_hillshade_path(dem_path)
+    fd, tmpfile = tempfile.mkstemp('_hillshade.tif', dir=settings.MEDIA_TMP)
+    os.close(fd)
+    fd, cogfile = tempfile.mkstemp('_hillshade_cogeo.tif', dir=settings.MEDIA_TMP)
+    os.close(fd)
+    pad = 16
+
+    try:
+        with rasterio.open(dem_path) as src:
+            nodata = src.nodata if src.nodata is not None else -9999
+            profile = dict(driver='GTiff', width=src.width, height=src.height, count=1,
+                           dtype=rasterio.uint8, crs=src.crs, transform=src.transform,
+                           tiled=True, blockxsize=512, blockysize=512,
+                           compress='deflate', BIGTIFF='IF_SAFER')
+
+            dx = src.transform[0] * HILLSHADE_DELTA_SCALE
+            dy = src.transform[4] * HILLSHADE_DELTA_SCALE
+
+            with rasterio.open(tmpfile, 'w', **profile) as dst:
+                for w, dst_w in compute_subwindows(Window(0, 0, src.width, src.height), window_size):
+                    elevation = src.read(1, window=padded_window(w, pad), boundless=True,
+                                         fill_value=nodata, out_dtype=np.float32)
+                    intensity = compute_hillshade(elevation, dx=dx, dy=dy, vert_exag=vert_exag)
+                    intensity = intensity[pad:pad+int(w.height), pad:pad+int(w.width)]
+                    np.multiply(intensity, 255.0, out=intensity)
+                    dst.write(intensity.astype(np.uint8), 1, window=dst_w)
+
+                dst.update_tags(HILLSHADE_VERT_EXAG=vert_exag)
+
+        subprocess.check_output(["gdal_translate", "-of", "COG",
+                                 "-co", "BLOCKSIZE=256",
+                                 "-co", "COMPRESS=deflate",
+                                 "-co", "NUM_THREADS=ALL_CPUS",
+                                 "-co", "BIGTIFF=IF_SAFER",
+                                 "-co", "RESAMPLING=AVERAGE",
+                                 "--config", "GDAL_NUM_THREADS", "ALL_CPUS",
+                                 tmpfile, cogfile])
+        shutil.move(cogfile, output)
+    finally:
+        for f in [tmpfile, cogfile]:
+            if os.path.isfile(f):
+                os.unlink(f)
+
+    logger.info(f"Generated hillshade {output} in {round(time.time() - now, 2)}s")
+    return output
+
 def export_raster(input, output, progress_callback=None, **opts):
     now = time.time()
 
@@ -112,9 +290,11 @@ def export_raster(input, output, progress_callback=None, **opts):
     rescale = opts.get('rescale')
     color_map = opts.get('color_map')
     hillshade = opts.get('hillshade')
+    hillshade_mode = opts.get('hillshade_mode')
     asset_type = opts.get('asset_type')
     name = opts.get('name', 'raster') # KMZ specific
     crop_wkt = opts.get('crop')
+    threads = opts.get('threads', settings.WORKERS_MAX_THREADS)
 
     dem = asset_type in ['dsm', 'dtm']
     path_base, _ = os.path.splitext(output)
@@ -186,6 +366,9 @@ def export_raster(input, output, progress_callback=None, **opts):
             driver = "PNG"
             band_count = 4
             rgb = True
+        elif export_format == "mbtiles":
+            band_count = 4
+            rgb = True
         elif export_format == "gtiff-rgb":
             compress = "JPEG"
             bigtiff = True
@@ -211,6 +394,10 @@ def export_raster(input, output, progress_callback=None, **opts):
             profile.update(compress=compress)
             profile.update(predictor=2 if compress == "DEFLATE" else 1)
 
+            # Compress blocks on multiple threads (the output is the same)
+            if threads is not None and threads > 1:
+                profile.update(num_threads=threads)
+
         if rgb and rescale is None:
             # Compute min max
             nodata = None
@@ -219,13 +406,35 @@ def export_raster(input, output, progress_callback=None, **opts):
             md = ds_src.metadata(pmin=2.0, pmax=98.0, hist_options={"bins": 255}, nodata=nodata)
             rescale = [md['statistics']['1']['min'], md['statistics']['1']['max']]
 
+        if export_format == "mbtiles":
+            # Tiles are rendered in Web Mercator, the same way
+            # the tiler does (crop has already been applied)
+            params = {
+                'expr': expression,
+                'rescale': ",".join(map(str, rescale)),
+                'color_map': color_map,
+                'hillshade': hillshade if hillshade is not None and hillshade > 0 else None,
+                'hillshade_mode': hillshade_mode if hillshade is not None and hillshade > 0 else None,
+                'tilesize': PYRAMID_TILESIZE,
+                'crop': False,
+                'boundaries_feature': None,
+            }
+
+            def tiles_progress(done, total):
+                p(f"Rendering tile {done}/{total}", 100 * CHUNK_SIZE / total if total > 0 else 0)
+
+            write_tile_archive(input, output, asset_type, params, name=name, threads=threads,
+                               progress_callback=tiles_progress)
+            logger.info(f"Exported {output} in {round(time.time() - now, 2)}s")
+            return
+
         ci = src.colorinterp
         alpha_index = None
         if has_alpha_band(src):
             alpha_index = src.colorinterp.index(ColorInterp.alpha) + 1
         
+        window_size = get_block_aligned_window_size(src, window_size)
         subwins = compute_subwindows(win, window_size)
-        # subwins = compute_block_aligned_subwindows(src, win)
 
         if rgb and expression is None:
             # More than 4 bands?
@@ -297,6 +506,11 @@ def export_raster(input, output, progress_callback=None, **opts):
         num_wins = len(subwins)
         progress_per_win = (100 - post_perc) / num_wins if num_wins > 0 else 0
 
+        # Windows are read and computed by the functions below (possibly on
+        # multiple threads), each returning a list of (array, dst.write arguments)
+        # that are written in order
+        rgb_colorinterp = False
+
         if expression is not None:
             # Apply band math
             if rgb:
@@ -304,109 +518,115 @@ def export_raster(input, output, progress_callback=None, **opts):
             else:
                 profile.update(dtype=rasterio.float32, count=1, nodata=-9999)
 
-            bands_names = ["b{}".format(b) for b in tuple(sorted(set(re.findall(r"b(?P<bands>[0-9]{1,2})", expression))))]
-            rgb_expr = expression.split(",")
-            indexes = tuple([int(b.replace("b", "")) for b in bands_names])
+            compiled = compile_expression(expression)
+            indexes = compiled.indexes
 
             if alpha_index is not None:
                 indexes += (alpha_index, )
 
-            with rasterio.open(output_raster, 'w', **profile) as dst:
-                for idx, (w, dst_w) in enumerate(subwins):
-                    p(f"Processing tile {idx}/{num_wins}", progress_per_win)
-
-                    data = src.read(indexes=indexes, window=w, out_dtype=np.float32)
-                    arr = dict(zip(bands_names, data))
-                    arr = np.array([np.nan_to_num(ne.evaluate(bloc.strip(), local_dict=arr)) for bloc in rgb_expr])
+            rgb_colorinterp = rgb and cmap is not None
 
-                    # Set nodata values
-                    index_band = arr[0]
-                    mask = None
-                    if alpha_index is not None:
-                        # -1 is the last band = alpha
-                        mask = data[-1] != 0
-                        index_band[~mask] = -9999
+            def read_window(src, w):
+                return src.read(indexes=indexes, window=w, out_dtype=np.float32)
 
-                    # Remove infinity values
-                    index_band[index_band>1e+30] = -9999
-                    index_band[index_band<-1e+30] = -9999
+            def compute_window(w, dst_w, data):
+                arr = np.nan_to_num(compiled.evaluate(data), copy=False)
 
-                    # Make sure this is float32
-                    arr = arr.astype(np.float32)
+                # Set nodata values
+                index_band = arr[0]
+                mask = None
+                if alpha_index is not None:
+                    # -1 is the last band = alpha
+                    mask = data[-1] != 0
+                    index_band[~mask] = -9999
 
-                    # Apply colormap?
-                    if rgb and cmap is not None:
-                        rgb_data, _ = apply_cmap(process(arr, skip_background=True, includes_alpha=False), cmap)
-                        dst.write(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), window=dst_w, indexes=(1,2,3))
+                # Remove infinity values
+                index_band[index_band>1e+30] = -9999
+                index_band[index_band<-1e+30] = -9999
 
-                        if with_alpha:
-                            dst.write(mask.astype(np.uint8) * 255, 4, window=dst_w)
+                # Apply colormap?
+                if rgb and cmap is not None:
+                    rgb_data, _ = apply_cmap(process(arr, skip_background=True, includes_alpha=False), cmap)
+                    writes = [(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), dict(window=dst_w, indexes=(1,2,3)))]
 
-                        update_rgb_colorinterp(dst)
-                    else:
-                        # Raw
-                        dst.write(process(arr), window=dst_w) 
+                    if with_alpha:
+                        writes.append((mask.astype(np.uint8) * 255, dict(indexes=4, window=dst_w)))
+                    return writes
+                else:
+                    # Raw
+                    return [(process(arr), dict(window=dst_w))]
         elif dem:
             # Apply hillshading, colormaps to elevation
-            with rasterio.open(output_raster, 'w', **profile) as dst:
-                for idx, (w, dst_w) in enumerate(subwins):
-                    p(f"Processing tile {idx}/{num_wins}", progress_per_win)
-
-                    # Apply colormap?
-                    if rgb and cmap is not None:
-                        nodata = profile.get('nodata')
-                        if nodata is None:
-                            nodata = -9999
-
-                        pad = 16
-                        elevation = src.read(window=padded_window(w, pad), boundless=True, fill_value=nodata, out_shape=(
-                            1,
-                            window_size + pad * 2,
-                            window_size + pad * 2,
-                        ), resampling=rasterio.enums.Resampling.bilinear)[:1][0]
-
-                        elevation[0:pad, 0:pad] = nodata
-                        elevation[pad+window_size:pad*2+window_size, 0:pad] = nodata
-                        elevation[0:pad, pad+window_size:pad*2+window_size] = nodata
-                        elevation[pad+window_size:pad*2+window_size, pad+window_size:pad*2+window_size] = nodata
-
-                        mask = elevation != nodata
-
-                        intensity = None
-                        if hillshade is not None and hillshade > 0:
-                            delta_scale = ZOOM_EXTRA_LEVELS ** 2
-                            dx = src.meta["transform"][0] * delta_scale
-                            dy = src.meta["transform"][4] * delta_scale
-                            ls = LightSource(azdeg=315, altdeg=45)
-
-                            intensity = ls.hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade)
-                            intensity = intensity[pad:pad+window_size, pad:pad+window_size]
-                            intensity = intensity * 255.0
-
-                        rgb_data, _ = apply_cmap(process(elevation[pad:window_size+pad, pad:window_size+pad][np.newaxis,:], skip_background=True, includes_alpha=False), cmap)
-
-                        if intensity is not None:
-                            rgb_data = hsv_blend(rgb_data, intensity)
-                        
-                        mask = mask[pad:window_size+pad, pad:window_size+pad]
-                        dst.write(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), window=dst_w, indexes=(1,2,3))
-                        if with_alpha:
-                            dst.write(mask.astype(np.uint8) * 255, 4, window=dst_w)
-
-                        update_rgb_colorinterp(dst)
-                    else:
-                        # Raw
-                        arr = src.read(window=w)[:1]
-                        dst.write(process(arr), window=dst_w)
+            rgb_colorinterp = rgb and cmap is not None
+            nodata = profile.get('nodata')
+            if nodata is None:
+                nodata = -9999
+            pad = 16
+
+            dx = src.meta["transform"][0] * HILLSHADE_DELTA_SCALE
+            dy = src.meta["transform"][4] * HILLSHADE_DELTA_SCALE
+
+            def read_window(src, w):
+                # Apply colormap?
+                if rgb and cmap is not None:
+                    return src.read(window=padded_window(w, pad), boundless=True, fill_value=nodata, out_shape=(
+                        1,
+                        window_size + pad * 2,
+                        window_size + pad * 2,
+                    ), resampling=rasterio.enums.Resampling.bilinear)[:1][0]
+                else:
+                    return src.read(window=w)[:1]
+
+            def compute_window(w, dst_w, data):
+                if rgb and cmap is not None:
+                    elevation = data
+                    elevation[0:pad, 0:pad] = nodata
+                    elevation[pad+window_size:pad*2+window_size, 0:pad] = nodata
+                    elevation[0:pad, pad+window_size:pad*2+window_size] = nodata
+                    elevation[pad+window_size:pad*2+window_size, pad+window_size:pad*2+window_size] = nodata
+
+                    mask = elevation != nodata
+
+                    intensity = None
+                    if hillshade is not None and hillshade > 0:
+                        intensity = compute_hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade,
+                                                      multidirectional=hillshade_mode == 'multidirectional')
+                        intensity = intensity[pad:pad+window_size, pad:pad+window_size]
+
+                    rgb_data, _ = apply_cmap(process(elevation[pad:window_size+pad, pad:window_size+pad][np.newaxis,:], skip_background=True, includes_alpha=False), cmap)
+
+                    if intensity is not None:
+                        rgb_data = hillshade_blend(rgb_data, intensity)
+                    
+                    mask = mask[pad:window_size+pad, pad:window_size+pad]
+                    writes = [(process(rgb_data, skip_rescale=True, mask=mask, includes_alpha=False), dict(window=dst_w, indexes=(1,2,3)))]
+                    if with_alpha:
+                        writes.append((mask.astype(np.uint8) * 255, dict(indexes=4, window=dst_w)))
+                    return writes
+                else:
+                    # Raw
+                    return [(process(data), dict(window=dst_w))]
         else:
             # Copy bands as-is
-            with rasterio.open(output_raster, 'w', **profile) as dst:
-                for idx, (w, dst_w) in enumerate(subwins):
-                    p(f"Processing tile {idx}/{num_wins}", progress_per_win)
+            def read_window(src, w):
+                return src.read(indexes=indexes, window=w)
+
+            def compute_window(w, dst_w, data):
+                return [(process(data, drop_last_band=not with_alpha), dict(window=dst_w))]
+
+        with rasterio.open(output_raster, 'w', **profile) as dst:
+            def write_window(idx, writes):
+                p(f"Processing tile {idx}/{num_wins}", progress_per_win)
+
+                for arr, kwargs in writes:
+                    dst.write(arr, **kwargs)
+
+                if rgb_colorinterp:
+                    update_rgb_colorinterp(dst)
 
-                    arr = src.read(indexes=indexes, window=w)
-                    dst.write(process(arr, drop_last_band=not with_alpha), window=dst_w)
+            process_windows(input, src, subwins, read_window, compute_window, write_window, threads=threads)
 
+            if expression is None and not dem:
                 new_ci = [src.colorinterp[idx - 1] for idx in indexes]
                 if not with_alpha:
                     new_ci = [ci for ci in new_ci if ci != ColorInterp.alpha]
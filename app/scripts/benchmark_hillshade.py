@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Benchmark the hillshade + HSV blend kernel used to render elevation tiles
+# against the previous LightSource + hsv_blend implementation.
+#
+# Usage: python -m app.scripts.benchmark_hillshade [--runs N]
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+
+from app.api.hillshade import LightSource, hillshade, hillshade_blend
+from app.api.hsvblend import hsv_blend
+
+TILE_BUFFER = 16
+
+
+def make_elevation(size):
+    x = np.linspace(0, 20, size)
+    noise = np.random.default_rng(0).normal(0, 0.5, (size, size))
+    return (np.sin(x)[np.newaxis, :] * np.cos(x)[:, np.newaxis] * 30 + noise + 150).astype(np.float32)
+
+
+def make_rgb(size):
+    return np.random.default_rng(1).integers(0, 256, (3, size, size)).astype(np.uint8)
+
+
+def render_before(elevation, rgb, tilesize):
+    ls = LightSource(azdeg=315, altdeg=45)
+    intensity = ls.hillshade(elevation, dx=0.05, dy=-0.05, vert_exag=6)
+    intensity = intensity[TILE_BUFFER:TILE_BUFFER+tilesize, TILE_BUFFER:TILE_BUFFER+tilesize]
+    intensity = intensity * 255.0
+    return hsv_blend(rgb, intensity)
+
+
+def render_after(elevation, rgb, tilesize, multidirectional=False):
+    intensity = hillshade(elevation, dx=0.05, dy=-0.05, vert_exag=6, multidirectional=multidirectional)
+    intensity = intensity[TILE_BUFFER:TILE_BUFFER+tilesize, TILE_BUFFER:TILE_BUFFER+tilesize]
+    return hillshade_blend(rgb, intensity)
+
+
+def measure(func, runs):
+    # Warm up (and fill reusable buffers)
+    func()
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    elapsed = (time.perf_counter() - start) / runs
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hillshade tile rendering")
+    parser.add_argument("--runs", type=int, default=50, help="Number of runs per measurement")
+    args = parser.parse_args()
+
+    print("{:<10} {:<26} {:>12} {:>14}".format("tilesize", "implementation", "ms/tile", "peak memory"))
+
+    for tilesize in [256, 512]:
+        elevation = make_elevation(tilesize + TILE_BUFFER * 2)
+        rgb = make_rgb(tilesize)
+
+        before = render_before(elevation.copy(), rgb, tilesize)
+        after = render_after(elevation.copy(), rgb, tilesize)
+        max_diff = np.abs(before.astype(np.int16) - after.astype(np.int16)).max()
+
+        for name, func in [("LightSource + hsv_blend", lambda: render_before(elevation, rgb, tilesize)),
+                           ("hillshade + blend", lambda: render_after(elevation, rgb, tilesize)),
+                           ("hillshade (multi) + blend", lambda: render_after(elevation, rgb, tilesize, True))]:
+            elapsed, peak = measure(func, args.runs)
+            print("{:<10} {:<26} {:>12.3f} {:>11.1f} KB".format(tilesize, name, elapsed * 1000, peak / 1024))
+
+        print("{:<10} max difference: {}".format(tilesize, max_diff))
@@ -4,6 +4,7 @@ import '../css/AssetDownloadButtons.scss';
 import AssetDownloads from '../classes/AssetDownloads';
 import PropTypes from 'prop-types';
 import ExportAssetDialog from './ExportAssetDialog';
+import Workers from '../classes/Workers';
 import { _ } from '../classes/gettext';
 
 class AssetDownloadButtons extends React.Component {
@@ -33,10 +34,47 @@ class AssetDownloadButtons extends React.Component {
         super();
 
         this.state = {
-            exportDialogProps: null
+            exportDialogProps: null,
+            backingUp: false,
+            backupError: ""
         }
     }
 
+    componentWillUnmount(){
+        if (this.backupReq) this.backupReq.abort();
+    }
+
+    downloadBackup = e => {
+        e.preventDefault();
+        if (this.state.backingUp) return;
+
+        const { task } = this.props;
+        this.setState({backingUp: true, backupError: ""});
+
+        // Backups are built by a worker, wait for it before downloading
+        const requestBackup = () => {
+            this.backupReq = $.ajax({
+                type: 'POST',
+                url: `/api/projects/${task.project}/tasks/${task.id}/backup`
+            }).done(result => {
+                if (result.celery_task_id){
+                    Workers.waitForCompletion(result.celery_task_id, error => {
+                        if (error) this.setState({backingUp: false, backupError: error});
+                        else requestBackup();
+                    });
+                }else if (result.url){
+                    this.setState({backingUp: false});
+                    window.location.href = result.url;
+                }else{
+                    this.setState({backingUp: false, backupError: interpolate(_("Invalid JSON response: %(error)s"), {error: JSON.stringify(result)})});
+                }
+            }).fail(error => {
+                this.setState({backingUp: false, backupError: (error.responseJSON || {}).detail || JSON.stringify(error)});
+            });
+        };
+        requestBackup();
+    }
+
     onHide = () => {
         this.setState({exportDialogProps: null});
         if (this.props.onModalClose) this.props.onModalClose();
@@ -108,7 +146,9 @@ class AssetDownloadButtons extends React.Component {
                 }
             })}
             {this.props.hideItems.indexOf("backup.zip") === -1 ? <li>
-                <a href={`/api/projects/${this.props.task.project}/tasks/${this.props.task.id}/backup`}><i className="fa fa-file-download fa-fw"></i> {_("Backup")}</a>
+                <a href={`/api/projects/${this.props.task.project}/tasks/${this.props.task.id}/backup`} onClick={this.downloadBackup} title={this.state.backupError}>
+                    <i className={(this.state.backingUp ? "fa fa-circle-notch fa-spin" : (this.state.backupError ? "fa fa-exclamation-triangle" : "fa fa-file-download")) + " fa-fw"}></i> {_("Backup")}
+                </a>
             </li> : ""}
           </ul>
         </div>);
@@ -9,7 +9,7 @@ import Workers from '../classes/Workers';
 
 export default class ExportAssetPanel extends React.Component {
   static defaultProps = {
-      exportFormats: ["gtiff-rgb", "gtiff", "jpg", "png", "kmz"],
+      exportFormats: ["gtiff-rgb", "gtiff", "jpg", "png", "kmz", "mbtiles"],
       asset: "",
       exportParams: {},
       task: null,
@@ -52,6 +52,10 @@ export default class ExportAssetPanel extends React.Component {
             label: "KMZ (RGB)",
             icon: "fas fa-globe"
         },
+        'mbtiles': {
+            label: "MBTiles (RGB)",
+            icon: "fa fa-table"
+        },
         'laz': {
             label: "LAZ",
             icon: "fa fa-cube"
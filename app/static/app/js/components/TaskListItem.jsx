@@ -169,12 +169,15 @@ class TaskListItem extends React.Component {
   }
 
   consoleOutputUrl(line, download){
-    let url = `/api/projects/${this.state.task.project}/tasks/${this.state.task.id}/output/`;
+    let url = `/api/projects/${this.state.task.project}/tasks/${this.state.task.id}/`;
     
     if (download !== undefined){
-      url += `?f=raw`;
+      url += `output/?f=raw`;
+    }else if (this.shouldRefresh()){
+      // Wait for new output instead of polling for it
+      url += `tail/?f=json`;
     }else{
-      url += `?f=json`;
+      url += `output/?f=json`;
     }
 
     if (line !== undefined){
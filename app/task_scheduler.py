@@ -0,0 +1,160 @@
+import time
+import logging
+import redis
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+# Sorted set of task IDs, scored by the time of their next check
+SCHEDULE_KEY = 'task_schedule'
+
+# Current check interval of each task (in seconds)
+INTERVALS_KEY = 'task_schedule_intervals'
+
+# Dispatch statistics
+STATS_KEY = 'task_schedule_stats'
+
+SYNC_LOCK_KEY = 'task_schedule_sync'
+
+
+def get_lease_time():
+    # Dispatched tasks are not dispatched again until they are rescheduled
+    # by process_task, or this many seconds have passed (e.g. a worker died)
+    return max(settings.TASK_CHECK_MAX_INTERVAL, 30) if settings.TASK_CHECK_MAX_INTERVAL > 0 else 0
+
+
+def schedule_task(task_id, delay=0):
+    """
+    Schedule the next check of a task
+    :param delay: seconds from now
+    """
+    redis_client.zadd(SCHEDULE_KEY, {str(task_id): time.time() + delay})
+
+
+def wake_task(task_id):
+    """
+    Mark a task as due right away (e.g. after a user action)
+    and reset its check interval
+    """
+    pipe = redis_client.pipeline()
+    pipe.zadd(SCHEDULE_KEY, {str(task_id): time.time()})
+    pipe.hdel(INTERVALS_KEY, str(task_id))
+    pipe.execute()
+
+
+def unschedule_task(task_id):
+    pipe = redis_client.pipeline()
+    pipe.zrem(SCHEDULE_KEY, str(task_id))
+    pipe.hdel(INTERVALS_KEY, str(task_id))
+    pipe.execute()
+
+
+def reschedule_task(task_id, changed):
+    """
+    Schedule the next check of a task after it has been processed.
+    Tasks that keep changing are checked every TASK_CHECK_INTERVAL seconds,
+    tasks that don't are checked less and less often, up to TASK_CHECK_MAX_INTERVAL.
+    :param changed: whether anything changed since the last check
+    :return: seconds until the next check
+    """
+    interval = settings.TASK_CHECK_INTERVAL
+    if not changed:
+        last_interval = redis_client.hget(INTERVALS_KEY, str(task_id))
+        if last_interval is not None:
+            interval = min(settings.TASK_CHECK_MAX_INTERVAL, max(interval, float(last_interval) * settings.TASK_CHECK_BACKOFF))
+
+    pipe = redis_client.pipeline()
+    pipe.zadd(SCHEDULE_KEY, {str(task_id): time.time() + interval})
+    pipe.hset(INTERVALS_KEY, str(task_id), interval)
+    pipe.execute()
+
+    return interval
+
+
+def claim_due_tasks(limit=None):
+    """
+    Get the tasks that are due for a check and lease them,
+    so that they are not dispatched twice
+    :param limit: maximum number of tasks to claim
+    :return: list of task IDs
+    """
+    now = time.time()
+    due = redis_client.zrangebyscore(SCHEDULE_KEY, '-inf', now, withscores=True,
+                                     start=0 if limit is not None else None, num=limit)
+    lag = now - due[0][1] if len(due) > 0 else 0
+
+    pipe = redis_client.pipeline()
+    if len(due) > 0:
+        lease_until = now + get_lease_time()
+        pipe.zadd(SCHEDULE_KEY, {task_id: lease_until for task_id, _ in due}, xx=True)
+    pipe.hmset(STATS_KEY, {'last_dispatch': now, 'dispatched': len(due), 'lag': lag})
+    pipe.execute()
+
+    return [task_id.decode('utf-8') for task_id, _ in due]
+
+
+def is_sync_due():
+    """
+    :return: whether the schedule should be reconciled with the database
+    """
+    if settings.TASK_SCHEDULE_SYNC_INTERVAL <= 0:
+        return True
+    return bool(redis_client.set(SYNC_LOCK_KEY, time.time(), nx=True, ex=settings.TASK_SCHEDULE_SYNC_INTERVAL))
+
+
+def sync_schedule(task_ids):
+    """
+    Reconcile the schedule with the list of tasks that need processing:
+    tasks that are missing are scheduled right away, tasks that
+    are no longer pending are removed
+    :param task_ids: IDs of all tasks that need processing
+    :return: (number of tasks added, number of tasks removed)
+    """
+    task_ids = {str(task_id) for task_id in task_ids}
+    scheduled = {t.decode('utf-8') for t in redis_client.zrange(SCHEDULE_KEY, 0, -1)}
+
+    added = task_ids - scheduled
+    removed = scheduled - task_ids
+
+    pipe = redis_client.pipeline()
+    if len(added) > 0:
+        now = time.time()
+        pipe.zadd(SCHEDULE_KEY, {task_id: now for task_id in added}, nx=True)
+    if len(removed) > 0:
+        pipe.zrem(SCHEDULE_KEY, *removed)
+        pipe.hdel(INTERVALS_KEY, *removed)
+    pipe.execute()
+
+    if len(added) > 0 or len(removed) > 0:
+        logger.info("Task schedule synced ({} added, {} removed)".format(len(added), len(removed)))
+
+    return len(added), len(removed)
+
+
+def get_task_scheduler_stats():
+    now = time.time()
+    try:
+        queued = redis_client.zcard(SCHEDULE_KEY)
+        due = redis_client.zcount(SCHEDULE_KEY, '-inf', now)
+        oldest = redis_client.zrange(SCHEDULE_KEY, 0, 0, withscores=True)
+        stats = {k.decode('utf-8'): float(v) for k, v in redis_client.hgetall(STATS_KEY).items()}
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot read task scheduler stats: {}".format(str(e)))
+        queued, due, oldest, stats = 0, 0, [], {}
+
+    return {
+        # Number of tasks being tracked
+        'queued': queued,
+
+        # Number of tasks that are due for a check
+        'due': due,
+
+        # How late (in seconds) is the most overdue task
+        'lag': max(0, now - oldest[0][1]) if len(oldest) > 0 else 0,
+
+        # Last dispatch
+        'last_dispatch': stats.get('last_dispatch'),
+        'last_dispatched': int(stats.get('dispatched', 0)),
+        'last_dispatch_lag': stats.get('lag', 0),
+    }
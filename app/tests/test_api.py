@@ -180,6 +180,22 @@ class TestApi(BootTestCase):
         res = client.get('/api/projects/{}/tasks/{}/output/?line=0&limit=-2&f=raw'.format(project.id, task.id))
         self.assertEqual(res.content.decode("utf-8"), "line2\nline3")
 
+        # Console tail returns right away when there's new output
+        res = client.get('/api/projects/{}/tasks/{}/tail/?line=1'.format(project.id, task.id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, {'lines': ['line2', 'line3'], 'count': 3})
+
+        # Or after a timeout when there isn't
+        res = client.get('/api/projects/{}/tasks/{}/tail/?line=3&timeout=0.1'.format(project.id, task.id))
+        self.assertEqual(res.data, {'lines': [], 'count': 3})
+
+        task.console += "\nline4"
+        res = client.get('/api/projects/{}/tasks/{}/tail/?line=3&limit=-1'.format(project.id, task.id))
+        self.assertEqual(res.data, {'lines': ['line4'], 'count': 4})
+
+        res = client.get('/api/projects/{}/tasks/{}/tail/?timeout=invalid'.format(project.id, task.id))
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
         # Cannot list task details for a task belonging to a project we don't have access to
         res = client.get('/api/projects/{}/tasks/{}/'.format(other_project.id, other_task.id))
         self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
@@ -131,6 +131,7 @@ class TestApiTask(BootTransactionTestCase):
                 ('orthophoto', {'format': 'jpg', 'epsg': 4326, 'rescale': '10,200'}, False, ".jpg", status.HTTP_200_OK),
                 ('orthophoto', {'format': 'png'}, False, ".png", status.HTTP_200_OK),
                 ('orthophoto', {'format': 'kmz'}, False, ".kmz", status.HTTP_200_OK),
+                ('orthophoto', {'format': 'mbtiles'}, False, ".mbtiles", status.HTTP_200_OK),
                 
                 ('orthophoto', {'formula': 'NDVI'}, False, "-NDVI.tif", status.HTTP_400_BAD_REQUEST),
                 ('orthophoto', {'bands': 'RGN'}, False, "-NDVI.tif", status.HTTP_400_BAD_REQUEST),
@@ -143,6 +144,7 @@ class TestApiTask(BootTransactionTestCase):
                 ('dsm', {'epsg': 4326, 'format': 'jpg'}, False, ".jpg", status.HTTP_200_OK),
                 ('dsm', {'epsg': 4326, 'format': 'gtiff-rgb'}, False, ".tif", status.HTTP_200_OK),
                 ('dsm', {'format': 'kmz'}, False, ".kmz", status.HTTP_200_OK),
+                ('dsm', {'format': 'mbtiles', 'color_map': 'jet'}, False, ".mbtiles", status.HTTP_200_OK),
                 ('dsm', {'color_map': 'viridis', 'hillshade': 2, 'format': 'png'}, False, ".png", status.HTTP_200_OK),
                 ('dsm', {'rescale': 'invalid-but-works-cuz-gtiff'}, True, ".tif", status.HTTP_200_OK),
                 
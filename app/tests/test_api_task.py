@@ -1,6 +1,8 @@
 import io
 import os
+import glob
 import time
+import zipfile
 
 import threading
 
@@ -11,6 +13,7 @@ from datetime import timedelta
 import json
 import requests
 from PIL import Image
+from rio_tiler.io import COGReader
 from django.contrib.auth.models import User
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -23,6 +26,9 @@ from app import pending_actions
 from app.api.formulas import algos, get_camera_filters_for
 from app.api.tiler import ZOOM_EXTRA_LEVELS
 from app.cogeo import valid_cogeo
+from app.deferred_assets import get_archive
+from app.raster_metadata import get_raster_metadata_key, get_raster_metadata_cache_path
+from app.tile_pyramid import generate_tile_pyramid, clear_tile_pyramids
 from app.models import Project, Task
 from app.models.task import task_directory_path, full_task_directory_path, TaskInterruptedException
 from app.plugins.signals import task_completed, task_removed, task_removing
@@ -137,14 +143,18 @@ class TestApiTask(BootTransactionTestCase):
                 self.assertTrue(im.size == img1.size)
 
             # Normal case with images[], GCP, name and processing node parameter and resize_to option
+            # (images are resized in parallel)
             testWatch.clear()
             gcp = open("app/fixtures/gcp.txt", 'r')
+            max_threads = settings.WORKERS_MAX_THREADS
+            settings.WORKERS_MAX_THREADS = 4
             res = client.post("/api/projects/{}/tasks/".format(project.id), {
                 'images': [image1, image2, multispec_image, gcp],
                 'name': 'test_task',
                 'processing_node': pnode.id,
                 'resize_to': img1.size[0] / 2.0
             }, format="multipart")
+            settings.WORKERS_MAX_THREADS = max_threads
             self.assertTrue(res.status_code == status.HTTP_201_CREATED)
             resized_task = Task.objects.latest('created_at')
             image1.seek(0)
@@ -406,6 +416,36 @@ class TestApiTask(BootTransactionTestCase):
             # A textured mesh archive file should not exist (it's generated on the fly)
             self.assertFalse(os.path.exists(task.assets_path(task.ASSETS_MAP["textured_model.zip"]["deferred_path"])))
 
+            # Deferred archives have been built in the assets cache
+            archive = task.get_asset_file_or_stream("textured_model.zip")
+            self.assertTrue(isinstance(archive, str))
+            self.assertTrue(archive.startswith(task.get_task_assets_cache()))
+
+            # Other files in a zip are stored as-is
+            with zipfile.ZipFile(archive) as zf:
+                for info in zf.infolist():
+                    if info.filename.lower().endswith(".jpg"):
+                        self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+            # And support range requests
+            res = client.get("/api/projects/{}/tasks/{}/download/textured_model.zip".format(project.id, task.id), HTTP_RANGE="bytes=0-3")
+            self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(res.streaming_content), b'PK\x03\x04')
+            self.assertEqual(res['Content-Range'], "bytes 0-3/{}".format(os.path.getsize(archive)))
+
+            res = client.get("/api/projects/{}/tasks/{}/download/textured_model.zip".format(project.id, task.id), HTTP_RANGE="bytes={}-".format(os.path.getsize(archive)))
+            self.assertEqual(res.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+            # Archives of the entire task are not duplicated in the cache
+            self.assertFalse(isinstance(task.get_asset_file_or_stream("all.zip"), str))
+            self.assertTrue(get_archive(task, "all.zip", task.get_deferred_asset_paths("all.zip")) is None)
+
+            # Archives are rebuilt when the files change
+            texture_file = [f for f in glob.glob(task.assets_path("odm_texturing", "*")) if os.path.isfile(f)][0]
+            os.utime(texture_file, (time.time() + 10, time.time() + 10))
+            self.assertEqual(task.get_asset_file_or_stream("textured_model.zip"), archive)
+            self.assertTrue(get_archive(task, "textured_model.zip", task.get_deferred_asset_paths("textured_model.zip")) is not None)
+
             # Can download raw assets
             res = client.get("/api/projects/{}/tasks/{}/assets/odm_orthophoto/odm_orthophoto.tif".format(project.id, task.id))
             self.assertTrue(res.status_code == status.HTTP_200_OK)
@@ -413,6 +453,30 @@ class TestApiTask(BootTransactionTestCase):
             # EPT dataset should be there/have been created
             res = client.get("/api/projects/{}/tasks/{}/assets/entwine_pointcloud/ept.json".format(project.id, task.id))
             self.assertTrue(res.status_code == status.HTTP_200_OK)
+            ept_json = res.content
+
+            # Repeated requests are not modified
+            etag = res['ETag']
+            res = client.get("/api/projects/{}/tasks/{}/assets/entwine_pointcloud/ept.json".format(project.id, task.id), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+            # Partial reads
+            res = client.get("/api/projects/{}/tasks/{}/assets/entwine_pointcloud/ept.json".format(project.id, task.id), HTTP_RANGE="bytes=-10")
+            self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(res.streaming_content), ept_json[-10:])
+
+            # Ranges are ignored if the file has changed
+            res = client.get("/api/projects/{}/tasks/{}/assets/entwine_pointcloud/ept.json".format(project.id, task.id), HTTP_RANGE="bytes=-10", HTTP_IF_RANGE='"changed"')
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(res.content, ept_json)
+
+            # Files can be sent by nginx
+            settings.DOWNLOAD_OFFLOAD_LOCATION = '/_media/'
+            res = client.get("/api/projects/{}/tasks/{}/assets/entwine_pointcloud/ept.json".format(project.id, task.id))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(res['X-Accel-Redirect'], '/_media/' + os.path.relpath(task.assets_path("entwine_pointcloud", "ept.json"), settings.MEDIA_ROOT))
+            self.assertEqual(res.content, b'')
+            settings.DOWNLOAD_OFFLOAD_LOCATION = None
 
              # Orthophoto bands field should be populated
             self.assertEqual(len(task.orthophoto_bands), 4)
@@ -581,6 +645,12 @@ class TestApiTask(BootTransactionTestCase):
                 self.assertTrue('max' in metadata['statistics'][b])
                 self.assertTrue('min' in metadata['statistics'][b])
 
+            # Default metadata was precomputed at completion and is served from cache
+            md_key = get_raster_metadata_key(task.get_asset_download_path("orthophoto.tif"), "orthophoto")
+            self.assertTrue(os.path.isfile(get_raster_metadata_cache_path(task, md_key)))
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/metadata".format(project.id, task.id))
+            self.assertEqual(json.loads(res.content.decode("utf-8"))['statistics'], metadata['statistics'])
+
             # Metadata with invalid formula
             res = client.get("/api/projects/{}/tasks/{}/orthophoto/metadata?formula=INVALID".format(project.id, task.id))
             self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -679,6 +749,17 @@ class TestApiTask(BootTransactionTestCase):
                 with Image.open(io.BytesIO(res.content)) as i:
                     self.assertEqual(i.width, 512)
                     self.assertEqual(i.height, 512)
+
+            # Tiles above the zoom levels of a pre-rendered tile pyramid are still rendered
+            pyramid_path = generate_tile_pyramid(task, "orthophoto", max_zoom=17)
+            self.assertTrue(os.path.isfile(pyramid_path))
+            with COGReader(task.get_asset_download_path("orthophoto.tif")) as src:
+                west, south, east, north = src.bounds
+                for z in [17, 18, 18 + 1]:
+                    t = src.tms.tile((west + east) / 2, (south + north) / 2, z)
+                    res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/{}/{}/{}.png".format(project.id, task.id, t.z, t.x, t.y))
+                    self.assertEqual(res.status_code, status.HTTP_200_OK)
+            clear_tile_pyramids(task)
             
             # Cannot set invalid scene
             res = client.post("/api/projects/{}/tasks/{}/3d/scene".format(project.id, task.id), json.dumps({ "garbage": "" }), content_type="application/json")
@@ -816,10 +897,37 @@ class TestApiTask(BootTransactionTestCase):
             for s in ["1024", "abc", "-1"]:
                 res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/{}.png?size={}".format(project.id, task.id, tile_path['orthophoto'], s))
                 self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+            # Can request multiple tiles at once
+            res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/batch?tiles={},0/0/0&ext=png".format(project.id, task.id, tile_path['orthophoto']))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertTrue(res.get('content-type').startswith("multipart/mixed; boundary="))
+            boundary = res.get('content-type').split("boundary=")[1].encode('utf-8')
+            parts = res.content.split(b"--" + boundary)[1:-1]
+
+            # Tiles outside of bounds are omitted
+            self.assertEqual(len(parts), 1)
+            headers, content = parts[0].split(b"\r\n\r\n", 1)
+            self.assertTrue(b"Content-Location: " + tile_path['orthophoto'].encode('utf-8') in headers)
+            self.assertTrue(b"Content-Type: image/png" in headers)
+            with Image.open(io.BytesIO(content[:-2])) as i:
+                self.assertEqual(i.width, 256)
+                self.assertEqual(i.height, 256)
+
+            # Can request ranges of tiles
+            z, x, y = tile_path['dsm'].split("/")
+            res = client.get("/api/projects/{}/tasks/{}/dsm/tiles/batch?z={}&x={}-{}&y={}".format(project.id, task.id, z, x, int(x) + 1, y))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertTrue(b"Content-Location: " + tile_path['dsm'].encode('utf-8') in res.content)
+
+            # Cannot request too many or invalid tiles
+            for q in ["z=17&x=0-1000&y=0-1000", "tiles=a/b/c", "z=17&x=5-1&y=1", ""]:
+                res = client.get("/api/projects/{}/tasks/{}/orthophoto/tiles/batch?{}".format(project.id, task.id, q))
+                self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
             
-            # This task's assets cache should not exist
+            # The GLB cache should not exist
             ta_cache_dir = task.get_task_assets_cache()
-            self.assertFalse(os.path.isdir(ta_cache_dir))
+            self.assertFalse(os.path.isfile(os.path.join(ta_cache_dir, "odm_textured_model_geo-2.glb")))
 
             # Can access the safe textured model endpoint
             res = client.get("/api/projects/{}/tasks/{}/textured_model/".format(project.id, task.id))
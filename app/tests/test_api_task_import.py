@@ -1,16 +1,20 @@
 import os
+import json
 import time
+import zipfile
 import shutil
 import subprocess
 
 import io
 import requests
+from unittest.mock import patch
 from django.contrib.auth.models import User
 from guardian.shortcuts import remove_perm, assign_perm
 from rest_framework import status
 from rest_framework.test import APIClient
 
 import worker
+from app.backup import HASH_CACHE_MIN_SIZE
 from app.cogeo import valid_cogeo
 from app.models import Project
 from app.models import Task
@@ -301,6 +305,46 @@ class TestApiTask(BootTransactionTestCase):
 
             with open(assets_path, 'wb') as f:
                 f.write(b''.join(res.streaming_content))
+            backup_id = res['X-Backup-Id']
+
+            # Backups list the files of the task and store each content once
+            with zipfile.ZipFile(assets_path) as z:
+                manifest = json.loads(z.read("backup_manifest.json"))
+                self.assertEqual(manifest['id'], backup_id)
+                self.assertTrue('data/backup.json' in [f['path'] for f in manifest['files']])
+                self.assertEqual(len([n for n in z.namelist() if n.startswith("blobs/")]), len(set([f['hash'] for f in manifest['files']])))
+
+            # Backups are built by a worker, clients wait for it before downloading
+            res = client.post("/api/projects/{}/tasks/{}/backup".format(project.id, task.id))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(res.data['url'], "/api/projects/{}/tasks/{}/backup".format(project.id, task.id))
+
+            # Backups can be sent by nginx, along with their ID
+            settings.DOWNLOAD_OFFLOAD_LOCATION = '/_media/'
+            res = client.get("/api/projects/{}/tasks/{}/backup".format(project.id, task.id))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertTrue(res['X-Accel-Redirect'].startswith('/_media/'))
+            self.assertEqual(res['X-Backup-Id'], backup_id)
+            settings.DOWNLOAD_OFFLOAD_LOCATION = None
+
+            # Incremental backups only include what changed (and small files)
+            res = client.get("/api/projects/{}/tasks/{}/backup?since={}".format(project.id, task.id, backup_id))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertEqual(res['X-Backup-Id'], backup_id)
+            incremental_path = os.path.join(settings.MEDIA_TMP, "backup_incremental.zip")
+            with open(incremental_path, 'wb') as f:
+                f.write(b''.join(res.streaming_content))
+            with zipfile.ZipFile(incremental_path) as z:
+                small = set([f['hash'] for f in manifest['files'] if f['size'] < HASH_CACHE_MIN_SIZE])
+                self.assertEqual(sorted(z.namelist()), sorted(["backup_manifest.json"] + ["blobs/" + h for h in small]))
+
+            # Duplicated tasks can use the backups of the original as a base
+            duplicate_task = task.duplicate()
+            res = client.get("/api/projects/{}/tasks/{}/backup?since={}".format(project.id, duplicate_task.id, backup_id))
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            with zipfile.ZipFile(io.BytesIO(b''.join(res.streaming_content))) as z:
+                self.assertEqual(json.loads(z.read("backup_manifest.json"))['base'], backup_id)
+            duplicate_task.delete()
 
             assets_file = open(assets_path, 'rb')
 
@@ -329,6 +373,12 @@ class TestApiTask(BootTransactionTestCase):
             self.assertEqual(file_import_task.name, "Backup test")
             self.assertTrue('saved' in file_import_task.potree_scene)
             self.assertEqual(file_import_task.public, True)
+
+            # Backups of other tasks cannot be used as a base
+            res = client.get("/api/projects/{}/tasks/{}/backup?since={}".format(project.id, file_import_task.id, backup_id))
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+            res = client.post("/api/projects/{}/tasks/{}/backup".format(project.id, file_import_task.id), {'since': backup_id})
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
             
             # Can access assets
             res = client.get("/api/projects/{}/tasks/{}/assets/odm_orthophoto/odm_orthophoto.tif".format(project.id, file_import_task.id))
@@ -338,6 +388,124 @@ class TestApiTask(BootTransactionTestCase):
             self.assertTrue(valid_cogeo(file_import_task.assets_path(task.ASSETS_MAP["dsm.tif"])))
             self.assertTrue(valid_cogeo(file_import_task.assets_path(task.ASSETS_MAP["dtm.tif"])))
 
+            # Incremental backups are restored with the files of the user's other tasks
+            incremental_file = open(incremental_path, 'rb')
+            res = client.post("/api/projects/{}/tasks/import".format(project.id), {
+                'file': [incremental_file]
+            }, format="multipart")
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+            incremental_file.close()
+
+            incremental_import_task = Task.objects.get(id=res.data['id'])
+            c = 0
+            while c < 10:
+                worker.tasks.process_pending_tasks()
+                incremental_import_task.refresh_from_db()
+                if incremental_import_task.status == status_codes.COMPLETED:
+                    break
+                c += 1
+                time.sleep(1)
+
+            self.assertEqual(incremental_import_task.status, status_codes.COMPLETED)
+            self.assertEqual(incremental_import_task.name, "Backup test")
+            orthophoto = incremental_import_task.assets_path(task.ASSETS_MAP["orthophoto.tif"])
+            self.assertTrue(valid_cogeo(orthophoto))
+
+            # Files are copied, not linked
+            self.assertNotEqual(os.stat(orthophoto).st_ino, os.stat(file_import_task.assets_path(task.ASSETS_MAP["orthophoto.tif"])).st_ino)
+            self.assertNotEqual(os.stat(orthophoto).st_ino, os.stat(task.assets_path(task.ASSETS_MAP["orthophoto.tif"])).st_ino)
+
+            # Other users' tasks are not used
+            other_user = User.objects.get(username="testuser2")
+            other_project = Project.objects.create(owner=other_user, name="test backup restore")
+            client.logout()
+            client.login(username="testuser2", password="test1234")
+            incremental_file = open(incremental_path, 'rb')
+            res = client.post("/api/projects/{}/tasks/import".format(other_project.id), {
+                'file': [incremental_file]
+            }, format="multipart")
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+            incremental_file.close()
+
+            other_import_task = Task.objects.get(id=res.data['id'])
+            c = 0
+            while c < 10:
+                worker.tasks.process_pending_tasks()
+                other_import_task.refresh_from_db()
+                if other_import_task.status in [status_codes.COMPLETED, status_codes.FAILED]:
+                    break
+                c += 1
+                time.sleep(1)
+
+            self.assertEqual(other_import_task.status, status_codes.FAILED)
+
+            # Downloads always send the backup, unless clients ask to wait for a worker
+            client.logout()
+            client.login(username="testuser", password="test1234")
+            task.name = "Backup test changed"
+            task.save()
+
+            with patch.object(worker.tasks, 'schedule_task_backup', return_value="pending"):
+                res = client.get("/api/projects/{}/tasks/{}/backup?async=1".format(project.id, task.id))
+                self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+                self.assertEqual(res.data['celery_task_id'], "pending")
+
+                res = client.get("/api/projects/{}/tasks/{}/backup".format(project.id, task.id))
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                self.assertNotEqual(res['X-Backup-Id'], backup_id)
+                with zipfile.ZipFile(io.BytesIO(b''.join(res.streaming_content))) as z:
+                    self.assertTrue("backup_manifest.json" in z.namelist())
+
+    def test_backup_path_traversal(self):
+        client = APIClient()
+        client.login(username="testuser", password="test1234")
+        user = User.objects.get(username="testuser")
+        project = Project.objects.create(owner=user, name="test backup path traversal")
+
+        if not os.path.exists(settings.MEDIA_TMP):
+            os.mkdir(settings.MEDIA_TMP)
+
+        # A file that the backup tries to take
+        victim_path = os.path.join(settings.MEDIA_TMP, "victim.txt")
+        with open(victim_path, 'w') as f:
+            f.write("secret")
+
+        backup_path = os.path.join(settings.MEDIA_TMP, "traversal_backup.zip")
+        with zipfile.ZipFile(backup_path, 'w') as z:
+            z.writestr("backup_manifest.json", json.dumps({
+                'version': 1,
+                'id': "0" * 40,
+                'base': None,
+                'files': [{
+                    'path': "assets/odm_orthophoto/odm_orthophoto.tif",
+                    'hash': "../" * 32 + os.path.abspath(victim_path).lstrip("/"),
+                    'size': 6
+                }]
+            }))
+            z.writestr("blobs/readme.txt", "not a blob")
+
+        with open(backup_path, 'rb') as f:
+            res = client.post("/api/projects/{}/tasks/import".format(project.id), {
+                'file': [f]
+            }, format="multipart")
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        import_task = Task.objects.get(id=res.data['id'])
+        c = 0
+        while c < 10:
+            worker.tasks.process_pending_tasks()
+            import_task.refresh_from_db()
+            if import_task.status in [status_codes.COMPLETED, status_codes.FAILED]:
+                break
+            c += 1
+            time.sleep(1)
+
+        # The import fails and the file is left alone
+        self.assertEqual(import_task.status, status_codes.FAILED)
+        with open(victim_path, 'r') as f:
+            self.assertEqual(f.read(), "secret")
+        self.assertFalse(os.path.exists(import_task.assets_path("odm_orthophoto", "odm_orthophoto.tif")))
+
     def test_entwine_bin(self):
         entwine = shutil.which("entwine")
         self.assertTrue(entwine is not None)
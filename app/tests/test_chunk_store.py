@@ -0,0 +1,61 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from app.chunk_store import write_chunk, finalize_upload, get_received_ranges, get_upload_path, discard_upload
+from webodm import settings
+
+
+class TestChunkStore(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(dir=settings.MEDIA_TMP)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        for uuid in ["test-chunks", "test-gap"]:
+            discard_upload(uuid)
+
+    def test_chunk_store(self):
+        data = os.urandom(100003)
+        chunk_size = 30000
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+        def send(i, checksum=None):
+            return write_chunk("test-chunks", SimpleUploadedFile("image.jpg", chunks[i]), i, i * chunk_size,
+                               len(chunks), total_size=len(data), checksum=checksum)
+
+        # Chunks can arrive out of order, and more than once
+        self.assertFalse(send(2))
+        self.assertFalse(send(0))
+        self.assertFalse(send(2))
+        self.assertEqual(os.path.getsize(get_upload_path("test-chunks")), len(data))
+        self.assertEqual(get_received_ranges("test-chunks"), [(0, chunk_size), (2 * chunk_size, chunk_size)])
+
+        # Bad chunks are rejected
+        with self.assertRaises(ValueError):
+            send(1, checksum="0" * 64)
+        with self.assertRaises(ValueError):
+            write_chunk("test-chunks", SimpleUploadedFile("image.jpg", data), 3, 3 * chunk_size, len(chunks), total_size=len(data))
+
+        self.assertFalse(send(1, checksum=hashlib.sha256(chunks[1]).hexdigest()))
+        self.assertTrue(send(3))
+
+        # Uploads that cannot be moved can be finalized again
+        with self.assertRaises(OSError):
+            finalize_upload("test-chunks", os.path.join(self.tmpdir, "missing", "image.jpg"))
+        self.assertTrue(send(3))
+
+        destination = os.path.join(self.tmpdir, "image.jpg")
+        self.assertEqual(finalize_upload("test-chunks", destination), len(data))
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(get_upload_path("test-chunks")))
+        self.assertEqual(get_received_ranges("test-chunks"), [])
+
+        # Uploads with missing data cannot be finalized
+        self.assertFalse(write_chunk("test-gap", SimpleUploadedFile("a", b"abc"), 0, 0, 2))
+        self.assertTrue(write_chunk("test-gap", SimpleUploadedFile("a", b"abc"), 1, 10, 2))
+        with self.assertRaises(ValueError):
+            finalize_upload("test-gap", destination)
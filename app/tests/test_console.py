@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import threading
+from django.test import TestCase
+from app.classes.console import Console, INDEX_ENTRY_SIZE
+from webodm import settings
+
+
+class TestConsole(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(dir=settings.MEDIA_TMP)
+        os.makedirs(os.path.join(self.tmpdir, "data"))
+        self.console = Console(os.path.join(self.tmpdir, "data", "console_output.txt"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def assertMatchesOutput(self, console):
+        output = console.output()
+        self.assertEqual(console.lines_count(), len(output.split("\n")) if output else 0)
+
+        lines = output.rstrip().split("\n")
+        self.assertEqual(console.read_lines(), (lines, len(lines)))
+        for start in range(len(lines) + 2):
+            self.assertEqual(console.read_lines(start, start + 2), (lines[start:start + 2], len(lines)))
+        self.assertEqual(console.read_lines(1, last=2), (lines[max(min(1, len(lines)), len(lines) - 2):], len(lines)))
+
+    def test_console(self):
+        c = self.console
+
+        # Missing file
+        self.assertEqual(c.lines_count(), 0)
+        self.assertEqual(c.read_lines(), ([""], 1))
+
+        c.reset()
+        self.assertMatchesOutput(c)
+
+        c += "line1\nline2"
+        c += " continued\nline3\n"
+        self.assertTrue(os.path.isfile(c.index_file))
+        self.assertEqual(c.lines_count(), 4)
+        self.assertEqual(c.read_lines(1, 2), (["line2 continued"], 3))
+        self.assertMatchesOutput(c)
+
+        c += "ünicode\n\n \n"
+        self.assertMatchesOutput(c)
+
+        # Lines appended without updating the index are still found
+        with open(c.file, "a", encoding="utf-8") as f:
+            f.write("line5\nline6\n")
+        self.assertEqual(c.read_lines(last=1), (["line6"], 8))
+        self.assertMatchesOutput(c)
+
+        # Index is rebuilt when missing
+        c.remove_index()
+        self.assertMatchesOutput(c)
+        c += "line7\n"
+        self.assertMatchesOutput(c)
+
+        # Reset
+        c.reset("a\nb\nc")
+        self.assertEqual(c.read_lines(), (["a", "b", "c"], 3))
+        self.assertMatchesOutput(c)
+
+        # Link
+        task_output = os.path.join(self.tmpdir, "task_output.txt")
+        with open(task_output, "w", encoding="utf-8") as f:
+            f.write("linked1\nlinked2\nlinked3\nlinked4\n")
+        c.link(task_output)
+        self.assertEqual(c.read_lines(2), (["linked3", "linked4"], 4))
+        self.assertMatchesOutput(c)
+
+        c.delink()
+        self.assertMatchesOutput(c)
+
+        # Windows line endings
+        c.reset("\r\naé\r\nb\r\n")
+        self.assertEqual(c.read_lines(0, 1), ([""], 3))
+        self.assertEqual(c.read_lines(1, 2), (["aé"], 3))
+        self.assertEqual(c.read_lines(), (["", "aé", "b"], 3))
+
+        # Concurrent writers
+        c.reset()
+        threads = [threading.Thread(target=lambda: [c.append("line\n") for i in range(50)]) for t in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(c.read_lines(last=1), (["line"], 200))
+        self.assertEqual(os.path.getsize(c.index_file), 200 * INDEX_ENTRY_SIZE)
+        self.assertMatchesOutput(c)
+
+        # Stale index (file replaced with a shorter one)
+        with open(c.file, "w", encoding="utf-8") as f:
+            f.write("x\n")
+        self.assertEqual(c.read_lines(), (["x"], 1))
+        self.assertMatchesOutput(c)
@@ -1,6 +1,10 @@
 import re
+import numpy as np
+import numexpr as ne
+from concurrent.futures import ThreadPoolExecutor
 from django.test import TestCase
-from app.api.formulas import lookup_formula, get_algorithm_list, get_camera_filters_for, algos, get_auto_bands
+from app.api.formulas import lookup_formula, get_algorithm_list, get_camera_filters_for, algos, get_auto_bands, \
+    compile_expression
 
 class TestFormulas(TestCase):
     def setUp(self):
@@ -25,6 +29,47 @@ class TestFormulas(TestCase):
         self.assertTrue(lookup_formula("_TESTFUNC", "RGB")[0] == "b1+(sqrt(b3))")
         self.assertTrue(lookup_formula("_TESTFUNC", "RGB")[1] == None)
 
+    def test_compile_expression(self):
+        c = compile_expression("(b4-b1)/(b4+b1)")
+        self.assertEqual(c.indexes, (1, 4))
+        self.assertEqual(c.count, 1)
+
+        # Compiled expressions are cached
+        self.assertTrue(compile_expression("(b4-b1)/(b4+b1)") is c)
+
+        data = np.random.default_rng(0).integers(1, 255, (2, 16, 16)).astype(np.uint8)
+        res = c.evaluate(data)
+        self.assertEqual(res.dtype, np.float32)
+        self.assertEqual(res.shape, (1, 16, 16))
+        b1, b4 = data.astype(np.float32)
+        self.assertTrue(np.allclose(res[0], ne.evaluate("(b4-b1)/(b4+b1)")))
+
+        # Multiple bands, written to an existing buffer
+        c = compile_expression("b3,b2*2,sqrt(b1)")
+        self.assertEqual(c.indexes, (1, 2, 3))
+        out = np.empty((3, 16, 16), dtype=np.float32)
+        data = np.random.default_rng(1).random((3, 16, 16)).astype(np.float32)
+        self.assertTrue(c.evaluate(data, out=out) is out)
+        self.assertTrue(np.allclose(out, [data[2], data[1] * 2, np.sqrt(data[0])]))
+
+        # Can evaluate from multiple threads at the same time
+        inputs = [np.random.default_rng(i).random((3, 256, 256)).astype(np.float32) for i in range(8)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(c.evaluate, inputs))
+        for data, res in zip(inputs, results):
+            self.assertTrue(np.allclose(res, [data[2], data[1] * 2, np.sqrt(data[0])]))
+
+        # Every formula compiles
+        for algo in algos:
+            if 'expr' in algos[algo]:
+                expr, _ = lookup_formula(algo, "RGBNReL")
+                self.assertTrue(compile_expression(expr).count >= 1)
+
+        # Invalid expressions
+        self.assertRaises(ValueError, compile_expression, "b1+")
+        self.assertRaises(ValueError, compile_expression, "b1+x")
+        self.assertRaises(ValueError, compile_expression, "__import__('os')")
+
     def test_algo_list(self):
         al = get_algorithm_list()
 
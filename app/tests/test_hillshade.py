@@ -0,0 +1,76 @@
+import os
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from django.test import TestCase
+from app.api.hillshade import LightSource, hillshade, hillshade_blend
+from app.api.hsvblend import hsv_blend
+from app.cogeo import valid_cogeo
+from app.raster_utils import generate_hillshade, get_precomputed_hillshade, get_hillshade_path
+from webodm import settings
+
+
+class TestHillshade(TestCase):
+    def setUp(self):
+        x = np.linspace(0, 10, 64)
+        self.elevation = (np.sin(x)[np.newaxis, :] * np.cos(x)[:, np.newaxis] * 30 + 150).astype(np.float32)
+
+    def test_hillshade(self):
+        for vert_exag in [1, 6]:
+            expected = LightSource(azdeg=315, altdeg=45).hillshade(self.elevation, dx=0.1, dy=-0.1, vert_exag=vert_exag)
+            intensity = hillshade(self.elevation, dx=0.1, dy=-0.1, vert_exag=vert_exag)
+            self.assertEqual(intensity.dtype, np.float32)
+            self.assertTrue(np.allclose(expected, intensity, atol=1e-3))
+
+        # Multi-directional
+        intensity = hillshade(self.elevation, dx=0.1, dy=-0.1, vert_exag=6, multidirectional=True)
+        self.assertTrue(np.all(intensity >= 0) and np.all(intensity <= 1))
+
+        # Flat areas are lit the same in both modes
+        flat = np.full((8, 8), 100, dtype=np.float32)
+        self.assertTrue(np.allclose(hillshade(flat), np.sin(np.radians(45))))
+        self.assertTrue(np.allclose(hillshade(flat, multidirectional=True), np.sin(np.radians(45))))
+
+    def test_blend(self):
+        rng = np.random.default_rng(0)
+        rgb = rng.integers(0, 256, (3, 32, 32)).astype(np.uint8)
+        rgb[:, 0:4, 0:4] = 0
+        intensity = rng.random((32, 32)).astype(np.float32)
+
+        expected = hsv_blend(rgb, intensity * 255.0)
+        blended = hillshade_blend(rgb, intensity)
+        self.assertEqual(blended.dtype, np.uint8)
+        self.assertTrue(np.abs(expected.astype(np.int16) - blended.astype(np.int16)).max() <= 1)
+
+    def test_precomputed_hillshade(self):
+        d = tempfile.mkdtemp(dir=settings.MEDIA_TMP)
+        dem_path = os.path.join(d, "dsm.tif")
+        elevation = np.tile(self.elevation, (10, 10))
+        with rasterio.open(dem_path, 'w', driver='GTiff', width=elevation.shape[1], height=elevation.shape[0],
+                           count=1, dtype=rasterio.float32, crs='EPSG:32615', nodata=-9999,
+                           transform=from_origin(576000, 5188000, 0.1, 0.1)) as dst:
+            dst.write(elevation, 1)
+
+        hillshade_path = generate_hillshade(dem_path, vert_exag=6)
+        self.assertEqual(hillshade_path, get_hillshade_path(dem_path))
+        self.assertTrue(valid_cogeo(hillshade_path))
+
+        with rasterio.open(hillshade_path) as src:
+            self.assertEqual(src.count, 1)
+            self.assertEqual(src.dtypes[0], 'uint8')
+            self.assertEqual((src.width, src.height), (elevation.shape[1], elevation.shape[0]))
+            self.assertTrue(len(src.overviews(1)) > 0)
+
+        # Only used when enabled and parameters match
+        enabled = settings.HILLSHADE_PRECOMPUTE
+        try:
+            settings.HILLSHADE_PRECOMPUTE = False
+            self.assertIsNone(get_precomputed_hillshade(dem_path, 6))
+
+            settings.HILLSHADE_PRECOMPUTE = True
+            self.assertEqual(get_precomputed_hillshade(dem_path, 6), hillshade_path)
+            self.assertIsNone(get_precomputed_hillshade(dem_path, 2))
+            self.assertIsNone(get_precomputed_hillshade(dem_path, 6, 'multidirectional'))
+        finally:
+            settings.HILLSHADE_PRECOMPUTE = enabled
@@ -0,0 +1,85 @@
+import time
+
+from django.contrib.auth.models import User
+
+from app.models import Project, Task
+from app.processing_stats import record_stages, get_stage_times, clear_stages, record_task_processing, \
+    get_task_eta
+from app.tests.classes import BootTestCase
+from nodeodm import status_codes
+from nodeodm.models import ProcessingNode
+
+
+class TestProcessingStats(BootTestCase):
+    def test_stages(self):
+        clear_stages("test")
+        self.assertEqual(get_stage_times("test"), {})
+
+        record_stages("test", ["[INFO]    Initializing ODM", "[INFO]    Running dataset stage", "[INFO]    Finished dataset stage"])
+        time.sleep(0.1)
+        record_stages("test", ["[INFO]    Running opensfm stage"])
+        record_stages("test", ["[INFO]    Running dataset stage"]) # Ignored, already started
+
+        stages = get_stage_times("test", end_time=time.time() + 10)
+        self.assertEqual(list(stages.keys()), ["dataset", "opensfm"])
+        self.assertTrue(0.1 <= stages["dataset"] < 1)
+        self.assertTrue(stages["opensfm"] >= 10)
+
+        clear_stages("test")
+        self.assertEqual(get_stage_times("test"), {})
+
+    def test_predictions(self):
+        project = Project.objects.get(owner=User.objects.get(username="testuser"))
+        node = ProcessingNode.objects.create(hostname="invalid-host", port=11223)
+        options = [{'name': 'fast-orthophoto', 'value': True}]
+
+        # Nothing to predict without history
+        self.assertTrue(node.get_throughput() is None)
+        self.assertTrue(node.predict_processing_time(100) is None)
+
+        task = Task.objects.create(project=project, processing_node=node, images_count=100, options=options)
+        self.assertEqual(get_task_eta(task), {'predicted_processing_time': None, 'eta': None})
+
+        # Completed tasks are recorded (100 images / hour)
+        task.processing_time = 3600 * 1000
+        task.status = status_codes.COMPLETED
+        task.save()
+        record_task_processing(task)
+
+        throughput = node.get_throughput()
+        self.assertEqual(throughput['tasks'], 1)
+        self.assertAlmostEqual(throughput['images_per_hour'], 100)
+        self.assertAlmostEqual(node.predict_processing_time(50), 1800)
+
+        # Partial runs are not
+        task.options = options + [{'name': 'rerun-from', 'value': 'odm_meshing'}]
+        record_task_processing(task)
+        self.assertEqual(node.get_throughput()['tasks'], 1)
+
+        # Statistics are kept per set of options (400 images / hour)
+        node.record_processing(100, 900, [{'name': 'pc-quality', 'value': 'lowest'}], stage_times={'dataset': 90, 'opensfm': 810})
+        self.assertAlmostEqual(node.predict_processing_time(100, options), 3600)
+        self.assertAlmostEqual(node.predict_processing_time(100, [{'name': 'pc-quality', 'value': 'lowest'}]), 900)
+        self.assertAlmostEqual(node.get_throughput([{'name': 'pc-quality', 'value': 'lowest'}])['stages']['opensfm'], 0.9)
+
+        # All tasks of the node are used for unknown options
+        self.assertAlmostEqual(node.get_throughput([{'name': 'unknown', 'value': 1}])['images_per_hour'], 200 / 4500 * 3600)
+
+        # ETA of running tasks
+        running = Task.objects.create(project=project, processing_node=node, images_count=100, options=options,
+                                      status=status_codes.RUNNING, processing_time=600 * 1000)
+        eta = get_task_eta(running)
+        self.assertAlmostEqual(eta['predicted_processing_time'], 3600)
+        self.assertAlmostEqual(eta['eta'], 3000)
+
+        # Queued tasks wait for the tasks ahead of them
+        queued = Task.objects.create(project=project, processing_node=node, images_count=100, options=options,
+                                     status=status_codes.QUEUED)
+        self.assertAlmostEqual(get_task_eta(queued)['eta'], 3000 + 3600)
+
+        node.max_parallel_tasks = 2
+        node.save()
+        self.assertAlmostEqual(get_task_eta(queued)['eta'], 1500 + 3600)
+
+        # Nothing to predict for completed tasks
+        self.assertTrue(get_task_eta(task)['eta'] is None)
@@ -1,9 +1,13 @@
+import os
+import time
+
 from django.contrib.auth.models import User, Group
 from rest_framework import status
 from rest_framework.test import APIClient
 from app.models import Task, Project
 from nodeodm.models import ProcessingNode
-from worker.tasks import check_quotas
+from worker.tasks import check_quotas, reconcile_disk_usage
+from app.models.profile import reconcile_used_spaces
 from .classes import BootTestCase
 
 class TestQuota(BootTestCase):
@@ -85,4 +89,102 @@ class TestQuota(BootTestCase):
         check_quotas()
         tasks = Task.objects.filter(project__owner=user)
         self.assertEqual(len(tasks), 1)
-        self.assertEqual(tasks[0].name, "Test")
\ No newline at end of file
+        self.assertEqual(tasks[0].name, "Test")
+
+    def test_used_space(self):
+        user = User.objects.get(username="testuser")
+        user2 = User.objects.get(username="testuser2")
+        p = Project.objects.create(owner=user, name='Test')
+        p2 = Project.objects.create(owner=user2, name='Test2')
+        self.assertEqual(user.profile.used_quota(), 0)
+
+        # Disk usage follows task sizes
+        t = Task.objects.create(project=p, name='Test', size=100)
+        t2 = Task.objects.create(project=p, name='Test2', size=10)
+        self.assertEqual(user.profile.used_quota(), 110)
+
+        t.size = 50
+        t.save()
+        self.assertEqual(user.profile.used_quota(), 60)
+
+        # Loading tasks doesn't look up their projects or owners
+        with self.assertNumQueries(1):
+            self.assertEqual(len(list(Task.objects.filter(project=p))), 2)
+        with self.assertNumQueries(1):
+            Task.objects.only('id', 'project_id', 'status').get(pk=t.id)
+
+        # Tasks that move to another user's project
+        t2.project = p2
+        t2.save()
+        self.assertEqual(user.profile.used_quota(), 50)
+        self.assertEqual(user2.profile.used_quota(), 10)
+
+        # Projects that change owner
+        p2.owner = user
+        p2.save()
+        self.assertEqual(user.profile.used_quota(), 60)
+        self.assertEqual(user2.profile.used_quota(), 0)
+
+        # Deleted tasks
+        Task.objects.get(pk=t2.id).delete()
+        self.assertEqual(user.profile.used_quota(), 50)
+
+        # Duplicated tasks
+        t3 = t.duplicate()
+        self.assertEqual(user.profile.used_quota(), 100)
+        t3.delete()
+
+        # Drift is fixed by reconciliation
+        Task.objects.filter(pk=t.id).update(size=70)
+        self.assertEqual(user.profile.used_quota(), 50)
+        self.assertEqual(reconcile_used_spaces(), 1)
+        self.assertEqual(user.profile.used_quota(), 70)
+        self.assertEqual(reconcile_used_spaces(), 0)
+
+    def test_size_ledger(self):
+        user = User.objects.get(username="testuser")
+        p = Project.objects.create(owner=user, name='Test')
+        t = Task.objects.create(project=p, name='Test')
+        t.create_task_directories()
+
+        def write(path, size):
+            with open(t.task_path(path), 'wb') as f:
+                f.write(b'\0' * size)
+
+        write("image.jpg", 1024 * 1024)
+        os.makedirs(t.task_path("assets", "entwine_pointcloud"), exist_ok=True)
+        write(os.path.join("assets", "orthophoto.tif"), 2 * 1024 * 1024)
+        write(os.path.join("assets", "entwine_pointcloud", "ept.json"), 1024 * 1024)
+
+        t.update_size(commit=True)
+        self.assertEqual(t.size, 4)
+        self.assertEqual(t.size_ledger[os.path.join("assets", "entwine_pointcloud")]['bytes'], 1024 * 1024)
+        self.assertEqual(t.size_ledger["assets"]['bytes'], 2 * 1024 * 1024)
+        self.assertEqual(user.profile.used_quota(), 4)
+        self.assertEqual(t.get_changed_size_components(), [])
+
+        # Only the components that changed are scanned
+        write(os.path.join("assets", "entwine_pointcloud", "ept-data.bin"), 1024 * 1024)
+        write("image2.jpg", 1024 * 1024)
+        t.update_size(commit=True, components=[os.path.join("assets", "entwine_pointcloud")])
+        self.assertEqual(t.size, 5)
+
+        # Changes made behind our back are found and fixed by reconciliation
+        os.utime(t.task_path(), (time.time() + 10, time.time() + 10))
+        self.assertEqual(t.get_changed_size_components(), [''])
+        reconcile_disk_usage()
+        t.refresh_from_db()
+        self.assertEqual(t.size, 6)
+        self.assertEqual(user.profile.used_quota(), 6)
+
+        # Including changes in nested directories
+        os.utime(t.task_path())
+        os.makedirs(t.task_path("assets", "odm_orthophoto"), exist_ok=True)
+        t.update_size(commit=True)
+        self.assertEqual(t.get_changed_size_components(), [])
+        time.sleep(0.01)
+        write(os.path.join("assets", "odm_orthophoto", "odm_orthophoto.tif"), 1024 * 1024)
+        self.assertEqual(t.get_changed_size_components(), ["assets"])
+        reconcile_disk_usage()
+        t.refresh_from_db()
+        self.assertEqual(t.size, 7)
@@ -0,0 +1,62 @@
+import os
+import shutil
+import time
+
+from django.test import TestCase
+from app.raster_pool import RasterPool
+from webodm import settings
+
+
+class TestRasterPool(TestCase):
+    def setUp(self):
+        self.raster = os.path.join(settings.MEDIA_TMP, "test_raster_pool.tif")
+        os.makedirs(settings.MEDIA_TMP, exist_ok=True)
+        shutil.copy(os.path.join("app", "fixtures", "orthophoto.tif"), self.raster)
+
+    def tearDown(self):
+        if os.path.isfile(self.raster):
+            os.unlink(self.raster)
+
+    def test_pool(self):
+        pool = RasterPool(max_idle=2, idle_timeout=60)
+
+        with pool.open(self.raster) as src:
+            first = src
+            self.assertTrue(src.dataset.count > 0)
+
+        # Handle is returned to the pool and reused
+        self.assertEqual(len(pool), 1)
+        with pool.open(self.raster) as src:
+            self.assertIs(src, first)
+
+            # Concurrent users get their own handle
+            self.assertEqual(len(pool), 0)
+            with pool.open(self.raster) as src2:
+                self.assertIsNot(src2, first)
+
+        self.assertEqual(len(pool), 2)
+
+        # Modified files are not served from stale handles
+        st = os.stat(self.raster)
+        os.utime(self.raster, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        with pool.open(self.raster) as src:
+            self.assertIsNot(src, first)
+
+        # Stale handles were dropped
+        self.assertEqual(len(pool), 1)
+
+        # Idle handles expire
+        pool.idle_timeout = 0
+        time.sleep(0.01)
+        with pool.open(self.raster) as src:
+            pass
+        self.assertEqual(len(pool), 1)
+
+        pool.invalidate(self.raster)
+        self.assertEqual(len(pool), 0)
+
+        # Pooling can be disabled
+        pool = RasterPool(max_idle=0)
+        with pool.open(self.raster) as src:
+            pass
+        self.assertEqual(len(pool), 0)
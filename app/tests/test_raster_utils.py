@@ -0,0 +1,77 @@
+import os
+import tempfile
+import hashlib
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from django.test import TestCase
+from app.raster_utils import export_raster, process_windows, compute_subwindows
+from rasterio.windows import Window
+from webodm import settings
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class TestRasterUtils(TestCase):
+    def test_process_windows(self):
+        orthophoto = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "fixtures", "orthophoto.tif"))
+        windows = compute_subwindows(Window(0, 0, 1000, 700), 128)
+        out = np.zeros((700, 1000), dtype=np.int64)
+        order = []
+
+        def write(idx, res):
+            order.append(idx)
+            dst_w, value = res
+            out[int(dst_w.row_off):int(dst_w.row_off + dst_w.height), int(dst_w.col_off):int(dst_w.col_off + dst_w.width)] = value
+
+        for threads in [1, 4]:
+            out.fill(0)
+            order.clear()
+            process_windows(orthophoto, None, windows, lambda src, w: int(w.col_off),
+                            lambda w, dst_w, data: (dst_w, data + 1), write, threads=threads)
+
+            # Results are written in order
+            self.assertEqual(order, list(range(len(windows))))
+            self.assertFalse((out == 0).any())
+
+        # Errors are propagated
+        def fail(w, dst_w, data):
+            raise ValueError("fail")
+
+        with self.assertRaises(ValueError):
+            process_windows(orthophoto, None, windows, lambda src, w: None, fail, lambda idx, res: None, threads=4)
+
+    def test_parallel_export(self):
+        d = tempfile.mkdtemp(dir=settings.MEDIA_TMP)
+        orthophoto = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "fixtures", "orthophoto.tif"))
+
+        dem = os.path.join(d, "dsm.tif")
+        x = np.linspace(0, 20, 1200)
+        elevation = (np.sin(x)[np.newaxis, :] * np.cos(x)[:, np.newaxis] * 30 + 150).astype(np.float32)
+        elevation[:100, :100] = -9999
+        with rasterio.open(dem, 'w', driver='GTiff', width=1200, height=1200, count=1, dtype=rasterio.float32,
+                           crs='EPSG:32615', nodata=-9999, tiled=True, blockxsize=256, blockysize=256,
+                           transform=from_origin(576000, 5188000, 0.1, 0.1)) as dst:
+            dst.write(elevation, 1)
+
+        exports = [
+            (orthophoto, dict(asset_type='orthophoto', format='gtiff')),
+            (orthophoto, dict(asset_type='orthophoto', format='gtiff-rgb')),
+            (orthophoto, dict(asset_type='orthophoto', format='gtiff', expression='(b2-b1)/(b2+b1)')),
+            (orthophoto, dict(asset_type='orthophoto', format='gtiff-rgb', expression='(b2-b1)/(b2+b1)', color_map='rdylgn', rescale=[-1, 1])),
+            (dem, dict(asset_type='dsm', format='gtiff')),
+            (dem, dict(asset_type='dsm', format='gtiff-rgb', color_map='viridis', hillshade=6)),
+        ]
+
+        for input, opts in exports:
+            hashes = set()
+            for threads in [1, 4]:
+                output = os.path.join(d, "export-{}.tif".format(threads))
+                export_raster(input, output, threads=threads, **opts)
+                hashes.add(file_hash(output))
+
+            # Parallel exports are identical to serial exports
+            self.assertEqual(len(hashes), 1, opts)
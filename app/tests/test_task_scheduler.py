@@ -0,0 +1,64 @@
+import time
+
+from django.test import TestCase
+from app.task_scheduler import schedule_task, wake_task, unschedule_task, reschedule_task, claim_due_tasks, \
+    sync_schedule, get_task_scheduler_stats, redis_client, SCHEDULE_KEY, INTERVALS_KEY
+from webodm import settings
+
+
+class TestTaskScheduler(TestCase):
+    def setUp(self):
+        redis_client.delete(SCHEDULE_KEY, INTERVALS_KEY)
+
+        self.intervals = (settings.TASK_CHECK_INTERVAL, settings.TASK_CHECK_MAX_INTERVAL, settings.TASK_CHECK_BACKOFF)
+        settings.TASK_CHECK_INTERVAL = 5
+        settings.TASK_CHECK_MAX_INTERVAL = 60
+        settings.TASK_CHECK_BACKOFF = 2
+
+    def tearDown(self):
+        redis_client.delete(SCHEDULE_KEY, INTERVALS_KEY)
+        settings.TASK_CHECK_INTERVAL, settings.TASK_CHECK_MAX_INTERVAL, settings.TASK_CHECK_BACKOFF = self.intervals
+
+    def test_scheduler(self):
+        schedule_task("a")
+        schedule_task("b", delay=100)
+        self.assertEqual(get_task_scheduler_stats()['queued'], 2)
+        self.assertEqual(get_task_scheduler_stats()['due'], 1)
+
+        # Only due tasks are dispatched, and only once
+        self.assertEqual(claim_due_tasks(), ["a"])
+        self.assertEqual(claim_due_tasks(), [])
+        self.assertEqual(get_task_scheduler_stats()['due'], 0)
+
+        # Tasks that don't change are checked less often
+        self.assertEqual(reschedule_task("a", changed=False), 5)
+        self.assertEqual(reschedule_task("a", changed=False), 10)
+        self.assertEqual(reschedule_task("a", changed=False), 20)
+        self.assertEqual(reschedule_task("a", changed=False), 40)
+        self.assertEqual(reschedule_task("a", changed=False), 60)
+        self.assertEqual(reschedule_task("a", changed=False), 60)
+
+        # Until something changes
+        self.assertEqual(reschedule_task("a", changed=True), 5)
+        self.assertEqual(reschedule_task("a", changed=False), 10)
+
+        # Waking up a task makes it due right away
+        wake_task("b")
+        self.assertEqual(claim_due_tasks(), ["b"])
+        self.assertEqual(reschedule_task("b", changed=False), 5)
+
+        # Lag is measured
+        redis_client.zadd(SCHEDULE_KEY, {"c": time.time() - 10})
+        stats = get_task_scheduler_stats()
+        self.assertEqual(stats['due'], 1)
+        self.assertTrue(stats['lag'] >= 10)
+        self.assertEqual(claim_due_tasks(), ["c"])
+        self.assertTrue(get_task_scheduler_stats()['last_dispatch_lag'] >= 10)
+
+        unschedule_task("c")
+        self.assertEqual(get_task_scheduler_stats()['queued'], 2)
+
+        # Sync adds missing tasks and removes stale ones
+        self.assertEqual(sync_schedule(["a", "d"]), (1, 1))
+        self.assertEqual(claim_due_tasks(), ["d"])
+        self.assertEqual(get_task_scheduler_stats()['queued'], 2)
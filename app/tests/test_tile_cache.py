@@ -0,0 +1,64 @@
+import os
+import time
+
+from django.test import TestCase
+from app.tile_cache import get_tile_cache_key, get_cached_tile, put_cached_tile, clear_tile_cache, \
+    evict_tile_cache, get_tile_cache_dir, get_tile_cache_stats, reset_tile_cache_stats, get_tile_cache_path
+
+
+class TestTileCache(TestCase):
+    def setUp(self):
+        clear_tile_cache("test")
+        reset_tile_cache_stats()
+
+    def tearDown(self):
+        clear_tile_cache("test")
+
+    def test_tile_cache(self):
+        k1 = get_tile_cache_key(expr="b1+b3", rescale="0,1", ext=None)
+        k2 = get_tile_cache_key(ext=None, rescale="0,1", expr="b1+b3")
+        k3 = get_tile_cache_key(expr="b1+b3", rescale="0,2", ext=None)
+
+        # Keys are deterministic and parameter-aware
+        self.assertEqual(k1, k2)
+        self.assertNotEqual(k1, k3)
+
+        # Cache miss
+        self.assertIsNone(get_cached_tile("test", "orthophoto", 16, 1, 2, k1, ["jpg", "png"]))
+
+        put_cached_tile("test", "orthophoto", 16, 1, 2, k1, "png", b"tile")
+
+        # Cache hit (with the correct extension)
+        self.assertEqual(get_cached_tile("test", "orthophoto", 16, 1, 2, k1, ["jpg", "png"]), (b"tile", "png"))
+        self.assertIsNone(get_cached_tile("test", "orthophoto", 16, 1, 2, k3, ["jpg", "png"]))
+        self.assertIsNone(get_cached_tile("test", "dsm", 16, 1, 2, k1, ["jpg", "png"]))
+
+        stats = get_tile_cache_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+
+        # Can clear the cache for a task
+        clear_tile_cache("test")
+        self.assertFalse(os.path.isdir(get_tile_cache_dir("test")))
+        self.assertIsNone(get_cached_tile("test", "orthophoto", 16, 1, 2, k1, ["png"]))
+
+    def test_eviction(self):
+        data = b"0" * 1024 * 512
+        for y in range(4):
+            put_cached_tile("test", "orthophoto", 16, 1, y, "key", "png", data)
+            p = get_tile_cache_path("test", "orthophoto", 16, 1, y, "key", "png")
+            t = time.time() - (10 - y) * 60
+            os.utime(p, (t, t))
+
+        # Touching a tile makes it recently used
+        get_cached_tile("test", "orthophoto", 16, 1, 0, "key", ["png"])
+
+        # Fits within budget
+        self.assertEqual(evict_tile_cache(max_size=100), 0)
+
+        # Least recently used tiles are evicted first
+        self.assertEqual(evict_tile_cache(max_size=1.5), 2)
+        self.assertTrue(os.path.isfile(get_tile_cache_path("test", "orthophoto", 16, 1, 0, "key", "png")))
+        self.assertFalse(os.path.isfile(get_tile_cache_path("test", "orthophoto", 16, 1, 1, "key", "png")))
+        self.assertFalse(os.path.isfile(get_tile_cache_path("test", "orthophoto", 16, 1, 2, "key", "png")))
+        self.assertTrue(os.path.isfile(get_tile_cache_path("test", "orthophoto", 16, 1, 3, "key", "png")))
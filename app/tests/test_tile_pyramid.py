@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+from django.test import TestCase
+from app.tile_pyramid import init_tile_archive, write_archive_tiles, get_archive_tiles, read_tile_archive, \
+    set_tile_archive_metadata, detect_tile_format
+from webodm import settings
+
+
+class TestTilePyramid(TestCase):
+    def test_tile_archive(self):
+        d = tempfile.mkdtemp(dir=settings.MEDIA_TMP)
+        path = os.path.join(d, "test.mbtiles")
+
+        conn = init_tile_archive(path)
+        set_tile_archive_metadata(conn, complete="0")
+        write_archive_tiles(conn, [(16, 1, 2, b'\x89PNG\r\n'), (16, 1, 3, b'\xff\xd8\xff\xe0')])
+        conn.commit()
+
+        # Tiles are stored in TMS scheme but addressed in XYZ scheme
+        self.assertEqual(get_archive_tiles(conn), {(16, 1, 2), (16, 1, 3)})
+        self.assertEqual(conn.execute("SELECT tile_row FROM tiles WHERE tile_column = 1 ORDER BY tile_row DESC").fetchone()[0], 2 ** 16 - 1 - 2)
+
+        data, complete = read_tile_archive(path, 16, 1, 2)
+        self.assertEqual(data, b'\x89PNG\r\n')
+        self.assertEqual(detect_tile_format(data), "png")
+        self.assertEqual(detect_tile_format(read_tile_archive(path, 16, 1, 3)[0]), "jpg")
+
+        # Missing tiles in incomplete archives are unknown
+        self.assertEqual(read_tile_archive(path, 16, 5, 5), (None, False))
+
+        # Missing tiles in complete archives are empty
+        set_tile_archive_metadata(conn, complete="1", minzoom=14, maxzoom=16)
+        conn.commit()
+        self.assertEqual(read_tile_archive(path, 16, 5, 5), (None, True))
+        self.assertEqual(read_tile_archive(path, 14, 5, 5), (None, True))
+
+        # Zoom levels outside of the archive are unknown
+        self.assertEqual(read_tile_archive(path, 17, 5, 5), (None, False))
+        self.assertEqual(read_tile_archive(path, 13, 5, 5), (None, False))
+
+        # Resuming keeps existing tiles
+        conn.close()
+        conn = init_tile_archive(path)
+        self.assertEqual(len(get_archive_tiles(conn)), 2)
+        conn.close()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from django.test import TestCase
+from app.zip_utils import extract_zip, get_corrupted_ranges
+from webodm import settings
+
+
+class TestZipUtils(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(dir=settings.MEDIA_TMP)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_extract_zip(self):
+        files = {}
+        for i in range(40):
+            files["dir{}/sub{}/file{}.txt".format(i % 3, i % 5, i)] = os.urandom(i * 1000) + b"x" * (i * 5000)
+        files["top.txt"] = b""
+
+        zip_path = os.path.join(self.tmpdir, "all.zip")
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            z.writestr("empty_dir/", b"")
+            for name, data in files.items():
+                z.writestr(name, data)
+
+        for threads in [1, 4]:
+            out_dir = os.path.join(self.tmpdir, "out{}".format(threads))
+            progress = []
+            extract_zip(zip_path, out_dir, threads=threads, progress_callback=progress.append)
+
+            self.assertTrue(os.path.isdir(os.path.join(out_dir, "empty_dir")))
+            for name, data in files.items():
+                with open(os.path.join(out_dir, name), "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+            self.assertEqual(progress, sorted(progress))
+            self.assertEqual(progress[-1], 1)
+
+        # Corrupted archives raise BadZipFile
+        with open(zip_path, "r+b") as f:
+            f.truncate(os.path.getsize(zip_path) // 2)
+
+        with self.assertRaises(zipfile.BadZipFile):
+            extract_zip(zip_path, os.path.join(self.tmpdir, "bad"), threads=4)
+
+    def test_get_corrupted_ranges(self):
+        zip_path = os.path.join(self.tmpdir, "all.zip")
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            for i in range(10):
+                z.writestr("file{}.bin".format(i), os.urandom(10000) + b"x" * 10000)
+
+        with zipfile.ZipFile(zip_path, "r") as z:
+            members = sorted(z.infolist(), key=lambda m: m.header_offset)
+            start_dir = z.start_dir
+
+        with open(zip_path, "rb") as f:
+            data = f.read()
+
+        def corrupt(offset):
+            with open(zip_path, "wb") as f:
+                f.write(data[:offset] + bytes([data[offset] ^ 0xFF]) + data[offset + 1:])
+
+        self.assertEqual(get_corrupted_ranges(zip_path), [])
+        self.assertEqual(get_corrupted_ranges(zip_path, check_crc=True), [])
+
+        # Corrupted member data is only found by checking CRCs
+        corrupt(members[3].header_offset + 100)
+        self.assertEqual(get_corrupted_ranges(zip_path), [])
+        self.assertEqual(get_corrupted_ranges(zip_path, check_crc=True), [(members[3].header_offset, members[4].header_offset)])
+
+        # Corrupted local headers (the central directory could be wrong too)
+        corrupt(members[5].header_offset + 31)
+        self.assertEqual(get_corrupted_ranges(zip_path), [(members[5].header_offset, members[6].header_offset), (start_dir, len(data))])
+
+        # Corrupted end of central directory
+        corrupt(len(data) - 22)
+        ranges = get_corrupted_ranges(zip_path)
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(ranges[0][1], len(data))
+        self.assertTrue(ranges[0][0] <= start_dir)
@@ -0,0 +1,221 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import redis
+from webodm import settings
+
+logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+HITS_KEY = 'tile_cache_hits'
+MISSES_KEY = 'tile_cache_misses'
+SIZE_KEY = 'tile_cache_size'
+
+# When evicting, shrink the cache to this fraction of
+# the maximum size so that we don't evict on every run
+EVICTION_TARGET_RATIO = 0.9
+
+
+def is_tile_cache_enabled():
+    return settings.TILE_CACHE_MAX_SIZE is not None and settings.TILE_CACHE_MAX_SIZE > 0
+
+
+def get_tile_cache_dir(task_id=None):
+    d = os.path.join(settings.MEDIA_CACHE, "tiles")
+    if task_id is not None:
+        d = os.path.join(d, str(task_id))
+    return d
+
+
+def get_tile_cache_key(**params):
+    """
+    Compute a key that uniquely identifies a rendered tile
+    :param params: all parameters that affect the output of a tile
+    :return: hex digest
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_geometry_hash(geom):
+    """
+    :param geom: a GEOSGeometry, a GeoJSON dict or None
+    :return: a short hash of the geometry (or None)
+    """
+    if geom is None:
+        return None
+
+    if isinstance(geom, dict):
+        s = json.dumps(geom, sort_keys=True)
+    else:
+        s = geom.wkt
+
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def get_tile_cache_path(task_id, tile_type, z, x, y, key, ext):
+    return os.path.join(get_tile_cache_dir(task_id), tile_type, str(z), "{}_{}_{}.{}".format(x, y, key, ext))
+
+
+def incr_counter(k):
+    try:
+        redis_client.incr(k)
+    except redis.exceptions.RedisError:
+        # Counters are informational only
+        pass
+
+
+def get_cached_tile(task_id, tile_type, z, x, y, key, exts):
+    """
+    Lookup a rendered tile from the cache
+    :param exts: list of candidate image extensions
+    :return: (tile bytes, ext) or None if the tile is not cached
+    """
+    if not is_tile_cache_enabled():
+        return None
+
+    for ext in exts:
+        p = get_tile_cache_path(task_id, tile_type, z, x, y, key, ext)
+        try:
+            with open(p, 'rb') as f:
+                data = f.read()
+
+            # Bump modified time, used for LRU eviction
+            os.utime(p, None)
+            incr_counter(HITS_KEY)
+            return data, ext
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Cannot read cached tile {}: {}".format(p, str(e)))
+
+    incr_counter(MISSES_KEY)
+    return None
+
+
+def put_cached_tile(task_id, tile_type, z, x, y, key, ext, data):
+    """
+    Store a rendered tile in the cache
+    """
+    if not is_tile_cache_enabled():
+        return
+
+    p = get_tile_cache_path(task_id, tile_type, z, x, y, key, ext)
+    d = os.path.dirname(p)
+    try:
+        os.makedirs(d, exist_ok=True)
+
+        # Write to a temporary file first so that concurrent
+        # readers never see partially written tiles
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=d)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, p)
+    except OSError as e:
+        logger.warning("Cannot write cached tile {}: {}".format(p, str(e)))
+
+
+def clear_tile_cache(task_id):
+    d = get_tile_cache_dir(task_id)
+    if os.path.isdir(d):
+        try:
+            shutil.rmtree(d)
+        except Exception as e:
+            logger.warning("Cannot clear tile cache {}: {}".format(d, str(e)))
+
+
+def scan_tile_cache():
+    """
+    :return: list of (mtime, size, path) for all cached tiles
+    """
+    entries = []
+    stack = [get_tile_cache_dir()]
+
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(e.path)
+                        elif e.is_file(follow_symlinks=False):
+                            st = e.stat(follow_symlinks=False)
+                            entries.append((st.st_mtime, st.st_size, e.path))
+                    except OSError:
+                        # File removed while scanning
+                        pass
+        except OSError:
+            pass
+
+    return entries
+
+
+def evict_tile_cache(max_size=None):
+    """
+    Remove the least recently used tiles until the cache
+    fits within the size budget
+    :param max_size: size budget in megabytes (defaults to settings.TILE_CACHE_MAX_SIZE)
+    :return: number of evicted tiles
+    """
+    if max_size is None:
+        max_size = settings.TILE_CACHE_MAX_SIZE if is_tile_cache_enabled() else 0
+
+    max_bytes = max_size * 1024 * 1024
+    entries = scan_tile_cache()
+    total_bytes = sum(e[1] for e in entries)
+    evicted = 0
+
+    if total_bytes > max_bytes:
+        target_bytes = max_bytes * EVICTION_TARGET_RATIO
+        entries.sort()
+
+        for mtime, size, path in entries:
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+                evicted += 1
+            except OSError:
+                pass
+
+        logger.info("Evicted {} tiles from tile cache".format(evicted))
+
+    try:
+        redis_client.set(SIZE_KEY, total_bytes)
+    except redis.exceptions.RedisError:
+        pass
+
+    return evicted
+
+
+def get_tile_cache_stats():
+    def get_int(k):
+        try:
+            v = redis_client.get(k)
+            return int(v) if v is not None else 0
+        except (redis.exceptions.RedisError, ValueError):
+            return 0
+
+    hits = get_int(HITS_KEY)
+    misses = get_int(MISSES_KEY)
+    total = hits + misses
+
+    return {
+        'enabled': is_tile_cache_enabled(),
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': (float(hits) / total) if total > 0 else 0,
+        'size': get_int(SIZE_KEY) / 1024 / 1024,
+        'max_size': settings.TILE_CACHE_MAX_SIZE,
+    }
+
+
+def reset_tile_cache_stats():
+    try:
+        redis_client.delete(HITS_KEY, MISSES_KEY)
+    except redis.exceptions.RedisError:
+        pass
@@ -0,0 +1,276 @@
+import os
+import glob
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from webodm import settings
+from app.tile_cache import get_tile_cache_key
+
+logger = logging.getLogger('app.logger')
+
+PYRAMID_TILESIZE = 256
+
+# Number of tiles rendered (and committed to the archive) per unit of work
+CHUNK_SIZE = 32
+
+
+def get_tile_pyramid_dir(task):
+    return task.task_path("tiles")
+
+
+def get_tile_pyramid_key(raster_path, params, tilesize):
+    """
+    Compute a key that uniquely identifies a pre-rendered tile pyramid
+    :param params: tile rendering parameters (see app.api.tiler.get_tile_params)
+    :param tilesize: size of the tiles in pixels
+    :return: hex digest or None if the parameters cannot be served from a pyramid
+    """
+    if params['crop'] or params['boundaries_feature'] is not None:
+        return None
+
+    try:
+        rescale = [float(v) for v in params['rescale'].split(",")] if params['rescale'] is not None else None
+    except ValueError:
+        return None
+
+    return get_tile_cache_key(raster_mtime=os.path.getmtime(raster_path),
+                              tilesize=tilesize,
+                              expr=params['expr'],
+                              rescale=rescale,
+                              color_map=params['color_map'],
+                              hillshade=params['hillshade'],
+                              hillshade_mode=params['hillshade_mode'])
+
+
+def get_tile_pyramid_path(task, tile_type, key):
+    return os.path.join(get_tile_pyramid_dir(task), "{}_{}.mbtiles".format(tile_type, key))
+
+
+def detect_tile_format(data):
+    if data[:3] == b'\xff\xd8\xff':
+        return "jpg"
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return "webp"
+    else:
+        return "png"
+
+
+def init_tile_archive(path):
+    """
+    Open (or create) an MBTiles archive for writing
+    :return: sqlite3 connection
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)")
+    conn.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+    conn.commit()
+    return conn
+
+
+def set_tile_archive_metadata(conn, **values):
+    conn.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                     [(k, str(v)) for k, v in values.items()])
+
+
+def write_archive_tiles(conn, tiles):
+    """
+    :param tiles: list of (z, x, y, data) in XYZ scheme
+    """
+    conn.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                     [(z, x, (2 ** z - 1) - y, data) for z, x, y, data in tiles])
+
+
+def get_archive_tiles(conn):
+    """
+    :return: set of (z, x, y) tiles (XYZ scheme) stored in the archive
+    """
+    return {(z, x, (2 ** z - 1) - row) for z, x, row in
+            conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles")}
+
+
+def read_tile_archive(path, z, x, y):
+    """
+    Read a tile from an MBTiles archive
+    :return: (tile bytes or None, whether the archive is complete for zoom level z)
+    """
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        row = conn.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                           (z, x, (2 ** z - 1) - y)).fetchone()
+        if row is not None:
+            return bytes(row[0]), True
+
+        metadata = dict(conn.execute("SELECT name, value FROM metadata WHERE name IN ('complete', 'minzoom', 'maxzoom')"))
+        if metadata.get('complete') != "1":
+            return None, False
+
+        # Zoom levels that were not rendered (e.g. overzoom levels) are unknown
+        try:
+            return None, int(metadata['minzoom']) <= z <= int(metadata['maxzoom'])
+        except (KeyError, ValueError):
+            return None, False
+    finally:
+        conn.close()
+
+
+def get_pyramid_tile(task, tile_type, raster_path, params, tilesize, z, x, y):
+    """
+    Lookup a tile from a pre-rendered tile pyramid
+    :return: (tile bytes, ext), False if the pyramid is complete and has no such
+        tile (the tile is empty) or None if the tile is not available (it's not
+        rendered yet or its zoom level is outside of the pyramid)
+    """
+    key = get_tile_pyramid_key(raster_path, params, tilesize)
+    if key is None:
+        return None
+
+    path = get_tile_pyramid_path(task, tile_type, key)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        data, complete = read_tile_archive(path, z, x, y)
+    except sqlite3.Error as e:
+        logger.warning("Cannot read tile pyramid {}: {}".format(path, str(e)))
+        return None
+
+    if data is not None:
+        return data, detect_tile_format(data)
+    elif complete:
+        return False
+    else:
+        return None
+
+
+def get_pyramid_zoom_levels(src, max_zoom=None):
+    from app.api.tiler import get_zoom_safe, ZOOM_EXTRA_LEVELS
+
+    minzoom, maxzoom = get_zoom_safe(src)
+    if max_zoom is not None:
+        maxzoom = min(maxzoom, max_zoom)
+    minzoom = max(0, minzoom - ZOOM_EXTRA_LEVELS)
+    return range(minzoom, max(minzoom, maxzoom) + 1)
+
+
+def write_tile_archive(input, output, tile_type, params, name=None, max_zoom=None, threads=None, progress_callback=None):
+    """
+    Render the tiles of a raster into an MBTiles archive. Writing is resumable:
+    tiles that are already in the archive are skipped.
+    :param input: path to the raster
+    :param output: path to the MBTiles archive
+    :param tile_type: one of orthophoto, dsm, dtm
+    :param params: tile rendering parameters (see app.api.tiler.get_tile_params),
+        crop must be applied to the input raster beforehand
+    :param name: name of the tileset
+    :param max_zoom: maximum zoom level to render (defaults to settings.TILE_PYRAMID_MAX_ZOOM)
+    :param threads: number of rendering threads (defaults to settings.TILE_PYRAMID_THREADS)
+    :param progress_callback: optional function(done, total) called as tiles are rendered
+    :return: number of tiles written
+    """
+    # Lazy import, the tiler depends on the worker
+    from app.api.tiler import render_tile
+    from rio_tiler.io import COGReader
+    from rest_framework import exceptions
+
+    if max_zoom is None:
+        max_zoom = settings.TILE_PYRAMID_MAX_ZOOM
+    if threads is None:
+        threads = settings.TILE_PYRAMID_THREADS
+    if threads is None or threads <= 0:
+        threads = os.cpu_count() or 1
+
+    with COGReader(input) as src:
+        zooms = get_pyramid_zoom_levels(src, max_zoom)
+        west, south, east, north = src.bounds
+        tiles = [(t.z, t.x, t.y) for t in src.tms.tiles(west, south, east, north, zooms)]
+
+    conn = init_tile_archive(output)
+    try:
+        set_tile_archive_metadata(conn, name=name if name is not None else tile_type,
+                                  format="png", type="baselayer", version="1.0.0",
+                                  bounds="{},{},{},{}".format(west, south, east, north),
+                                  minzoom=zooms[0], maxzoom=zooms[-1],
+                                  complete="0")
+        conn.commit()
+
+        done = get_archive_tiles(conn)
+        todo = [t for t in tiles if t not in done]
+        logger.info("Writing tile archive {} ({} of {} tiles left)".format(output, len(todo), len(tiles)))
+
+        def render_chunk(chunk):
+            result = []
+            with COGReader(input) as src:
+                for z, x, y in chunk:
+                    try:
+                        content, ext = render_tile(None, src, tile_type, z, x, y, params, PYRAMID_TILESIZE)
+                        result.append((z, x, y, content))
+                    except exceptions.NotFound:
+                        # Empty tile
+                        pass
+            return result
+
+        chunks = [todo[i:i + CHUNK_SIZE] for i in range(0, len(todo), CHUNK_SIZE)]
+        written = 0
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # Single writer: chunks are committed as soon as they are rendered,
+            # so that an interrupted run can be resumed
+            for idx, result in enumerate(executor.map(render_chunk, chunks)):
+                write_archive_tiles(conn, result)
+                conn.commit()
+                written += len(result)
+                if progress_callback is not None:
+                    progress_callback(min(len(todo), (idx + 1) * CHUNK_SIZE), len(todo))
+
+        set_tile_archive_metadata(conn, complete="1")
+        conn.commit()
+
+        # Fold the write-ahead log back into a single file
+        conn.execute("PRAGMA journal_mode=DELETE")
+        logger.info("Wrote tile archive {} ({} new tiles)".format(output, written))
+    finally:
+        conn.close()
+
+    return written
+
+
+def generate_tile_pyramid(task, tile_type, formula=None, bands=None, max_zoom=None, threads=None):
+    """
+    Pre-render the tiles of a task's raster (with default rendering parameters)
+    into an MBTiles archive that the tiler can serve from
+    :param formula: optional plant health formula (orthophoto only)
+    :param bands: optional band order for formula
+    :return: path to the archive
+    """
+    from app.api.tiler import get_tile_params, get_raster_path
+
+    raster_path = get_raster_path(task, tile_type)
+    if not os.path.isfile(raster_path):
+        raise FileNotFoundError("{} does not exist".format(raster_path))
+
+    query = {}
+    if formula is not None:
+        query['formula'] = formula
+        if bands is not None:
+            query['bands'] = bands
+    params = get_tile_params(task, tile_type, query)
+
+    key = get_tile_pyramid_key(raster_path, params, PYRAMID_TILESIZE)
+    path = get_tile_pyramid_path(task, tile_type, key)
+
+    write_tile_archive(raster_path, path, tile_type, params,
+                       name="{} {}".format(task, tile_type),
+                       max_zoom=max_zoom, threads=threads)
+    return path
+
+
+def clear_tile_pyramids(task):
+    for f in glob.glob(os.path.join(get_tile_pyramid_dir(task), "*.mbtiles*")):
+        try:
+            os.remove(f)
+        except OSError as e:
+            logger.warning("Cannot remove tile pyramid {}: {}".format(f, str(e)))
@@ -0,0 +1,224 @@
+import os
+import time
+import zlib
+import shutil
+import struct
+import zipfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def extract_zip(zip_path, dest_dir, threads=1, progress_callback=None):
+    """
+    Extract a zip archive, optionally decompressing multiple members in parallel.
+    It will raise a zipfile.BadZipFile exception if the archive is corrupted.
+    :param zip_path: path to the zip file
+    :param dest_dir: directory to extract to
+    :param threads: number of members to extract at the same time
+    :param progress_callback: function called with the fraction (0-1) of uncompressed bytes extracted
+    """
+    with zipfile.ZipFile(zip_path, "r") as zip_h:
+        members = zip_h.infolist()
+
+        if threads <= 1 or len(members) <= 1:
+            if progress_callback is None:
+                zip_h.extractall(dest_dir)
+            else:
+                total = max(1, sum(m.file_size for m in members))
+                extracted = 0
+                for m in members:
+                    zip_h.extract(m, dest_dir)
+                    extracted += m.file_size
+                    progress_callback(extracted / total)
+            return
+
+    # Each thread reads from its own handle. Larger members are started
+    # first so that a single large file doesn't end up being extracted last.
+    members.sort(key=lambda m: m.file_size, reverse=True)
+    total = max(1, sum(m.file_size for m in members))
+    extracted = 0
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def extract_member(m):
+        if not hasattr(local, 'zip_h'):
+            local.zip_h = zipfile.ZipFile(zip_path, "r")
+            with handles_lock:
+                handles.append(local.zip_h)
+
+        try:
+            local.zip_h.extract(m, dest_dir)
+        except FileExistsError:
+            # Another thread created the same parent directory
+            local.zip_h.extract(m, dest_dir)
+
+        return m.file_size
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    futures = [executor.submit(extract_member, m) for m in members]
+    try:
+        # Progress is reported from the calling thread
+        for f in as_completed(futures):
+            extracted += f.result()
+            if progress_callback is not None:
+                progress_callback(extracted / total)
+    finally:
+        for f in futures:
+            f.cancel()
+        executor.shutdown(wait=True)
+        for h in handles:
+            h.close()
+
+
+def deflate_file(path, tmp_dir, chunk_size=1024 * 1024):
+    """
+    Compress a file into a temporary file of raw deflate data, so that
+    members can be compressed in parallel and added with append_raw_member
+    :param path: file to compress
+    :param tmp_dir: directory where to write the compressed data
+    :return: dict with the path of the compressed data, the CRC and the sizes of the file
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.deflate', dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out, open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+    except:
+        os.remove(tmp_path)
+        raise
+
+    return {
+        'path': tmp_path,
+        'crc': crc,
+        'file_size': file_size,
+        'compress_size': os.path.getsize(tmp_path)
+    }
+
+
+def append_raw_member(zip_h, arcname, deflated, date_time=None):
+    """
+    Add a member to a zip archive (opened for writing) from data
+    that has been compressed with deflate_file
+    :param zip_h: zipfile.ZipFile
+    :param arcname: name of the member
+    :param deflated: result of deflate_file
+    :param date_time: modification time of the member (defaults to now)
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time=date_time or time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o644 << 16
+    zinfo.CRC = deflated['crc']
+    zinfo.file_size = deflated['file_size']
+    zinfo.compress_size = deflated['compress_size']
+
+    # Same as what zipfile does when closing a member written with ZipFile.open
+    zip_h._writecheck(zinfo)
+    zinfo.header_offset = zip_h.fp.tell()
+    zip_h.fp.write(zinfo.FileHeader())
+    with open(deflated['path'], 'rb') as f:
+        shutil.copyfileobj(f, zip_h.fp, 1024 * 1024)
+    zip_h.filelist.append(zinfo)
+    zip_h.NameToInfo[zinfo.filename] = zinfo
+    zip_h.start_dir = zip_h.fp.tell()
+
+
+def get_corrupted_ranges(zip_path, check_crc=False):
+    """
+    Find the parts of a zip archive that are corrupted, by checking
+    the central directory and the local header of each member.
+    :param zip_path: path to the zip file
+    :param check_crc: also decompress each member and verify its CRC (slow)
+    :return: list of (start, end) byte ranges (end exclusive). Empty if no corruption was found
+    """
+    size = os.path.getsize(zip_path)
+
+    try:
+        zip_h = zipfile.ZipFile(zip_path, "r")
+    except (zipfile.BadZipFile, OSError, EOFError):
+        # The end of central directory record or the central directory is damaged
+        return [(get_central_directory_offset(zip_path, size), size)]
+
+    ranges = []
+    central_directory_suspect = False
+    with zip_h, open(zip_path, "rb") as f:
+        members = sorted(zip_h.infolist(), key=lambda m: m.header_offset)
+
+        for i, m in enumerate(members):
+            start = m.header_offset
+            end = members[i + 1].header_offset if i + 1 < len(members) else zip_h.start_dir
+
+            f.seek(start)
+            header = f.read(zipfile.sizeFileHeader)
+            valid = len(header) == zipfile.sizeFileHeader and header[0:4] == zipfile.stringFileHeader
+            if valid:
+                filename_length = struct.unpack(zipfile.structFileHeader, header)[10] # file name length
+                filename = f.read(filename_length)
+                encoding = 'utf-8' if m.flag_bits & 0x800 else 'cp437'
+                valid = filename == m.orig_filename.encode(encoding, errors='replace')
+
+            if not valid:
+                # Either the local header or its central directory entry is wrong
+                central_directory_suspect = True
+
+            if valid and check_crc and not m.is_dir():
+                try:
+                    with zip_h.open(m) as member:
+                        while member.read(1024 * 1024):
+                            pass
+                except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError):
+                    valid = False
+
+            if not valid:
+                ranges.append((start, max(start + 1, end)))
+
+        if central_directory_suspect:
+            ranges.append((zip_h.start_dir, size))
+
+    return ranges
+
+
+def get_central_directory_offset(zip_path, size):
+    """
+    Best effort attempt at locating the start of the central directory
+    of a damaged zip archive
+    :return: byte offset (the offset of the end of central directory record
+        if the central directory cannot be located)
+    """
+    tail_size = min(size, zipfile.sizeEndCentDir + 0xFFFF)
+    with open(zip_path, "rb") as f:
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+
+    eocd = tail.rfind(zipfile.stringEndArchive)
+    if eocd == -1 or eocd + zipfile.sizeEndCentDir > len(tail):
+        return size - tail_size
+
+    eocd_offset = size - tail_size + eocd
+    cd_offset = struct.unpack(zipfile.structEndArchive, tail[eocd:eocd + zipfile.sizeEndCentDir])[6] # central directory offset
+
+    if cd_offset == 0xFFFFFFFF:
+        # ZIP64, the offset is in the ZIP64 end of central directory record
+        locator = eocd - zipfile.sizeEndCentDir64Locator
+        if locator >= 0 and tail[locator:locator + 4] == zipfile.stringEndArchive64Locator:
+            _, _, eocd64_offset, _ = struct.unpack(zipfile.structEndArchive64Locator, tail[locator:eocd])
+            eocd64 = eocd64_offset - (size - tail_size)
+            if 0 <= eocd64 and eocd64 + zipfile.sizeEndCentDir64 <= len(tail):
+                cd_offset = struct.unpack(zipfile.structEndArchive64, tail[eocd64:eocd64 + zipfile.sizeEndCentDir64])[9] # central directory offset
+            else:
+                return eocd_offset
+        else:
+            return eocd_offset
+
+    return cd_offset if cd_offset <= eocd_offset else eocd_offset
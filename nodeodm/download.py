@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pyodm import exceptions
+from urllib3.exceptions import ReadTimeoutError
+
+logger = logging.getLogger('app.logger')
+
+CHUNK_SIZE = 10 * 1024 * 1024
+
+# Number of times a chunk is requested before giving up
+CHUNK_RETRIES = 5
+
+
+def get_state_path(path):
+    return path + ".json"
+
+
+def read_state(path):
+    try:
+        with open(get_state_path(path), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_state(path, state):
+    # Write to a temporary file first, so that the state is never half written
+    tmp_path = get_state_path(path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, get_state_path(path))
+
+
+def remove_download(path):
+    """
+    Remove a download and its state
+    """
+    for p in [path, get_state_path(path)]:
+        if os.path.isfile(p):
+            os.unlink(p)
+
+
+def invalidate_download(path, ranges=None):
+    """
+    Mark parts of a download as corrupted, so that they are downloaded again
+    the next time the download is resumed.
+    :param path: path of the download
+    :param ranges: list of (start, end) byte ranges (end exclusive),
+        or None to download the entire file again
+    """
+    state = read_state(path)
+    if state is None or ranges is None:
+        remove_download(path)
+        return
+
+    chunk_size = state['chunk_size']
+    chunks = state['chunks']
+    for start, end in ranges:
+        for i in range(start // chunk_size, (max(start, end - 1) // chunk_size) + 1):
+            chunks.pop(str(i), None)
+
+    write_state(path, state)
+
+
+def chunk_hash(fd, offset, length):
+    h = hashlib.sha256()
+    read = 0
+    while read < length:
+        data = os.pread(fd, min(1024 * 1024, length - read), offset + read)
+        if not data:
+            break
+        h.update(data)
+        read += len(data)
+    return h.hexdigest()
+
+
+def download(session, url, path, progress_callback=None, parallel_downloads=16, timeout=None):
+    """
+    Download a file using HTTP range requests, resuming a previous download to the same path if possible.
+    Each chunk's checksum is stored along with the download, so that chunks that were not
+    completely written (e.g. because the worker was restarted) are downloaded again.
+    If the server doesn't support range requests, the file is downloaded from scratch.
+
+    :param session: requests.Session
+    :param url: URL of the file
+    :param path: destination path
+    :param progress_callback: optional function called with the download progress percentage
+    :param parallel_downloads: number of chunks to download at the same time
+    :return: path
+    """
+    def get(headers={}):
+        try:
+            res = session.get(url, stream=True, timeout=timeout, headers=headers)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            raise exceptions.NodeConnectionError(str(e))
+
+        if res.status_code == 401:
+            raise exceptions.NodeResponseError("Unauthorized. Do you need to set a token?")
+        elif not res.status_code in [200, 206]:
+            res.close()
+            raise exceptions.NodeServerError("Unexpected status code: %s" % res.status_code)
+        elif "application/json" in res.headers.get('content-type', ''):
+            # Errors are returned as JSON
+            try:
+                error = res.json().get('error', 'Unexpected response')
+            except (ValueError, AttributeError):
+                error = 'Unexpected response'
+            raise exceptions.NodeResponseError(error)
+        return res
+
+    res = get({'Range': 'bytes=0-0'})
+    content_range = res.headers.get('content-range', '')
+    if res.status_code != 206 or not content_range.startswith('bytes 0-0/') or content_range.endswith('/*'):
+        # No range support
+        logger.info("Range requests not supported, downloading {} in a single request".format(path))
+        remove_download(path)
+        with res:
+            content_length = res.headers.get('content-length')
+            total_length = int(content_length) if content_length is not None else None
+            downloaded = 0
+
+            try:
+                with open(path, 'wb') as f:
+                    for chunk in res.iter_content(1024 * 1024):
+                        downloaded += f.write(chunk)
+                        if progress_callback is not None and total_length:
+                            progress_callback(100.0 * downloaded / total_length)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, ReadTimeoutError) as e:
+                raise exceptions.NodeConnectionError(str(e))
+
+            if total_length is not None and downloaded != total_length:
+                raise exceptions.NodeConnectionError("Incomplete download ({} of {} bytes)".format(downloaded, total_length))
+        return path
+
+    res.close()
+    total_length = int(content_range.split('/')[1])
+
+    # The file on the server is identified by its URL (which includes the task UUID),
+    # size and validators (if any)
+    identity = {
+        'url': url,
+        'size': total_length,
+        'etag': res.headers.get('etag'),
+        'last_modified': res.headers.get('last-modified'),
+    }
+
+    state = read_state(path)
+    if state is None or state.get('identity') != identity or not os.path.isfile(path):
+        if state is not None:
+            logger.info("Remote file has changed, restarting download of {}".format(path))
+        state = {
+            'identity': identity,
+            'chunk_size': CHUNK_SIZE,
+            'chunks': {}
+        }
+        remove_download(path)
+
+    chunk_size = state['chunk_size']
+    num_chunks = max(1, (total_length + chunk_size - 1) // chunk_size)
+
+    def chunk_range(i):
+        start = i * chunk_size
+        return start, min(start + chunk_size, total_length)
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, total_length)
+
+        # Verify the chunks we already have
+        chunks = {}
+        for i, h in state['chunks'].items():
+            start, end = chunk_range(int(i))
+            if chunk_hash(fd, start, end - start) == h:
+                chunks[i] = h
+        if len(chunks) != len(state['chunks']):
+            logger.warning("{} chunks of {} failed verification and will be downloaded again".format(len(state['chunks']) - len(chunks), path))
+        if len(chunks) > 0:
+            logger.info("Resuming download of {} ({}/{} chunks)".format(path, len(chunks), num_chunks))
+        state['chunks'] = chunks
+        write_state(path, state)
+
+        def download_chunk(i):
+            start, end = chunk_range(i)
+            retry = 0
+
+            while True:
+                try:
+                    with get({'Range': 'bytes=%s-%s' % (start, end - 1)}) as res:
+                        if res.status_code != 206 or not res.headers.get('content-range', '').startswith('bytes %s-%s/' % (start, end - 1)):
+                            raise exceptions.NodeServerError("Range not available: %s-%s" % (start, end - 1))
+
+                        h = hashlib.sha256()
+                        offset = start
+                        try:
+                            for data in res.iter_content(1024 * 1024):
+                                if offset + len(data) > end:
+                                    raise exceptions.NodeServerError("Received more data than requested")
+                                os.pwrite(fd, data, offset)
+                                h.update(data)
+                                offset += len(data)
+                        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, ReadTimeoutError) as e:
+                            raise exceptions.NodeConnectionError(str(e))
+
+                        if offset != end:
+                            raise exceptions.NodeConnectionError("Incomplete chunk ({} of {} bytes)".format(offset - start, end - start))
+
+                        return i, h.hexdigest()
+                except exceptions.NodeConnectionError as e:
+                    if retry < CHUNK_RETRIES:
+                        retry += 1
+                        logger.warning("Cannot download chunk {} of {} ({}), retrying...".format(i, path, str(e)))
+                        time.sleep(retry * 2)
+                    else:
+                        raise e
+
+        missing = [i for i in range(num_chunks) if str(i) not in chunks]
+        completed = num_chunks - len(missing)
+        if progress_callback is not None:
+            progress_callback(100.0 * completed / num_chunks)
+
+        if len(missing) > 0:
+            executor = ThreadPoolExecutor(max_workers=max(1, min(parallel_downloads, len(missing))))
+            futures = [executor.submit(download_chunk, i) for i in missing]
+            try:
+                for f in as_completed(futures):
+                    i, h = f.result()
+
+                    # Completed chunks are kept across retries
+                    chunks[str(i)] = h
+                    write_state(path, state)
+
+                    completed += 1
+                    if progress_callback is not None:
+                        progress_callback(100.0 * completed / num_chunks)
+            finally:
+                for f in futures:
+                    f.cancel()
+                executor.shutdown(wait=True)
+    finally:
+        os.close(fd)
+
+    return path
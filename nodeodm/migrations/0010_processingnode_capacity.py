@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nodeodm', '0009_auto_20210610_1850'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingnode',
+            name='cpu_cores',
+            field=models.PositiveIntegerField(blank=True, help_text='Number of virtual CPU cores (as reported by the node itself)', null=True, verbose_name='CPU Cores'),
+        ),
+        migrations.AddField(
+            model_name='processingnode',
+            name='total_memory',
+            field=models.BigIntegerField(blank=True, help_text='Amount of total RAM in bytes (as reported by the node itself)', null=True, verbose_name='Total Memory'),
+        ),
+        migrations.AddField(
+            model_name='processingnode',
+            name='max_parallel_tasks',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum number of tasks that can be processed simultaneously (as reported by the node itself)', null=True, verbose_name='Max Parallel Tasks'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nodeodm', '0010_processingnode_capacity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingNodeThroughput',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('options_hash', models.CharField(help_text='Identifier of the set of options used for processing', max_length=40, verbose_name='Options Hash')),
+                ('tasks', models.FloatField(default=0, help_text='Number of tasks that have completed (older tasks have less weight)', verbose_name='Tasks')),
+                ('images', models.FloatField(default=0, help_text='Number of images processed (older tasks have less weight)', verbose_name='Images')),
+                ('megapixels', models.FloatField(default=0, help_text='Number of megapixels processed (older tasks have less weight)', verbose_name='Megapixels')),
+                ('processing_time', models.FloatField(default=0, help_text='Number of seconds spent processing (older tasks have less weight)', verbose_name='Processing Time')),
+                ('stage_times', django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, help_text='Number of seconds spent in each processing stage (older tasks have less weight)', verbose_name='Stage Times')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Last time a task was added to these statistics', verbose_name='Updated at')),
+                ('processing_node', models.ForeignKey(help_text='Processing node these statistics refer to', on_delete=django.db.models.deletion.CASCADE, related_name='throughput_stats', to='nodeodm.ProcessingNode', verbose_name='Processing Node')),
+            ],
+            options={
+                'verbose_name': 'Processing Node Throughput',
+                'verbose_name_plural': 'Processing Node Throughput',
+                'unique_together': {('processing_node', 'options_hash')},
+            },
+        ),
+    ]
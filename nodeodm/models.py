@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.db import transaction
 from django.contrib.postgres import fields
 from django.utils import timezone
 from django.dispatch import receiver
@@ -11,14 +12,113 @@ from django.utils.translation import gettext_lazy as _
 
 from webodm import settings
 
+import os
 import json
+import hashlib
+import time
+import redis
+import mimetypes
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from pyodm import Node
 from pyodm import exceptions
-from django.db.models import signals
+from pyodm.types import TaskInfo
+from pyodm.utils import MultipartEncoder, options_to_json
+from .download import download
+from django.db.models import signals, Q, Sum, Count
+from django.db.models.functions import Coalesce
+from contextlib import contextmanager
+from redis.exceptions import LockError
+from . import status_codes
 from datetime import timedelta
 import logging
 
 logger = logging.getLogger('app.logger')
+redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+ASSIGNMENT_LOCK_KEY = 'processing_node_assignment'
+
+
+def get_options_hash(options):
+    """
+    :param options: options list ([{'name': optionName, 'value': optionValue}, ...])
+    :return: identifier of a set of options (the order of the options doesn't matter)
+    """
+    options = sorted([[o['name'], o['value']] for o in (options or []) if o.get('name') is not None], key=lambda o: o[0])
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def summarize_throughput(stats, options=None):
+    """
+    Summarize the processing statistics of a node
+    :param stats: ProcessingNodeThroughput instances of a single node
+    :param options: if set, and the node has processed tasks with these options, use only those
+    :return: dict, or None if there are no statistics
+    """
+    if options is not None:
+        options_hash = get_options_hash(options)
+        matching = [s for s in stats if s.options_hash == options_hash]
+        if len(matching) > 0:
+            stats = matching
+
+    processing_time = sum(s.processing_time for s in stats)
+    if processing_time <= 0:
+        return None
+
+    images = sum(s.images for s in stats)
+    megapixels = sum(s.megapixels for s in stats)
+    stage_times = {}
+    for s in stats:
+        for stage, t in s.stage_times.items():
+            stage_times[stage] = stage_times.get(stage, 0) + t
+
+    stages_time = sum(stage_times.values())
+
+    return {
+        'tasks': sum(s.tasks for s in stats),
+        'images_per_hour': images / processing_time * 3600.0,
+        'megapixels_per_hour': megapixels / processing_time * 3600.0,
+
+        # Fraction of the processing time spent in each stage
+        'stages': {stage: t / stages_time for stage, t in stage_times.items()} if stages_time > 0 else {},
+    }
+
+
+def estimate_nodes_throughput(nodes, options=None):
+    """
+    Estimate how many images per second each node can process. Nodes that have
+    completed tasks use their historical throughput, the others are estimated from
+    their number of CPU cores and the per-core throughput of the nodes with history.
+    :param nodes: list of ProcessingNode
+    :param options: options of the task to be processed (see summarize_throughput)
+    :return: dict of node ID --> images/second
+    """
+    stats = {}
+    for s in ProcessingNodeThroughput.objects.filter(processing_node__in=[n.id for n in nodes]):
+        stats.setdefault(s.processing_node_id, []).append(s)
+
+    history = {}
+    for n in nodes:
+        summary = summarize_throughput(stats.get(n.id, []), options)
+        if summary is not None and summary['images_per_hour'] > 0:
+            history[n.id] = summary['images_per_hour'] / 3600.0
+
+    # Nodes that don't report their CPU cores are assumed to be average
+    known_cores = [n.cpu_cores for n in nodes if n.cpu_cores]
+    default_cores = sum(known_cores) / len(known_cores) if len(known_cores) > 0 else 1
+
+    def cores(node):
+        return node.cpu_cores or default_cores
+
+    with_history = [n for n in nodes if n.id in history]
+    if len(with_history) > 0:
+        per_core = sum(history[n.id] for n in with_history) / sum(cores(n) for n in with_history)
+    else:
+        # No history at all, only relative capacity matters
+        per_core = 1.0
+
+    return {n.id: history.get(n.id, per_core * cores(n)) for n in nodes}
+
 
 class ProcessingNode(models.Model):
     hostname = models.CharField(verbose_name=_("Hostname"), max_length=255, help_text=_("Hostname or IP address where the node is located (can be an internal hostname as well). If you are using Docker, this is never 127.0.0.1 or localhost. Find the IP address of your host machine by running ifconfig on Linux or by checking your network settings."))
@@ -32,6 +132,9 @@ class ProcessingNode(models.Model):
     engine_version = models.CharField(verbose_name=_("Engine Version"), max_length=32, null=True, help_text=_("Engine version used by the node."))
     label = models.CharField(verbose_name=_("Label"), max_length=255, default="", blank=True, help_text=_("Optional label for this node. When set, this label will be shown instead of the hostname:port name."))
     engine = models.CharField(verbose_name=_("Engine"), max_length=255, null=True, help_text=_("Engine used by the node."))
+    cpu_cores = models.PositiveIntegerField(verbose_name=_("CPU Cores"), null=True, blank=True, help_text=_("Number of virtual CPU cores (as reported by the node itself)"))
+    total_memory = models.BigIntegerField(verbose_name=_("Total Memory"), null=True, blank=True, help_text=_("Amount of total RAM in bytes (as reported by the node itself)"))
+    max_parallel_tasks = models.PositiveIntegerField(verbose_name=_("Max Parallel Tasks"), null=True, blank=True, help_text=_("Maximum number of tasks that can be processed simultaneously (as reported by the node itself)"))
 
     class Meta:
         verbose_name = _("Processing Node")
@@ -44,9 +147,14 @@ class ProcessingNode(models.Model):
             return '{}:{}'.format(self.hostname, self.port)
 
     @staticmethod
-    def find_best_available_node(user = None):
+    def find_best_available_node(user = None, images_count = 0, options = None):
         """
-        Attempts to find an available node (seen in the last 5 minutes, and with lowest queue count)
+        Attempts to find an available node (seen in the last 5 minutes) that can accept
+        a task with images_count images and that is expected to finish it the earliest,
+        given its capacity (CPU cores, historical throughput) and current load
+        (images of the tasks assigned to it that are still waiting or processing).
+        If options are passed, the throughput of each node with those options is used, if known.
+        Callers that assign the node to a task should do so while holding node_assignment_lock
         :return: ProcessingNode | None
         """
         if user is not None:
@@ -56,8 +164,97 @@ class ProcessingNode(models.Model):
 
         if not settings.NODE_OPTIMISTIC_MODE:
             nodes = nodes.filter(last_refreshed__gte=timezone.now() - timedelta(minutes=settings.NODE_OFFLINE_MINUTES))
-        
-        return nodes.order_by('queue_count').first()
+
+        active = Q(task__status__in=[status_codes.QUEUED, status_codes.RUNNING]) | Q(task__status__isnull=True)
+        nodes = list(nodes.annotate(active_tasks=Count('task', filter=active),
+                                    active_images=Coalesce(Sum('task__images_count', filter=active), 0)))
+        if len(nodes) == 0:
+            return None
+
+        # Don't pick nodes that would refuse the task, unless there's no other choice
+        # (the user will then see the node's error)
+        accepting = [n for n in nodes if n.max_images is None or images_count <= n.max_images]
+        if len(accepting) > 0:
+            nodes = accepting
+
+        throughputs = estimate_nodes_throughput(nodes, options)
+        job_size = max(1, images_count)
+
+        def score(node):
+            # Tasks reported by the node that we don't know about (e.g. submitted
+            # by other clients) are assumed to be as large as this one
+            unknown_tasks = max(0, node.queue_count - node.active_tasks)
+            load = node.active_images + unknown_tasks * job_size
+
+            # Estimated seconds until this task would be done
+            return ((load + job_size) / throughputs[node.id], node.queue_count, -(node.total_memory or 0))
+
+        return min(nodes, key=score)
+
+    @staticmethod
+    @contextmanager
+    def node_assignment_lock():
+        """
+        Serializes the assignment of processing nodes across workers, so that
+        concurrent assignments see each other's tasks and don't all pick the same node
+        """
+        lock = redis_client.lock(ASSIGNMENT_LOCK_KEY, timeout=30)
+        acquired = lock.acquire(blocking_timeout=30)
+        if not acquired:
+            logger.warning("Cannot acquire the processing node assignment lock, assigning without it")
+        try:
+            yield
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except LockError:
+                    pass
+
+    def record_processing(self, images_count, processing_time, options=None, megapixels=0, stage_times={}):
+        """
+        Add a completed task to this node's processing statistics.
+        Older tasks count less and less (see NODE_THROUGHPUT_DECAY),
+        so that statistics follow changes to the node's hardware or software.
+        :param images_count: number of images
+        :param processing_time: seconds
+        :param options: options list used for processing
+        :param megapixels: total megapixels of the images
+        :param stage_times: dict of stage name --> seconds
+        """
+        decay = settings.NODE_THROUGHPUT_DECAY
+
+        with transaction.atomic():
+            stats, _ = ProcessingNodeThroughput.objects.select_for_update().get_or_create(processing_node=self,
+                                                                                           options_hash=get_options_hash(options))
+            stats.tasks = stats.tasks * decay + 1
+            stats.images = stats.images * decay + images_count
+            stats.megapixels = stats.megapixels * decay + megapixels
+            stats.processing_time = stats.processing_time * decay + processing_time
+            stage_times_total = {stage: t * decay for stage, t in stats.stage_times.items()}
+            for stage, t in stage_times.items():
+                stage_times_total[stage] = stage_times_total.get(stage, 0) + t
+            stats.stage_times = stage_times_total
+            stats.save()
+
+    def get_throughput(self, options=None):
+        """
+        :param options: options list (see summarize_throughput)
+        :return: summary of this node's processing statistics (see summarize_throughput) or None
+        """
+        return summarize_throughput(list(self.throughput_stats.all()), options)
+
+    def predict_processing_time(self, images_count, options=None, stats=None):
+        """
+        :param stats: this node's ProcessingNodeThroughput instances, if they have already been fetched
+        :return: expected number of seconds to process a task with images_count images, or None if unknown
+        """
+        if stats is None:
+            stats = list(self.throughput_stats.all())
+        throughput = summarize_throughput(stats, options)
+        if throughput is None or throughput['images_per_hour'] <= 0:
+            return None
+        return max(1, images_count) / throughput['images_per_hour'] * 3600.0
 
     def is_online(self):
         if settings.NODE_OPTIMISTIC_MODE:
@@ -86,6 +283,9 @@ class ProcessingNode(models.Model):
                 self.max_images = None
             self.engine_version = info.engine_version
             self.engine = info.engine
+            self.cpu_cores = info.cpu_cores if isinstance(info.cpu_cores, int) and info.cpu_cores > 0 else None
+            self.total_memory = info.total_memory if isinstance(info.total_memory, int) and info.total_memory > 0 else None
+            self.max_parallel_tasks = info.max_parallel_tasks if isinstance(info.max_parallel_tasks, int) and info.max_parallel_tasks > 0 else None
 
             options = list(map(lambda o: o.__dict__, api_client.options()))
             self.available_options = options
@@ -140,6 +340,80 @@ class ProcessingNode(models.Model):
         task = api_client.create_task(images, opts, name, progress_callback)
         return task.uuid
 
+    def supports_chunked_uploads(self):
+        """
+        :returns True if images can be sent one by one (init_task, upload_task_file, commit_task)
+        """
+        return Node.compare_version(self.api_version, "1.4.0") >= 0
+
+    def init_task(self, name=None, options=[]):
+        """
+        Initializes a new task that receives its images one at a time
+        via upload_task_file. Processing starts when commit_task is called.
+
+        :param name: name of the task
+        :param options: options to be used for processing ([{'name': optionName, 'value': optionValue}, ...])
+        :returns UUID of the new task
+        """
+        api_client = self.api_client()
+
+        fields = {'options': options_to_json(self.options_list_to_dict(options))}
+        if name is not None:
+            fields['name'] = name
+
+        e = MultipartEncoder(fields=fields)
+        result = api_client.post('/task/new/init', data=e, headers={'Content-Type': e.content_type})
+        if isinstance(result, dict) and 'error' in result:
+            raise exceptions.NodeResponseError(result['error'])
+        elif isinstance(result, dict) and 'uuid' in result:
+            return result['uuid']
+        else:
+            raise exceptions.NodeServerError("Invalid response from /task/new/init: %s" % result)
+
+    def upload_task_file(self, uuid, file, max_retries=5, retry_timeout=5):
+        """
+        Uploads an image (or GCP file, etc.) to a task created with init_task
+
+        :param file: path to the file
+        :param max_retries: number of times the upload is retried before giving up
+        :param retry_timeout: wait this many seconds (multiplied by the retry number) before retrying
+        """
+        api_client = self.api_client()
+        retry = 0
+
+        while True:
+            result = None
+            try:
+                with open(file, 'rb') as f:
+                    e = MultipartEncoder(fields={
+                        'images': (os.path.basename(file), f, mimetypes.guess_type(file)[0] or "image/jpg")
+                    })
+                    result = api_client.post('/task/new/upload/{}'.format(uuid), data=e, headers={'Content-Type': e.content_type})
+
+                if isinstance(result, dict) and result.get('success'):
+                    return
+                elif isinstance(result, dict) and 'error' in result:
+                    raise exceptions.NodeResponseError(result['error'])
+                else:
+                    raise exceptions.NodeServerError("Failed upload with unexpected result: %s" % str(result))
+            except exceptions.OdmError as e:
+                if retry < max_retries and not (isinstance(result, dict) and result.get('noRetry')):
+                    retry += 1
+                    logger.warning("Cannot upload {} to {} ({}), retrying...".format(file, self, str(e)))
+                    time.sleep(retry * retry_timeout)
+                else:
+                    raise e
+
+    def commit_task(self, uuid):
+        """
+        Starts processing a task created with init_task,
+        after all of its files have been uploaded
+        :returns UUID of the task
+        """
+        api_client = self.api_client()
+        result = api_client.post('/task/new/commit/{}'.format(uuid))
+        return api_client.handle_task_new_response(result).uuid
+
     def get_task_info(self, uuid, with_output=None):
         """
         Gets information about this task, such as name, creation date, 
@@ -156,6 +430,130 @@ class ProcessingNode(models.Model):
 
         return task_info
 
+    def get_tasks_info(self, tasks, threads=None):
+        """
+        Gets information about multiple tasks at once. Requests are sent
+        concurrently and share a pool of keep-alive connections to the node.
+
+        :param tasks: list of (uuid, with_output) tuples
+        :param threads: maximum number of concurrent requests (defaults to settings.NODE_POLL_THREADS)
+        :returns dict of uuid --> TaskInfo, or the OdmError that occurred while fetching it
+        """
+        if threads is None:
+            threads = settings.NODE_POLL_THREADS
+        threads = max(1, min(threads, len(tasks)))
+
+        api_client = self.api_client()
+
+        # Output support for older clients (use the stored version
+        # instead of asking the node for it)
+        legacy_output = Node.compare_version(self.api_version, "1.5.1") < 0
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        def get(url, query):
+            try:
+                res = session.get(api_client.url(url, query), timeout=api_client.timeout)
+                if res.status_code == 401:
+                    raise exceptions.NodeResponseError("Unauthorized. Do you need to set a token?")
+                elif not res.status_code in [200, 403, 206]:
+                    raise exceptions.NodeServerError("Unexpected status code: %s" % res.status_code)
+
+                result = res.json()
+                if isinstance(result, dict) and 'error' in result:
+                    raise exceptions.NodeResponseError(result['error'])
+                return result
+            except ValueError as e:
+                raise exceptions.NodeServerError(str(e))
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                raise exceptions.NodeConnectionError(str(e))
+
+        def fetch(task):
+            uuid, with_output = task
+            try:
+                query = {'with_output': with_output} if with_output is not None and not legacy_output else {}
+                info = TaskInfo(get('/task/{}/info'.format(uuid), query))
+
+                if legacy_output and with_output is not None:
+                    info.output = get('/task/{}/output'.format(uuid), {'line': with_output})
+                return uuid, info
+            except exceptions.OdmError as e:
+                return uuid, e
+            except (KeyError, TypeError) as e:
+                return uuid, exceptions.NodeServerError("Invalid task info: {}".format(str(e)))
+
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                return dict(executor.map(fetch, tasks))
+        finally:
+            session.close()
+
+    def poll_tasks(self, tasks):
+        """
+        Fetches the status of several tasks being processed by this node at once
+        and saves their progress (processing time, progress, console output) in bulk.
+        Status transitions and errors are left to Task.process.
+
+        :param tasks: list of app.models.Task with a UUID on this node
+        :returns (list of tasks that need to be processed, list of tasks that made progress)
+        """
+        from app.models import Task
+        from app.processing_stats import record_stages
+
+        lines_count = {task.uuid: task.console.lines_count() for task in tasks}
+        infos = self.get_tasks_info([(task.uuid, lines_count[task.uuid]) for task in tasks])
+        to_process = []
+        progressed = []
+        to_update = []
+        locks = []
+
+        try:
+            for task in tasks:
+                info = infos.get(task.uuid)
+
+                if isinstance(info, exceptions.NodeConnectionError):
+                    # Try again at the next check
+                    continue
+                elif isinstance(info, exceptions.OdmError) or info.status.value != task.status:
+                    to_process.append(task)
+                    continue
+
+                # Same lock as the worker's process_task, so that progress and
+                # console output are not written twice (or overwritten)
+                lock_id = 'task_lock_{}'.format(task.id)
+                if not redis_client.set(lock_id, time.time(), nx=True, ex=30):
+                    continue
+                locks.append(lock_id)
+
+                if task.console.lines_count() != lines_count[task.uuid]:
+                    # Output was appended while polling
+                    continue
+
+                running_progress = (info.progress / 100.0) * Task.TASK_PROGRESS_LAST_VALUE
+                if len(info.output) > 0 or running_progress != task.running_progress:
+                    progressed.append(task)
+
+                if len(info.output) > 0:
+                    task.console += "\n".join(info.output) + '\n'
+                    record_stages(task.id, info.output)
+
+                task.processing_time = info.processing_time
+                task.running_progress = running_progress
+                if info.last_error != "":
+                    task.last_error = info.last_error
+                to_update.append(task)
+
+            if len(to_update) > 0:
+                Task.objects.bulk_update(to_update, ['processing_time', 'running_progress', 'last_error'])
+        finally:
+            if len(locks) > 0:
+                redis_client.delete(*locks)
+
+        return to_process, progressed
+
     def get_task_console_output(self, uuid, line):
         """
         Retrieves the console output of the OpenDroneMap's process.
@@ -181,13 +579,29 @@ class ProcessingNode(models.Model):
         task = api_client.get_task(uuid)
         return task.remove()
 
-    def download_task_assets(self, uuid, destination, progress_callback, parallel_downloads=16):
+    def download_task_assets(self, uuid, download_path, progress_callback, parallel_downloads=16):
         """
-        Downloads a task asset
+        Downloads the assets archive (all.zip) of a task.
+        If a previous download to the same path was interrupted, it is resumed,
+        keeping the chunks that were already downloaded (see nodeodm.download)
+
+        :param download_path: path where to save the archive
+        :returns download_path
         """
         api_client = self.api_client()
-        task = api_client.get_task(uuid)
-        return task.download_zip(destination, progress_callback, parallel_downloads=parallel_downloads)
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, parallel_downloads))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        try:
+            return download(session, api_client.url('/task/{}/download/all.zip'.format(uuid)), download_path,
+                            progress_callback=progress_callback,
+                            parallel_downloads=parallel_downloads,
+                            timeout=api_client.timeout)
+        finally:
+            session.close()
 
     def restart_task(self, uuid, options = None):
         """
@@ -217,6 +631,22 @@ def auto_update_node_info(sender, instance, created, **kwargs):
         except Exception as e:
             logger.warning("auto_update_node_info: " + str(e))
 
+class ProcessingNodeThroughput(models.Model):
+    processing_node = models.ForeignKey(ProcessingNode, on_delete=models.CASCADE, related_name="throughput_stats", help_text=_("Processing node these statistics refer to"), verbose_name=_("Processing Node"))
+    options_hash = models.CharField(max_length=40, help_text=_("Identifier of the set of options used for processing"), verbose_name=_("Options Hash"))
+    tasks = models.FloatField(default=0, help_text=_("Number of tasks that have completed (older tasks have less weight)"), verbose_name=_("Tasks"))
+    images = models.FloatField(default=0, help_text=_("Number of images processed (older tasks have less weight)"), verbose_name=_("Images"))
+    megapixels = models.FloatField(default=0, help_text=_("Number of megapixels processed (older tasks have less weight)"), verbose_name=_("Megapixels"))
+    processing_time = models.FloatField(default=0, help_text=_("Number of seconds spent processing (older tasks have less weight)"), verbose_name=_("Processing Time"))
+    stage_times = fields.JSONField(default=dict, blank=True, help_text=_("Number of seconds spent in each processing stage (older tasks have less weight)"), verbose_name=_("Stage Times"))
+    updated_at = models.DateTimeField(auto_now=True, help_text=_("Last time a task was added to these statistics"), verbose_name=_("Updated at"))
+
+    class Meta:
+        verbose_name = _("Processing Node Throughput")
+        verbose_name_plural = _("Processing Node Throughput")
+        unique_together = ('processing_node', 'options_hash')
+
+
 class ProcessingNodeUserObjectPermission(UserObjectPermissionBase):
     content_object = models.ForeignKey(ProcessingNode, on_delete=models.CASCADE)
 
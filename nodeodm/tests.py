@@ -13,6 +13,8 @@ from pyodm.exceptions import NodeConnectionError, NodeServerError, NodeResponseE
 from webodm import settings
 from app.tests.utils import start_processing_node
 from .models import ProcessingNode
+from .download import invalidate_download, remove_download
+from app.zip_utils import get_corrupted_ranges
 from . import status_codes
 
 current_dir = path.dirname(path.realpath(__file__))
@@ -133,6 +135,13 @@ class TestClientApi(TestCase):
 
             self.assertRaises(NodeResponseError, online_node.get_task_console_output, "wrong-uuid", 0)
 
+            # Can get info about multiple tasks at once
+            infos = online_node.get_tasks_info([(uuid, 0), ("wrong-uuid", None)])
+            self.assertEqual(infos[uuid].uuid, uuid)
+            self.assertEqual(infos[uuid].status.value, status_codes.COMPLETED)
+            self.assertTrue(isinstance(infos[uuid].output, list) and len(infos[uuid].output) > 0)
+            self.assertTrue(isinstance(infos["wrong-uuid"], NodeResponseError))
+
             # Can restart task
             self.assertTrue(online_node.restart_task(uuid))
             self.assertRaises(NodeResponseError, online_node.restart_task, "wrong-uuid")
@@ -165,6 +174,19 @@ class TestClientApi(TestCase):
             # Task has been deleted
             self.assertRaises(NodeResponseError, online_node.get_task_info, uuid)
 
+            # Can create a task by uploading images one at a time
+            self.assertFalse(online_node.supports_chunked_uploads()) # API version is not set
+            self.assertTrue(online_node.update_node_info())
+            self.assertTrue(online_node.supports_chunked_uploads())
+            uuid = online_node.init_task("test_chunked", [{'name': 'force-ccd', 'value': 6.16}])
+            self.assertTrue(uuid != None)
+            for image in glob.glob("nodeodm/fixtures/test_images/*.JPG"):
+                online_node.upload_task_file(uuid, image)
+            self.assertEqual(online_node.commit_task(uuid), uuid)
+            self.assertEqual(online_node.get_task_info(uuid).images_count, len(glob.glob("nodeodm/fixtures/test_images/*.JPG")))
+            wait_for_status(api, uuid, status_codes.COMPLETED, 10, "Could not process chunked task")
+
+
             # Test URL building for HTTPS
             sslApi = Node("localhost", 443, 'abc')
             self.assertEqual(sslApi.url('/info'), 'https://localhost/info?token=abc')
@@ -201,6 +223,64 @@ class TestClientApi(TestCase):
             # Best choice now is original processing node
             self.assertTrue(ProcessingNode.find_best_available_node().id == pnode.id)
 
+    def test_find_best_available_node_capacity(self):
+        from django.contrib.auth.models import User
+        from app.models import Project, Task
+
+        project = Project.objects.create(owner=User.objects.create_user(username='capacity', password='test1234'), name="capacity")
+        small_node = ProcessingNode.objects.get(pk=1)
+        large_node = ProcessingNode.objects.get(pk=2)
+        for n in [small_node, large_node]:
+            n.last_refreshed = timezone.now()
+            n.queue_count = 0
+            n.save()
+
+        # More cores, more capacity
+        small_node.cpu_cores = 2
+        small_node.save()
+        large_node.cpu_cores = 16
+        large_node.save()
+        self.assertEqual(ProcessingNode.find_best_available_node(images_count=100).id, large_node.id)
+
+        # Nodes that don't accept that many images are skipped
+        large_node.max_images = 50
+        large_node.save()
+        self.assertEqual(ProcessingNode.find_best_available_node(images_count=100).id, small_node.id)
+        self.assertEqual(ProcessingNode.find_best_available_node(images_count=50).id, large_node.id)
+
+        # Unless no node accepts them
+        small_node.max_images = 50
+        small_node.save()
+        self.assertTrue(ProcessingNode.find_best_available_node(images_count=100) is not None)
+        small_node.max_images = large_node.max_images = None
+        small_node.save()
+        large_node.save()
+
+        # Images that are already assigned to a node count as load (even if the node
+        # hasn't reported them in its queue count yet)
+        Task.objects.create(project=project, processing_node=large_node, images_count=2000)
+        self.assertEqual(ProcessingNode.find_best_available_node(images_count=100).id, small_node.id)
+
+        # Completed tasks are not load
+        Task.objects.create(project=project, processing_node=large_node, images_count=5000,
+                            status=status_codes.COMPLETED)
+        self.assertEqual(ProcessingNode.find_best_available_node(images_count=100).id, small_node.id)
+
+        # Processing statistics tell us how fast a node is
+        small_node.record_processing(100, 1000)
+        large_node.record_processing(100, 1)
+        self.assertEqual(ProcessingNode.find_best_available_node(images_count=100).id, large_node.id)
+
+        # Also with specific options
+        options = [{'name': 'fast-orthophoto', 'value': True}]
+        small_node.record_processing(100, 1, options)
+        large_node.record_processing(100, 1000, options)
+        self.assertEqual(ProcessingNode.find_best_available_node(images_count=100, options=options).id, small_node.id)
+
+        # Assignments are serialized
+        with ProcessingNode.node_assignment_lock():
+            self.assertEqual(ProcessingNode.find_best_available_node(images_count=100).id, large_node.id)
+
     def test_token_auth(self):
         def wait_for_status(api, uuid, status, num_retries=10, error_description="Failed to wait for status"):
             retries = 0
@@ -263,6 +343,24 @@ class TestClientApi(TestCase):
             api.token = "test_token"
             asset_archive = task.download_zip(settings.MEDIA_TMP)
             self.assertTrue(os.path.exists(asset_archive))
+
+            # Resumable downloads
+            download_path = os.path.join(settings.MEDIA_TMP, "all.zip.download")
+            self.assertEqual(online_node.download_task_assets(uuid, download_path, None), download_path)
+            with open(asset_archive, 'rb') as a, open(download_path, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+            # Only corrupted parts are downloaded again
+            with open(download_path, 'r+b') as f:
+                f.write(b"corrupted")
+            corrupted_ranges = get_corrupted_ranges(download_path)
+            self.assertTrue(len(corrupted_ranges) > 0)
+            invalidate_download(download_path, corrupted_ranges)
+            online_node.download_task_assets(uuid, download_path, None)
+            self.assertEqual(get_corrupted_ranges(download_path, check_crc=True), [])
+            remove_download(download_path)
+            self.assertFalse(os.path.exists(download_path))
+
             os.unlink(asset_archive)
 
             # Cannot get task output without token
@@ -160,6 +160,9 @@ else
     fi
     echo "Web concurrency set to $WEB_CONCURRENCY"
 
+    # nginx sends the files downloaded through the API
+    export WO_DOWNLOAD_OFFLOAD="${WO_DOWNLOAD_OFFLOAD:=YES}"
+
     congrats
 
     nginx -c $(pwd)/nginx/$conf
@@ -364,6 +364,10 @@ if DEBUG and not TESTING:
 # before it should be considered offline
 NODE_OFFLINE_MINUTES = 5
 
+# Weight of past tasks in the processing statistics of a node,
+# each time a new task completes (1 = all tasks count the same)
+NODE_THROUGHPUT_DECAY = 0.95
+
 # When turned on, updates nodes information only when necessary
 # and assumes that all nodes are always online, avoiding polling
 NODE_OPTIMISTIC_MODE = False
@@ -396,12 +400,99 @@ CLEANUP_PARTIAL_TASKS = 72
 # are removed for users that have zero quotas
 CLEANUP_EMPTY_PROJECTS = None
 
+# Internal nginx location that maps to MEDIA_ROOT. When set, files that are
+# downloaded through the API are sent by nginx (via X-Accel-Redirect)
+# after permissions have been checked, instead of being read by Django
+DOWNLOAD_OFFLOAD_LOCATION = '/_media/' if os.environ.get('WO_DOWNLOAD_OFFLOAD', 'NO') == 'YES' else None
+
+# Deferred assets whose archives are built in the background when tasks
+# complete, instead of compressing them on the fly for every download.
+# Archives are stored in the task assets cache in addition to the files
+# they contain, so large ones (e.g. all.zip) are better left streamed
+DEFERRED_ASSETS_PREBUILD = ['textured_model.zip']
+
+# Number of files that are hashed and compressed at the same time
+# when building task backups (None to use WORKERS_MAX_THREADS)
+BACKUP_THREADS = None
+
 # Maximum number of threads that a worker should use for processing
 WORKERS_MAX_THREADS = 1
 
+# Number of threads used by entwine to build EPT point clouds
+# when a task completes (defaults to WORKERS_MAX_THREADS)
+EPT_THREADS = None
+
+# Number of directories that are scanned at the same time
+# when computing the size of a task on disk
+DISK_USAGE_SCAN_THREADS = 8
+
+# When resizing images, upload each image to the processing node
+# as soon as it has been resized (if the node supports chunked uploads)
+PIPELINE_RESIZE_UPLOADS = True
+
+# Number of images that are uploaded to a processing node at the same time
+NODE_UPLOAD_THREADS = 10
+
 # Maximum number of seconds a worker task should take before being terminated
 WORKERS_MAX_TIME_LIMIT = None
 
+# Maximum size in megabytes of the rendered map tiles cache
+# (set to 0 to disable caching of rendered tiles)
+TILE_CACHE_MAX_SIZE = 2048
+
+# Maximum number of idle raster handles that each web process keeps
+# open for serving tiles and metadata (set to 0 to disable pooling)
+RASTER_POOL_SIZE = 16
+
+# Number of seconds after which idle raster handles are closed
+RASTER_POOL_IDLE_TIMEOUT = 120
+
+# Maximum number of tiles that can be requested in a single batch tiles request
+TILES_BATCH_MAX_TILES = 64
+
+# Number of threads used to render the tiles of a batch tiles request
+TILES_BATCH_THREADS = 4
+
+# Maximum zoom level of pre-rendered tile pyramids
+# (None to render up to the native resolution of the rasters)
+TILE_PYRAMID_MAX_ZOOM = None
+
+# Number of threads used to pre-render tile pyramids
+# (None to use all available CPUs)
+TILE_PYRAMID_THREADS = None
+
+# Precompute a hillshade intensity raster for DSMs/DTMs when tasks complete,
+# so that hillshaded elevation tiles are blended rather than shaded on the fly
+HILLSHADE_PRECOMPUTE = False
+
+# Vertical exaggeration of the precomputed hillshade
+# (should match the default hillshade value of the map viewer)
+HILLSHADE_PRECOMPUTE_VERT_EXAG = 6
+
+# How often (in seconds) tasks that are being processed are checked for updates.
+# When a task doesn't change between checks, the interval grows by TASK_CHECK_BACKOFF
+# up to TASK_CHECK_MAX_INTERVAL. User actions (commit, cancel, restart, ...) are
+# processed right away.
+TASK_CHECK_INTERVAL = 5
+TASK_CHECK_MAX_INTERVAL = 60
+TASK_CHECK_BACKOFF = 1.5
+
+# How often (in seconds) the task scheduler is reconciled with the database
+TASK_SCHEDULE_SYNC_INTERVAL = 60
+
+# Maximum number of concurrent status requests sent to a processing node
+# when checking its running tasks
+NODE_POLL_THREADS = 8
+
+# Maximum time (in seconds) a request for new console output
+# waits for the output to change before returning
+CONSOLE_TAIL_TIMEOUT = 20
+
+# Maximum number of requests that can wait for new console output at the same time.
+# Each waiting request holds a web worker, so this should be lower than the number of workers.
+# Requests over the limit return right away.
+CONSOLE_TAIL_MAX_WAITERS = max(1, int(os.environ.get('WEB_CONCURRENCY', 3)) // 2)
+
 # Username to log-in automatically if the user is anonymous
 # (e.g. for a demo or read-only site)
 AUTO_LOGIN_USER = None
@@ -421,6 +512,10 @@ DASHBOARD_ONBOARDING = True
 
 if TESTING or FLUSHING:
     CELERY_TASK_ALWAYS_EAGER = True
+    TASK_CHECK_INTERVAL = 0
+    TASK_CHECK_MAX_INTERVAL = 0
+    TASK_SCHEDULE_SYNC_INTERVAL = 0
+    CONSOLE_TAIL_TIMEOUT = 2
     EXTERNAL_AUTH_ENDPOINT = 'http://0.0.0.0:5555/auth'
 
 try:
@@ -52,6 +52,14 @@ app.conf.beat_schedule = {
             'retry': False
         }
     },
+    'cleanup-tile-cache': {
+        'task': 'worker.tasks.cleanup_tile_cache',
+        'schedule': 600,
+        'options': {
+            'expires': 299,
+            'retry': False
+        }
+    },
     'process-pending-tasks': {
         'task': 'worker.tasks.process_pending_tasks',
         'schedule': 5,
@@ -68,6 +76,14 @@ app.conf.beat_schedule = {
         	'retry': False
         }
     },
+    'reconcile-disk-usage': {
+        'task': 'worker.tasks.reconcile_disk_usage',
+        'schedule': 86400,
+        'options': {
+            'expires': 43199,
+            'retry': False
+        }
+    },
 }
 
 # Mock class for handling async results during testing
@@ -4,6 +4,7 @@ import tempfile
 import traceback
 import json
 import socket
+import uuid
 
 import time
 from threading import Event, Thread
@@ -12,6 +13,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Count
 from django.db.models import Q
 from app.models import Profile
+from app.models.profile import reconcile_used_spaces
 
 from app.models import Project
 from app.models import Task
@@ -22,6 +24,10 @@ import worker
 from .celery import app
 from app.raster_utils import export_raster as export_raster_sync, extension_for_export_format
 from app.pointcloud_utils import export_pointcloud as export_pointcloud_sync
+from app.tile_cache import evict_tile_cache
+from app.tile_pyramid import generate_tile_pyramid
+from app.backup import get_build_lock_id as get_backup_build_lock_id, BUILD_QUEUE_TIMEOUT as BACKUP_BUILD_QUEUE_TIMEOUT, BUILD_LOCK_TIMEOUT as BACKUP_BUILD_LOCK_TIMEOUT
+from app import task_scheduler
 from django.utils import timezone
 from datetime import timedelta
 import redis
@@ -114,14 +120,17 @@ def cleanup_tmp_directory():
 
 @app.task(ignore_result=True)
 def cleanup_cache_directory():
-    # Delete files and folder in the task_assets folder after 30 days
-    task_assets_cache = os.path.join(settings.MEDIA_CACHE, "task_assets")
+    # Delete files and folder in the task_assets and backup_manifests folders after 30 days
     time_limit = 60 * 60 * 24 * 30
 
-    if os.path.isdir(task_assets_cache):
-        for f in os.listdir(task_assets_cache):
+    for cache_dir in ["task_assets", "backup_manifests"]:
+        cache_dir = os.path.join(settings.MEDIA_CACHE, cache_dir)
+        if not os.path.isdir(cache_dir):
+            continue
+
+        for f in os.listdir(cache_dir):
             now = time.time()
-            filepath = os.path.join(task_assets_cache, f)
+            filepath = os.path.join(cache_dir, f)
             modified = os.stat(filepath).st_mtime
             if modified < now - time_limit:
                 if os.path.isfile(filepath):
@@ -131,6 +140,135 @@ def cleanup_cache_directory():
 
                 logger.info('Cleaned up: %s (%s)' % (filepath, modified))
 
+@app.task(ignore_result=True)
+def cleanup_tile_cache():
+    # Keep the rendered tiles cache within its size budget
+    evict_tile_cache()
+
+@app.task(ignore_result=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
+def build_deferred_assets(taskId, assets=None):
+    try:
+        task = Task.objects.get(pk=taskId)
+    except ObjectDoesNotExist:
+        logger.info("Task {} has already been deleted.".format(taskId))
+        return
+
+    task.build_deferred_assets(assets)
+
+@app.task(ignore_result=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
+def generate_tile_pyramids(taskId, formula=None, bands=None):
+    """
+    Pre-render the default orthophoto/DSM/DTM tiles of a task
+    (and optionally the orthophoto with a plant health formula)
+    """
+    lock_id = 'tile_pyramid_lock_{}'.format(taskId)
+    lock_value = str(uuid.uuid4()).encode('utf-8')
+    lock_timeout = 60
+
+    # The lock expires if the worker dies, so that generation can be resumed later
+    if not redis_client.set(lock_id, lock_value, nx=True, ex=lock_timeout):
+        logger.info("Tile pyramids for task {} are already being generated".format(taskId))
+        return
+
+    def update_lock():
+        if redis_client.get(lock_id) == lock_value:
+            redis_client.expire(lock_id, lock_timeout)
+    cancel_monitor = setInterval(lock_timeout / 4, update_lock)
+
+    def release_lock(pipe):
+        if pipe.get(lock_id) == lock_value:
+            pipe.multi()
+            pipe.delete(lock_id)
+
+    try:
+        try:
+            task = Task.objects.get(pk=taskId)
+        except ObjectDoesNotExist:
+            logger.info("Task {} has already been deleted.".format(taskId))
+            return
+
+        jobs = [(tile_type, None, None) for tile_type in ['orthophoto', 'dsm', 'dtm']]
+        if formula is not None:
+            jobs.append(('orthophoto', formula, bands))
+
+        for tile_type, f, b in jobs:
+            if not os.path.isfile(task.get_asset_download_path(tile_type + ".tif")):
+                continue
+
+            try:
+                generate_tile_pyramid(task, tile_type, formula=f, bands=b)
+            except Exception as e:
+                logger.error("Cannot generate {} tile pyramid for {}: {}".format(tile_type, task, str(e)))
+    finally:
+        cancel_monitor()
+        try:
+            redis_client.transaction(release_lock, lock_id)
+        except redis.exceptions.RedisError:
+            pass
+
+def schedule_task_backup(taskId, since=None):
+    """
+    Start building the backup of a task, unless it's already being built
+    :return: ID of the worker task building the backup
+    """
+    lock_id = get_backup_build_lock_id(taskId)
+
+    while True:
+        celery_task_id = str(uuid.uuid4())
+        if redis_client.set(lock_id, celery_task_id, nx=True, ex=BACKUP_BUILD_QUEUE_TIMEOUT):
+            build_task_backup.apply_async((taskId, since), task_id=celery_task_id)
+            return celery_task_id
+
+        building = redis_client.get(lock_id)
+        if building is not None:
+            return building.decode('utf-8')
+
+@app.task(bind=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
+def build_task_backup(self, taskId, since=None):
+    """
+    Build the backup of a task (see schedule_task_backup)
+    """
+    lock_id = get_backup_build_lock_id(taskId)
+    lock_value = self.request.id.encode('utf-8')
+    lock_timeout = BACKUP_BUILD_LOCK_TIMEOUT
+
+    # The lock was set when scheduling, but it might have expired while queued
+    # and be held by another build, in which case we wait for it to finish
+    while not redis_client.set(lock_id, lock_value, nx=True, ex=lock_timeout):
+        if redis_client.get(lock_id) == lock_value:
+            redis_client.expire(lock_id, lock_timeout)
+            break
+        time.sleep(1)
+
+    def update_lock():
+        if redis_client.get(lock_id) == lock_value:
+            redis_client.expire(lock_id, lock_timeout)
+    cancel_monitor = setInterval(lock_timeout / 4, update_lock)
+
+    def release_lock(pipe):
+        if pipe.get(lock_id) == lock_value:
+            pipe.multi()
+            pipe.delete(lock_id)
+
+    try:
+        task = Task.objects.get(pk=taskId)
+        backup_path, backup_id = task.get_task_backup(since)
+        result = {'backup_id': backup_id}
+    except Exception as e:
+        logger.error("Cannot build backup for task {}: {}".format(taskId, str(e)))
+        result = {'error': str(e)}
+    finally:
+        cancel_monitor()
+        try:
+            redis_client.transaction(release_lock, lock_id)
+        except redis.exceptions.RedisError:
+            pass
+
+    if settings.TESTING:
+        TestSafeAsyncResult.set(self.request.id, result)
+
+    return result
+
 # Based on https://stackoverflow.com/questions/22498038/improve-current-implementation-of-a-setinterval-python/22498708#22498708
 def setInterval(interval, func, *args):
     stopped = Event()
@@ -169,8 +307,10 @@ def process_task(taskId):
             task = Task.objects.get(pk=taskId)
         except ObjectDoesNotExist:
             logger.info("Task {} has already been deleted.".format(taskId))
+            unschedule_task(taskId)
             return
 
+        state = get_task_state(taskId)
         try:
             task.process()
         except Exception as e:
@@ -178,6 +318,8 @@ def process_task(taskId):
                 "Uncaught error! This is potentially bad. Please report it to http://github.com/OpenDroneMap/WebODM/issues: {} {}".format(
                     e, traceback.format_exc()))
             if settings.TESTING: raise e
+        finally:
+            reschedule_task(taskId, state)
     finally:
         if cancel_monitor is not None:
             cancel_monitor()
@@ -202,11 +344,117 @@ def get_pending_tasks():
                                   processing_node__isnull=False, partial=False) |
                                 Q(pending_action__isnull=False, partial=False))
 
+def get_task_state(taskId):
+    # Fields that tell whether a task has made progress between checks
+    return Task.objects.filter(pk=taskId).values_list('status', 'pending_action', 'processing_node',
+                                                      'uuid', 'upload_progress', 'running_progress').first()
+
+def reschedule_task(taskId, previous_state):
+    """
+    Schedule the next check of a task after it has been processed
+    :param previous_state: task state (see get_task_state) before processing
+    """
+    try:
+        state = get_task_state(taskId)
+        if state is None or not get_pending_tasks().filter(pk=taskId).exists():
+            # Deleted, completed, failed or canceled
+            task_scheduler.unschedule_task(taskId)
+        elif state[1] is not None:
+            # A pending action was set while processing
+            task_scheduler.wake_task(taskId)
+        else:
+            task_scheduler.reschedule_task(taskId, changed=state != previous_state)
+    except redis.exceptions.RedisError as e:
+        # The task will be picked up again when the schedule is synced
+        logger.warning("Cannot reschedule task {}: {}".format(taskId, str(e)))
+
+def unschedule_task(taskId):
+    try:
+        task_scheduler.unschedule_task(taskId)
+    except redis.exceptions.RedisError:
+        pass
+
+def wake_task(taskId):
+    """
+    Process a task right away (e.g. after a user action)
+    and reset its check interval
+    """
+    try:
+        task_scheduler.wake_task(taskId)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Cannot wake task {}: {}".format(taskId, str(e)))
+
+    process_task.delay(taskId)
+
 @app.task(ignore_result=True)
 def process_pending_tasks():
-    tasks = get_pending_tasks()
+    # Reconcile the schedule with the database every so often,
+    # so that tasks that were never scheduled (or got lost) are picked up
+    if task_scheduler.is_sync_due():
+        task_scheduler.sync_schedule(get_pending_tasks().values_list('id', flat=True))
+
+    # Only dispatch the tasks that are due for a check
+    due = task_scheduler.claim_due_tasks()
+    polled = poll_running_tasks(due)
+
+    for task_id in due:
+        if task_id not in polled:
+            process_task.delay(task_id)
+
+def poll_running_tasks(task_ids):
+    """
+    Running tasks mostly need a status update from their processing node.
+    Poll them in batches (one per node) and only dispatch the full processing
+    of tasks whose status changed.
+    :param task_ids: IDs of the tasks that are due for a check
+    :return: set of IDs of the tasks that have been handled
+    """
+    tasks = Task.objects.filter(pk__in=task_ids, partial=False, pending_action__isnull=True,
+                                processing_node__isnull=False,
+                                status__in=[status_codes.QUEUED, status_codes.RUNNING]) \
+                        .exclude(uuid='').select_related('processing_node')
+
+    nodes = {}
     for task in tasks:
-        process_task.delay(task.id)
+        nodes.setdefault(task.processing_node_id, []).append(task)
+
+    handled = set()
+    for node_tasks in nodes.values():
+        node = node_tasks[0].processing_node
+
+        # Offline nodes need to be handled by Task.process
+        if not node.is_online():
+            continue
+
+        # Skip tasks that are already being processed
+        # (they are rescheduled when done)
+        pollable = []
+        for task in node_tasks:
+            if redis_client.exists('task_lock_{}'.format(task.id)):
+                handled.add(str(task.id))
+            else:
+                pollable.append(task)
+
+        if len(pollable) == 0:
+            continue
+
+        try:
+            to_process, progressed = node.poll_tasks(pollable)
+        except Exception as e:
+            logger.warning("Cannot poll tasks of {}: {}".format(node, str(e)))
+            continue
+
+        for task in pollable:
+            handled.add(str(task.id))
+            if task in to_process:
+                process_task.delay(task.id)
+            else:
+                try:
+                    task_scheduler.reschedule_task(task.id, changed=task in progressed)
+                except redis.exceptions.RedisError as e:
+                    logger.warning("Cannot reschedule task {}: {}".format(task.id, str(e)))
+
+    return handled
 
 
 @app.task(bind=True, time_limit=settings.WORKERS_MAX_TIME_LIMIT)
@@ -247,9 +495,12 @@ def export_pointcloud(self, input, **opts):
 
 @app.task(ignore_result=True)
 def check_quotas():
-    profiles = Profile.objects.filter(quota__gt=-1)
+    profiles = Profile.objects.filter(quota__gt=-1).select_related('user')
     for p in profiles:
-        if p.has_exceeded_quota():
+        # Disk usage is kept up to date as tasks change size,
+        # there's no need to add up the size of all tasks
+        used = p.used_space
+        if used > p.quota:
             deadline = p.get_quota_deadline()
             if deadline is None:
                 deadline = p.set_quota_deadline(settings.QUOTA_EXCEEDED_GRACE_PERIOD)
@@ -257,21 +508,33 @@ def check_quotas():
             if now > deadline:
                 # deadline passed, delete tasks until quota is met
                 logger.info("Quota deadline expired for %s, deleting tasks" % str(p.user.username))
-                task_count = Task.objects.filter(project__owner=p.user).count()
-                c = 0
 
-                while p.has_exceeded_quota():
+                for last_task in Task.objects.filter(project__owner=p.user).order_by("-created_at"):
+                    if used <= p.quota:
+                        break
+
                     try:
-                        last_task = Task.objects.filter(project__owner=p.user).order_by("-created_at").first()
-                        if last_task is None:
-                            break
                         logger.info("Deleting %s" % last_task)
                         last_task.delete()
+                        used -= last_task.size
                     except Exception as e:
                         logger.warn("Cannot delete %s for %s: %s" % (str(last_task), str(p.user.username), str(e)))
-                    
-                    c += 1
-                    if c >= task_count:
-                        break
         else:
             p.clear_quota_deadline()
+
+
+@app.task(ignore_result=True)
+def reconcile_disk_usage():
+    """
+    Rescan the parts of task directories that have changed without
+    their size being updated, then fix the disk usage of users that drifted
+    """
+    count = 0
+    for task in Task.objects.select_related('project').iterator():
+        components = task.get_changed_size_components()
+        if len(components) > 0:
+            task.update_size(commit=True, components=components)
+            count += 1
+
+    fixed = reconcile_used_spaces()
+    logger.info("Reconciled disk usage ({} tasks rescanned, {} users fixed)".format(count, fixed))